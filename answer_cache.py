@@ -0,0 +1,124 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+from normalize import normalize_question
+
+
+# -------------------------------
+# Similarity
+# -------------------------------
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if (a or b) else 0.0
+
+
+# -------------------------------
+# Answer Cache
+# -------------------------------
+class AnswerCache:
+    """
+    OpenAI の回答を SQLite に保存する2段階のキャッシュ。
+    1段目は正規化した質問とマニュアルのバージョンハッシュの完全一致、
+    2段目は文字 bigram の Jaccard 類似度による近似一致（threshold が None の場合は無効）。
+    """
+
+    def __init__(self, path, max_entries=1000, ttl_seconds=7 * 24 * 3600, similarity_threshold=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                manual_version TEXT NOT NULL,
+                normalized_question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS answers_version ON answers (manual_version);
+            CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access);
+            """
+        )
+
+    @staticmethod
+    def _key(normalized, manual_version):
+        return hashlib.sha1(f"{manual_version}\x1f{normalized}".encode('utf-8')).hexdigest()
+
+    def get(self, question, manual_version):
+        """
+        キャッシュされた回答を検索し、(回答, 'cache' または 'cache-similar') を返す関数（ない場合は None）
+        """
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        now = time.time()
+        expires = now - self.ttl_seconds
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key, answer FROM answers WHERE key = ? AND created_at >= ?",
+                (self._key(normalized, manual_version), expires),
+            ).fetchone()
+            source = 'cache'
+            if row is None and self.similarity_threshold is not None:
+                row = self._find_similar(normalized, manual_version, expires)
+                source = 'cache-similar'
+            if row is None:
+                return None
+            self._conn.execute("UPDATE answers SET last_access = ? WHERE key = ?", (now, row[0]))
+        return row[1], source
+
+    def _find_similar(self, normalized, manual_version, expires):
+        query = _bigrams(normalized)
+        best, best_score = None, self.similarity_threshold
+        for key, candidate, answer in self._conn.execute(
+            "SELECT key, normalized_question, answer FROM answers WHERE manual_version = ? AND created_at >= ?",
+            (manual_version, expires),
+        ):
+            score = _jaccard(query, _bigrams(candidate))
+            if score >= best_score:
+                best, best_score = (key, answer), score
+        return best
+
+    def put(self, question, manual_version, answer):
+        """
+        回答をキャッシュに保存し、期限切れ・上限超過のエントリを LRU で削除する関数
+        """
+        normalized = normalize_question(question)
+        if not normalized:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO answers (key, manual_version, normalized_question, answer, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET answer = excluded.answer,
+                    created_at = excluded.created_at, last_access = excluded.last_access
+                """,
+                (self._key(normalized, manual_version), manual_version, normalized, answer, now, now),
+            )
+            self._conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                """
+                DELETE FROM answers WHERE key IN (
+                    SELECT key FROM answers ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+    def invalidate(self, manual_version):
+        """
+        現在のマニュアルバージョン以外のエントリを削除する関数（manual.csv の変更時に呼び出す）
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM answers WHERE manual_version != ?", (manual_version,))
@@ -1,26 +1,49 @@
 import streamlit as st
-import openai
 import pandas as pd
+import numpy as np
 import os
+import hashlib
 import json
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+import math
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as dt_time, timedelta, timezone
 
-# -------------------------------
-# OpenAI API Key Setup
-# -------------------------------
-openai.api_key = os.getenv("OPENAI_API_KEY")
+import config
+import gap_mining
+import llm
+import metrics
+import retrieval
+from answer_cache import AnswerCache
+from conversation_store import ConversationStore, depends_on_context
+from drive_sync import DriveClient, DrivePullWorker, DriveSyncWorker
+from faq_warmup import FAQAnswerStore, FAQWarmer
+from feedback_store import NOT_RATED, FeedbackStore
+from manual_import import SUPPORTED_FORMATS, ImportFormatError, detect_format, export_manual, import_manual
+from manual_index import ManualIndex
+from manual_store import ManualStore, ManualVersionConflict, append_rows, build_changeset, read_manual_csv
+from normalize import normalize_question
+from prompt_builder import PromptBuilder, PromptTooLongError
+
+# アップロード先のGoogle DriveフォルダID
+folder_id = '1ifXllfufA5EVGlWVEk8RAYvrQKE-5Ox9'  # ご提供のフォルダIDに置き換えてください
 
 # -------------------------------
 # Google Drive Authentication
 # -------------------------------
 def authenticate_google_drive():
     """
-    Google Driveにサービスアカウントを使用して認証し、Driveサービスオブジェクトを返す関数
+    Google Driveにサービスアカウントを使用して認証し、Driveクライアントを返す関数
+    （GDRIVE_API_ENDPOINT にローカルのフェイクサーバーを指定した場合は認証を省略する）。
+    初回のアップロード時にバックグラウンドワーカー内で1回だけ呼ばれるため、
+    認証ライブラリの読み込みもここで行う。
     """
     credentials_json = os.getenv("GDRIVE_CREDENTIALS")
     if not credentials_json:
+        if config.GDRIVE_API_ENDPOINT != config.DEFAULT_GDRIVE_API_ENDPOINT:
+            import requests
+            return DriveClient(requests.Session(), folder_id, endpoint=config.GDRIVE_API_ENDPOINT)
         raise ValueError("GDRIVE_CREDENTIALS 環境変数が設定されていません。")
     
     try:
@@ -28,60 +51,64 @@ def authenticate_google_drive():
     except json.JSONDecodeError:
         raise ValueError("GDRIVE_CREDENTIALS 環境変数のJSONが無効です。")
     
+    from google.auth.transport.requests import AuthorizedSession
+    from google.oauth2 import service_account
+
     credentials = service_account.Credentials.from_service_account_info(
         service_account_info,
         scopes=["https://www.googleapis.com/auth/drive"]
     )
     
-    service = build('drive', 'v3', credentials=credentials)
-    return service
+    return DriveClient(AuthorizedSession(credentials), folder_id, endpoint=config.GDRIVE_API_ENDPOINT)
 
-# Google Driveに認証
-try:
-    drive_service = authenticate_google_drive()
-except Exception as e:
-    st.error(f"Google Drive authentication failed: {e}")
+# -------------------------------
+# Metrics
+# -------------------------------
+@st.cache_resource
+def start_metrics_exporters():
+    """
+    メトリクスの HTTP エンドポイントとスパンのログを有効にする関数（プロセスごとに1回のみ実行）
+    """
+    if config.METRICS_LOG_PATH:
+        metrics.enable_span_log(config.METRICS_LOG_PATH)
+    if config.METRICS_PORT:
+        try:
+            return metrics.start_http_server(metrics.REGISTRY, config.METRICS_PORT)
+        except OSError as e:
+            st.warning(f"Failed to start the metrics endpoint on port {config.METRICS_PORT}: {e}")
+    return None
 
-# アップロード先のGoogle DriveフォルダID
-folder_id = '1ifXllfufA5EVGlWVEk8RAYvrQKE-5Ox9'  # ご提供のフォルダIDに置き換えてください
+start_metrics_exporters()
 
 # -------------------------------
-# File Upload Function
+# Background Drive Sync
 # -------------------------------
-def upload_file_to_drive(service, file_path, folder_id):
+@st.cache_resource
+def get_drive_sync_worker():
     """
-    指定されたファイルをGoogle Driveの指定フォルダにアップロードまたは更新する関数
+    Google Drive へのアップロードを行うバックグラウンドワーカーを起動して返す関数（プロセスごとに1つ）
     """
-    file_name = os.path.basename(file_path)
-    file_metadata = {
-        'name': file_name,
-        'parents': [folder_id]
-    }
-    media = MediaFileUpload(file_path, resumable=True)
-    try:
-        # ファイルが既に存在するか確認
-        existing_files = service.files().list(
-            q=f"name='{file_name}' and '{folder_id}' in parents and trashed=false",
-            fields='files(id, name)'
-        ).execute()
-        if existing_files['files']:
-            # 既存のファイルを更新
-            file_id = existing_files['files'][0]['id']
-            service.files().update(
-                fileId=file_id,
-                media_body=media
-            ).execute()
-            st.write(f'Updated {file_name} in Google Drive.')
-        else:
-            # 新しいファイルをアップロード
-            service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
-            st.write(f'Uploaded {file_name} to Google Drive.')
-    except Exception as e:
-        st.error(f"Failed to upload {file_name} to Google Drive: {e}")
+    worker = DriveSyncWorker(
+        authenticate_google_drive,
+        debounce_seconds=config.DRIVE_SYNC_DEBOUNCE_SECONDS,
+        max_pending=config.DRIVE_SYNC_MAX_PENDING,
+        max_retries=config.DRIVE_SYNC_MAX_RETRIES,
+    )
+    return worker.start()
+
+drive_sync = get_drive_sync_worker()
+
+def upload_file_to_drive(file_path, prepare=None, on_uploaded=None):
+    """
+    指定されたファイルの Google Drive へのアップロードをバックグラウンドで予約する関数
+    """
+    with metrics.span('drive_schedule'):
+        scheduled = drive_sync.schedule(file_path, prepare, on_uploaded)
+    if not scheduled:
+        st.warning(f"Google Drive sync queue is full; {os.path.basename(file_path)} will be uploaded later.")
+
+if drive_sync.last_error:
+    st.error(drive_sync.last_error)
 
 # -------------------------------
 # Streamlit App Configuration
@@ -195,13 +222,9 @@ def load_manual_data():
     """
     if os.path.exists('manual.csv'):
         try:
-            data = pd.read_csv('manual.csv', encoding='utf-8')
-            # 'priority' 列の欠損値を許容し、Int64型に変換（欠損値を許容）
-            if 'priority' in data.columns:
-                data['priority'] = pd.to_numeric(data['priority'], errors='coerce').astype('Int64')
-            else:
-                # 'priority' 列がない場合は追加（全てNaN）
-                data['priority'] = pd.Series([pd.NA] * len(data))
+            with metrics.span('load_manual'):
+                # 'priority' 列の欠損値を許容し、Int64型に変換（欠損値を許容）
+                data = read_manual_csv('manual.csv')
             if data.empty:
                 st.error("The manual.csv file is empty. Please add data.")
                 return pd.DataFrame(columns=['question', 'answer', 'priority'])
@@ -216,44 +239,431 @@ def load_manual_data():
         st.error("The manual.csv file was not found.")
         return pd.DataFrame(columns=['question', 'answer', 'priority'])
 
-manual_data = load_manual_data()
+@st.cache_resource
+def get_manual_store():
+    """
+    全セッションで共有するマニュアルのストアを返す関数（manual.csv の読み込みはプロセスごとに1回のみ）
+    """
+    return ManualStore(load_manual_data())
+
+manual_store = get_manual_store()
+
+# 現在のスナップショットを参照する（他のセッションによる変更は次の再実行で反映される）
+manual_snapshot = manual_store.snapshot()
+manual_data = manual_snapshot.data
+
+# -------------------------------
+# Manual Search Index
+# -------------------------------
+@st.cache_resource
+def get_manual_index():
+    """
+    マニュアル検索インデックスを開き、manual.csv との差分のみを反映して返す関数（プロセスごとに1回のみ実行）
+    """
+    try:
+        embedding_backend = retrieval.get_embedding_backend(
+            config.RETRIEVAL_EMBEDDING_BACKEND, config.RETRIEVAL_EMBEDDING_MODEL,
+            cache_size=config.RETRIEVAL_EMBEDDING_CACHE_SIZE,
+        )
+    except ValueError as e:
+        st.warning(f"Embedding backend is disabled: {e}")
+        embedding_backend = None
+    index = ManualIndex(
+        config.MANUAL_INDEX_PATH, embedding_backend=embedding_backend,
+        embedding_batch_size=config.RETRIEVAL_EMBEDDING_BATCH_SIZE,
+    )
+    index.sync(manual_store.snapshot().data)
+    return index
+
+manual_index = get_manual_index()
+
+# -------------------------------
+# Prompt Builder
+# -------------------------------
+@st.cache_resource
+def get_prompt_builder():
+    """
+    検索インデックスから OpenAI に送るプロンプトを組み立てるビルダーを返す関数（プロセスごとに1つ）
+    """
+    return PromptBuilder(
+        manual_index,
+        top_k=config.RETRIEVAL_TOP_K,
+        token_budget=config.RETRIEVAL_TOKEN_BUDGET,
+        prefix_token_budget=config.PROMPT_PREFIX_TOKEN_BUDGET,
+        max_prompt_tokens=config.PROMPT_MAX_TOKENS,
+        min_match_coverage=config.RETRIEVAL_MIN_MATCH_COVERAGE,
+    )
+
+prompt_builder = get_prompt_builder()
+
+# -------------------------------
+# Answer Cache
+# -------------------------------
+@st.cache_resource
+def get_answer_cache():
+    """
+    回答キャッシュを開いて返す関数（SQLite ファイルを全プロセスで共有する）
+    """
+    return AnswerCache(
+        config.ANSWER_CACHE_PATH,
+        max_entries=config.ANSWER_CACHE_MAX_ENTRIES,
+        ttl_seconds=config.ANSWER_CACHE_TTL_SECONDS,
+        similarity_threshold=config.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+    )
+
+answer_cache = get_answer_cache()
+
+def update_manual_index(added=None, removed=None):
+    """
+    管理者による変更で追加・削除された行のみをインデックスに反映し、古い回答キャッシュを破棄する関数
+    """
+    try:
+        if removed is not None:
+            manual_index.remove_rows(removed)
+        if added is not None:
+            manual_index.add_rows(added)
+    except Exception as e:
+        st.error(f"Failed to update the manual search index: {e}")
+    answer_cache.invalidate(manual_index.version())
+    # 内容が変わった FAQ の行の回答のみをバックグラウンドで作り直す
+    if faq_warmer is not None:
+        faq_warmer.schedule()
+
+def write_manual_csv(snapshot):
+    """
+    スナップショットを manual.csv に書き出す関数（ManualStore.publish のロック内で呼び、公開の順に書き出す）
+    """
+    with metrics.span('to_csv'):
+        # 一時ファイルに書き出してから置き換え、書き込み途中の manual.csv が読まれないようにする
+        tmp_path = f"manual.csv.{uuid.uuid4().hex}.tmp"
+        snapshot.data.to_csv(tmp_path, index=False, encoding='utf-8')
+        os.replace(tmp_path, 'manual.csv')
+
+def manual_sync_callbacks():
+    """
+    manual.csv のアップロードの直前・成功後に呼ぶ関数の組を返す関数（直前に他のプロセスの変更を取り込み、
+    アップロードした内容を次に他のプロセスの変更を取り込む際の共通の祖先として記録する）
+    """
+    uploaded = []
+
+    def prepare():
+        # 他のプロセスがアップロードした変更を上書きしないよう、先に取り込んでからアップロードする
+        if drive_pull is not None:
+            drive_pull.pull('manual.csv')
+        uploaded.append(manual_store.snapshot().data)
 
-# manual_data をセッションステートに保存
-if 'manual_data' not in st.session_state:
-    st.session_state['manual_data'] = manual_data
-else:
-    manual_data = st.session_state['manual_data']
+    return prepare, lambda: manual_store.mark_synced(uploaded[-1])
+
+def save_manual_data(data, added=None, removed=None, base=None):
+    """
+    変更後のマニュアルを新しいバージョンとして公開し、manual.csv・インデックス・Google Drive に反映する関数。
+    base は編集元のスナップショット（省略時はこの実行の開始時のスナップショット）。
+    （他のセッションが先に公開していた場合は変更をそのバージョンに適用し直し、同じ行を変更していた場合は保存せず False を返す）
+    """
+    base = base or manual_snapshot
+    with metrics.span('admin_save'):
+        try:
+            manual_store.publish(data, base.version, base_data=base.data, on_publish=write_manual_csv)
+        except ManualVersionConflict as e:
+            metrics.increment('manual_save_conflicts_total')
+            st.error(f"{e} Please reload the page and try again.")
+            return False
+        with metrics.span('index_update'):
+            update_manual_index(added=added, removed=removed)
+        # Google Drive にアップロード
+        prepare, on_uploaded = manual_sync_callbacks()
+        upload_file_to_drive('manual.csv', prepare=prepare, on_uploaded=on_uploaded)
+    return True
 
 # -------------------------------
-# Load Feedback Data
+# Feedback Event Store
 # -------------------------------
-def load_feedback_data():
+@st.cache_resource
+def get_feedback_store():
     """
-    feedback.csv ファイルをロードし、データフレームを返す関数
+    フィードバックのイベントストアを開いて返す関数（初回のみ既存の feedback.csv を取り込む）
     """
-    if os.path.exists('feedback.csv'):
+    store = FeedbackStore(config.FEEDBACK_DB_PATH)
+    if store.is_empty() and os.path.exists('feedback.csv'):
         try:
-            data = pd.read_csv('feedback.csv', encoding='utf-8')
-            if data.empty:
-                st.warning("The feedback.csv file is empty.")
-                return pd.DataFrame(columns=['question', 'answer', 'feedback'])
-            return data
-        except pd.errors.EmptyDataError:
-            st.warning("The feedback.csv file has no data.")
-            return pd.DataFrame(columns=['question', 'answer', 'feedback'])
+            store.import_legacy_csv('feedback.csv')
         except Exception as e:
-            st.error(f"An error occurred while loading feedback.csv: {e}")
-            return pd.DataFrame(columns=['question', 'answer', 'feedback'])
-    else:
-        return pd.DataFrame(columns=['question', 'answer', 'feedback'])
+            st.error(f"An error occurred while importing feedback.csv: {e}")
+    return store
+
+feedback_store = get_feedback_store()
+
+def sync_feedback_to_drive():
+    """
+    feedback.csv の Google Drive へのバックアップを予約する関数
+    （CSV の書き出しはアップロード直前にワーカー内で行うため、連続したイベントは1回にまとめられる）
+    """
+    upload_file_to_drive('feedback.csv', prepare=lambda: feedback_store.export_csv('feedback.csv'))
+
+# -------------------------------
+# Precomputed FAQ Answers
+# -------------------------------
+@st.cache_resource
+def get_faq_answer_store():
+    """
+    事前に生成した FAQ の回答のストアを開いて返す関数（プロセスごとに1回のみ実行）
+    """
+    return FAQAnswerStore(config.FAQ_ANSWERS_PATH)
+
+faq_answer_store = get_faq_answer_store()
+
+@st.cache_resource
+def get_faq_warmer():
+    """
+    優先度1の行とよく聞かれる質問の回答を事前に生成するバックグラウンドのジョブを開始して返す関数
+    （プロセスごとに1回のみ実行。無効な場合は None）
+    """
+    if not config.FAQ_WARMUP_ENABLED:
+        return None
+    popular_questions = None
+    if config.FAQ_WARMUP_TOP_QUESTIONS > 0:
+        def popular_questions():
+            return feedback_store.popular_questions(config.FAQ_WARMUP_TOP_QUESTIONS)['question'].tolist()
+    warmer = FAQWarmer(
+        faq_answer_store, manual_index, prompt_builder, llm.complete,
+        popular_questions=popular_questions, concurrency=config.FAQ_WARMUP_CONCURRENCY,
+    )
+    warmer.schedule()
+    return warmer
+
+faq_warmer = get_faq_warmer()
+
+# -------------------------------
+# Pull Changes from Other Instances
+# -------------------------------
+@st.cache_resource
+def get_manual_pull_conflicts():
+    """
+    他のプロセスの manual.csv を取り込んだ際に、両方で変更されていた質問のリストを返す関数（プロセスで共有し、Admin ページに表示する）
+    """
+    return []
+
+manual_pull_conflicts = get_manual_pull_conflicts()
+
+@st.cache_resource
+def get_drive_pull_worker():
+    """
+    他のプロセスが Google Drive に書き出した manual.csv・feedback.csv の変更を定期的に取り込むワーカーを
+    起動して返す関数（プロセスごとに1つ。DRIVE_PULL_INTERVAL_SECONDS が 0 の場合は None）
+    """
+    if config.DRIVE_PULL_INTERVAL_SECONDS <= 0:
+        return None
+
+    def apply_remote_manual(path):
+        # 前回同期した内容からの差分として取り込み、このプロセスでまだアップロードしていない変更は残す
+        # （manual.csv は公開と同じロック内で書き出す。各セッションは次の再実行で反映される）
+        merge = manual_store.merge_remote(read_manual_csv(path), on_publish=write_manual_csv)
+        manual_index.sync(merge.snapshot.data)
+        answer_cache.invalidate(manual_index.version())
+        if faq_warmer is not None:
+            faq_warmer.schedule()
+        if merge.conflicts:
+            metrics.increment('manual_pull_conflicts_total', len(merge.conflicts))
+            manual_pull_conflicts.extend(q for q in merge.conflicts if q not in manual_pull_conflicts)
+        if merge.local_changes:
+            # 取り込んだ結果に Google Drive にない変更が残っている場合は送り返す
+            prepare, on_uploaded = manual_sync_callbacks()
+            drive_sync.schedule('manual.csv', prepare=prepare, on_uploaded=on_uploaded)
+
+    def apply_remote_feedback(path):
+        # イベントは ID で重複を除いて取り込み、このプロセスにしかない質問・評価があれば書き出して送り返す
+        imported, local_only = feedback_store.merge_csv(path)
+        metrics.increment('feedback_merged_total', imported)
+        if local_only:
+            drive_sync.schedule('feedback.csv', prepare=lambda: feedback_store.export_csv('feedback.csv'))
+
+    worker = DrivePullWorker(
+        authenticate_google_drive, interval_seconds=config.DRIVE_PULL_INTERVAL_SECONDS, sync_worker=drive_sync,
+    )
+    worker.register('manual.csv', apply_remote_manual)
+    worker.register('feedback.csv', apply_remote_feedback)
+    return worker.start()
+
+drive_pull = get_drive_pull_worker()
+
+if drive_pull is not None and drive_pull.last_error:
+    st.error(drive_pull.last_error)
+
+# -------------------------------
+# Manual Gaps
+# -------------------------------
+@st.cache_data
+def load_gap_clusters(path, modified_at):
+    """
+    gap_mining.py の結果を読み込む関数（ファイルの更新時刻ごとに1回のみ読み込む）
+    """
+    return gap_mining.load_result(path)
+
+def draft_from_gap(gap):
+    """
+    Manual Gaps のクラスターの代表の質問を Add New Q&A のフォームに入力する関数
+    """
+    st.session_state['new_question'] = gap['question']
+    st.session_state['new_answer'] = ""
+    st.session_state['add_form_expanded'] = True
 
-feedback_data = load_feedback_data()
+# -------------------------------
+# User Identification
+# -------------------------------
+def get_user_id():
+    """
+    ブラウザごとのユーザーIDを返す関数（URL の uid パラメーターに保存し、再読み込み後も同じ履歴を表示する）
+    """
+    if 'user_id' not in st.session_state:
+        user_id = st.query_params.get('uid')
+        if not user_id:
+            user_id = uuid.uuid4().hex
+            st.query_params['uid'] = user_id
+        st.session_state['user_id'] = user_id
+    return st.session_state['user_id']
+
+user_id = get_user_id()
+
+# -------------------------------
+# Direct Match A/B Test
+# -------------------------------
+def direct_match_variant(user_id):
+    """
+    A/B 比較で利用者に割り当てる方式（'direct' または 'llm'）を返す関数（同じ利用者には常に同じ方式を割り当てる）
+    """
+    bucket = int.from_bytes(hashlib.sha1(f"direct-match:{user_id}".encode('utf-8')).digest()[:4], 'big') % 100
+    return 'direct' if bucket < config.DIRECT_MATCH_AB_PERCENT else 'llm'
+
+# -------------------------------
+# Conversations
+# -------------------------------
+@st.cache_resource
+def get_conversation_store():
+    """
+    会話のストアを開いて返す関数（プロセスごとに1回のみ実行）
+    """
+    return ConversationStore(config.CONVERSATION_DB_PATH)
+
+conversation_store = get_conversation_store()
+
+@st.cache_resource
+def get_conversation_executor():
+    """
+    会話の要約とアーカイブをバックグラウンドで実行するスレッドプールを返す関数（プロセスごとに1つ）
+    """
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix='conversation')
+
+def maintain_conversation(thread_id):
+    """
+    直近のターンより前で要約されていないターンをこれまでの要約と合わせて要約し直し、
+    長期間使われていない会話をアーカイブに移す関数（バックグラウンドで実行する）
+    """
+    pending = conversation_store.pending_summary(thread_id, keep_turns=config.CONVERSATION_MAX_TURNS)
+    if config.CONVERSATION_SUMMARY_ENABLED and pending is not None:
+        summary, turns = pending
+        try:
+            with metrics.span('conversation_summary'):
+                summary = llm.complete(prompt_builder.summary_messages(summary, turns))
+            conversation_store.set_summary(thread_id, summary, turns[-1]['turn'])
+            metrics.increment('conversation_summaries_total', outcome='success')
+        except llm.LLMError:
+            # 要約できなかったターンは次の質問の後に再度要約する
+            metrics.increment('conversation_summaries_total', outcome='error')
+    conversation_store.archive_idle(config.CONVERSATION_ARCHIVE_DAYS * 24 * 3600, interval=3600)
+
+def get_thread_id():
+    """
+    現在の会話の ID を返す関数（初回はユーザーが最後に使用した会話を引き継ぐ。会話がない場合は None）
+    """
+    if 'thread_id' not in st.session_state:
+        st.session_state['thread_id'] = conversation_store.latest_thread(user_id)
+    return st.session_state['thread_id']
+
+def start_new_conversation():
+    st.session_state['thread_id'] = None
+    st.session_state['conversation_select'] = None
 
-# feedback_data をセッションステートに保存
-if 'feedback_data' not in st.session_state:
-    st.session_state['feedback_data'] = feedback_data
-else:
-    feedback_data = st.session_state['feedback_data']
+def switch_conversation():
+    st.session_state['thread_id'] = st.session_state['conversation_select']
+
+# -------------------------------
+# Pagination & Filters
+# -------------------------------
+def history_filters(key_prefix):
+    """
+    履歴の絞り込み条件（期間・フィードバック・テキスト検索）の入力欄を表示し、query_history の引数を返す関数
+    """
+    with st.expander("🔍 Filter"):
+        dates = st.date_input("Date range", value=(), key=f"{key_prefix}_dates")
+        feedback = st.selectbox("Feedback", ["All", "Yes", "No", NOT_RATED], key=f"{key_prefix}_feedback")
+        text = st.text_input("Search text", key=f"{key_prefix}_text")
+    filters = {'feedback': None if feedback == "All" else feedback, 'text': text.strip() or None}
+    if dates:
+        filters['since'] = datetime.combine(dates[0], dt_time.min, tzinfo=timezone.utc).timestamp()
+        end = dates[1] if len(dates) > 1 else dates[0]
+        filters['until'] = datetime.combine(end + timedelta(days=1), dt_time.min, tzinfo=timezone.utc).timestamp()
+    return filters
+
+def fetch_page(key, page_size, fetch):
+    """
+    ページ番号の入力欄（key）で選択されたページを fetch(offset) で取得し、(データ, 件数, 先頭位置) を返す関数。
+    絞り込みで件数が減り、選択中のページが範囲外になった場合は最後のページを取得する。
+    """
+    offset = (int(st.session_state.get(key, 1)) - 1) * page_size
+    data, total = fetch(offset)
+    if offset and offset >= total:
+        st.session_state[key] = max(1, math.ceil(total / page_size))
+        offset = (st.session_state[key] - 1) * page_size
+        data, total = fetch(offset)
+    return data, total, offset
+
+def paginate(total, key, page_size):
+    """
+    ページ番号の入力欄と現在のページ位置を表示する関数
+    """
+    num_pages = max(1, math.ceil(total / page_size))
+    page_number = st.number_input("Page", min_value=1, max_value=num_pages, value=1, step=1, key=key)
+    st.caption(f"Page {page_number} of {num_pages} ({total} entries)")
+
+def search_manual(data, text):
+    """
+    質問または回答に text を含むマニュアルの行を返す関数（text が空の場合は全ての行）
+    """
+    if not text:
+        return data
+    matches = (
+        data['question'].fillna('').str.contains(text, case=False, regex=False)
+        | data['answer'].fillna('').str.contains(text, case=False, regex=False)
+    )
+    return data[matches]
+
+def has_grid_edits(edits):
+    """
+    st.data_editor の編集状態に未保存の編集・削除・追加があるかを返す関数
+    """
+    return any(edits.get(kind) for kind in ('edited_rows', 'added_rows', 'deleted_rows'))
+
+def reset_grid():
+    """
+    表の編集状態と編集元のスナップショットを破棄する関数（次の再実行で最新のスナップショットから編集する）
+    """
+    st.session_state.pop('manual_grid', None)
+    st.session_state.pop('manual_grid_base', None)
+
+def apply_grid_edits(grid_data, edits):
+    """
+    st.data_editor の編集状態（編集・削除・追加した行）を元の表に適用したデータフレームを返す関数。
+    Streamlit 1.40 の data_editor の戻り値は、途中の行の削除と行の追加を同時に行うと追加した行が失われるため代わりに使う。
+    """
+    edited = grid_data.copy()
+    for position, values in (edits.get('edited_rows') or {}).items():
+        for column, value in values.items():
+            edited.iat[int(position), edited.columns.get_loc(column)] = value
+    edited = edited.drop(edited.index[list(edits.get('deleted_rows') or [])])
+    added = pd.DataFrame(edits.get('added_rows') or [], columns=edited.columns)
+    if added.empty:
+        return edited
+    return pd.concat([edited.astype(object), added.astype(object)], ignore_index=True)
 
 # -------------------------------
 # Page Selection
@@ -288,79 +698,201 @@ if page == "User":
     st.markdown("## 📝 Frequently Asked Questions")
     faq_questions = manual_data[manual_data['priority'] == 1]['question'].dropna().tolist()
 
+    faq_clicked = False
     if faq_questions:
-        # 質問ボタンを表示
+        # 質問ボタンを表示（クリックするとその質問をすぐに送信する）
         num_columns = 3  # 列数を調整
         cols = st.columns(num_columns)
         for idx, question in enumerate(faq_questions):
             with cols[idx % num_columns]:
                 if st.button(question, key=f"faq_{idx}"):
                     st.session_state['selected_question'] = question
+                    faq_clicked = True
     else:
         st.info("No high priority (priority=1) questions found.")
 
+    # 会話（フォローアップの質問は直近のやり取りを踏まえて回答する）
+    st.markdown("## 🧵 Conversation")
+    threads = conversation_store.list_threads(user_id)
+    thread_id = get_thread_id()
+    current_thread = next((t for t in threads if t['thread_id'] == thread_id), None)
+    if current_thread is not None:
+        st.caption(
+            f"Follow-up questions use this conversation as context ({current_thread['turn_count']} turn(s)). "
+            "Start a new conversation to ask about something else."
+        )
+        with st.expander(f"Current conversation: {current_thread['title']}"):
+            for turn in conversation_store.turns(thread_id, after=max(0, current_thread['turn_count'] - 10)):
+                st.markdown(f"<div class='question'><strong>Q{turn['turn']}:</strong> {turn['question']}</div>", unsafe_allow_html=True)
+                st.markdown(f"<div class='answer'><strong>A{turn['turn']}:</strong> {turn['answer']}</div>", unsafe_allow_html=True)
+    else:
+        st.caption("Your next question starts a new conversation.")
+    conversation_cols = st.columns([3, 1])
+    with conversation_cols[0]:
+        if threads:
+            thread_labels = {
+                t['thread_id']: f"{datetime.fromtimestamp(t['updated_at']).strftime('%Y-%m-%d %H:%M')} {t['title']} ({t['turn_count']})"
+                for t in threads
+            }
+            st.selectbox(
+                "Continue a previous conversation",
+                [None] + list(thread_labels),
+                format_func=lambda t: thread_labels.get(t, "—"),
+                key="conversation_select",
+                on_change=switch_conversation,
+            )
+    with conversation_cols[1]:
+        st.button("New conversation", on_click=start_new_conversation, disabled=current_thread is None)
+
     # 質問入力欄
     if 'selected_question' in st.session_state:
         question = st.text_input("Enter your question:", value=st.session_state['selected_question'], key="selected_question_input")
     else:
         question = st.text_input("Enter your question:")
 
-    if st.button("Submit"):
+    submitted = st.button("Submit")
+    if faq_clicked:
+        question = st.session_state['selected_question']
+    if submitted or faq_clicked:
         if question:
-            # マニュアルの内容をテキストに結合
-            manual_text = "\n".join(manual_data['question'].fillna('') + "\n" + manual_data['answer'].fillna(''))
+            with metrics.span('submit'):
+                submit_started = time.perf_counter()
+                ai_response = None
+                answer_displayed = False
+                # 回答の元になったマニュアル行（集計用。キャッシュの回答の場合は不明）
+                answer_entry = None
+                manual_version = manual_index.version()
 
-            # 質問とマニュアルをOpenAIに送り、回答を取得
-            try:
-                response = openai.ChatCompletion.create(
-                    model="gpt-4o",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": (
-                                "You are an assistant who answers the user's questions based solely on the provided manual."
-                                " Please answer in the same language as the user's question."
-                                " Do not provide information not included in the manual, but use the knowledge from the manual to answer flexibly."
-                            )
-                        },
-                        {"role": "user", "content": f"Manual:\n{manual_text}\n\nUser's question:\n{question}"}
-                    ]
-                )
-                ai_response = response['choices'][0]['message']['content']
-                st.success("The answer has been generated. Please see below.")
-
-                # 質問と回答を表示
-                st.markdown(f"<div class='question'><strong>Question:</strong> {question}</div>", unsafe_allow_html=True)
-                st.markdown(f"<div class='answer'><strong>Answer:</strong> {ai_response}</div>", unsafe_allow_html=True)
-
-                # 質問と回答を履歴に追加
-                new_feedback = pd.DataFrame([{
-                    'question': question,
-                    'answer': ai_response,
-                    'feedback': pd.NA  # 初期値は未評価
-                }])
-                st.session_state['feedback_data'] = pd.concat([st.session_state['feedback_data'], new_feedback], ignore_index=True)
-
-                # 質問と回答を 'feedback.csv' に保存
-                def save_feedback():
-                    st.session_state['feedback_data'].to_csv('feedback.csv', index=False, encoding='utf-8')
-                    # Google Drive にアップロード
-                    upload_file_to_drive(drive_service, 'feedback.csv', folder_id)
-
-                save_feedback()
-
-            except openai.error.OpenAIError as e:
-                st.error(f"An error occurred while contacting OpenAI: {e}")
+                # 前のターンを前提にした質問の場合のみ、現在の会話の要約と直近のターンをトークン数の上限内で読み込む
+                # （それ以外の質問は履歴なしで回答し、回答キャッシュを使用する）
+                follow_up = thread_id is not None and depends_on_context(question)
+                with metrics.span('conversation_context'):
+                    history = conversation_store.context(
+                        thread_id, config.CONVERSATION_MAX_TURNS, config.CONVERSATION_TOKEN_BUDGET
+                    ) if follow_up else (None, [])
+                follow_up = bool(history[0] or history[1])
+
+                # マニュアルの質問と表記の揺れのみが異なる場合は、マニュアルの回答をそのまま使用する
+                # （A/B 比較では一致した質問のうち 'direct' を割り当てた利用者にのみ使い、割り当てを記録する）
+                direct_answer = None
+                variant = None
+                if config.DIRECT_MATCH_MODE in ('on', 'ab'):
+                    with metrics.span('direct_match'):
+                        direct_answer = manual_index.direct_match(question)
+                    metrics.increment('direct_match_lookups_total', result='hit' if direct_answer else 'miss')
+                    if direct_answer is not None and config.DIRECT_MATCH_MODE == 'ab':
+                        variant = direct_match_variant(user_id)
+                        if variant != 'direct':
+                            direct_answer = None
+
+                # FAQ の回答が事前に生成されていれば OpenAI を呼び出さずに使用する
+                # （事前生成の回答は会話の履歴を含まないため、フォローアップの質問には使わない）
+                if direct_answer is not None or follow_up:
+                    faq_answer = None
+                else:
+                    with metrics.span('faq_lookup'):
+                        faq_answer = faq_answer_store.get(question)
+                    metrics.increment('faq_answer_lookups_total', result='hit' if faq_answer else 'miss')
+
+                # キャッシュに回答があればOpenAIを呼び出さずに使用する（フォローアップの質問は会話によって回答が変わるため使わない）
+                if direct_answer is not None or faq_answer is not None or follow_up:
+                    cached = None
+                else:
+                    with metrics.span('cache_lookup'):
+                        cached = answer_cache.get(question, manual_version)
+                    metrics.increment('answer_cache_lookups_total', result=cached[1] if cached else 'miss')
+                if direct_answer is not None:
+                    ai_response, answer_entry = direct_answer
+                    answer_source = 'direct'
+                    st.success("This question matches an entry in the manual. Please see the answer below.")
+                elif faq_answer is not None:
+                    ai_response, answer_entry = faq_answer
+                    answer_source = 'faq'
+                    st.success("This is a frequently asked question. Please see the answer below.")
+                elif cached is not None:
+                    ai_response, answer_source = cached
+                    st.success("The answer was found in the cache. Please see below.")
+                else:
+                    # 質問に関連するマニュアル行のみをトークン数の予算内で選択する
+                    # （フォローアップの質問は直前の質問と合わせて検索する）
+                    retrieval_query = f"{history[1][-1]['question']}\n{question}" if history[1] else question
+                    with metrics.span('retrieval'):
+                        try:
+                            relevant_rows = prompt_builder.retrieve(retrieval_query)
+                        except Exception as e:
+                            st.warning(f"Embedding retrieval failed, falling back to keyword search: {e}")
+                            relevant_rows = prompt_builder.retrieve(retrieval_query, use_embeddings=False)
+                    answer_entry = relevant_rows.attrs.get('top_match')
+
+                    # 質問とマニュアルをOpenAIに送り、回答を取得
+                    try:
+                        with metrics.span('prompt_build'):
+                            messages = prompt_builder.build(question, relevant_rows, history=history)
+                        with metrics.span('openai'):
+                            if config.STREAMING_ENABLED:
+                                # 生成されたトークンを受信しながら表示する
+                                st.markdown(f"<div class='question'><strong>Question:</strong> {question}</div>", unsafe_allow_html=True)
+                                answer_placeholder = st.empty()
+                                ai_response = ""
+                                for token in llm.stream_completion(messages):
+                                    ai_response += token
+                                    answer_placeholder.markdown(f"<div class='answer'><strong>Answer:</strong> {ai_response}▌</div>", unsafe_allow_html=True)
+                                answer_placeholder.markdown(f"<div class='answer'><strong>Answer:</strong> {ai_response}</div>", unsafe_allow_html=True)
+                                answer_displayed = True
+                            else:
+                                ai_response = llm.complete(messages)
+                        answer_source = 'llm'
+                        if not follow_up:
+                            answer_cache.put(question, manual_version, ai_response)
+                        st.success("The answer has been generated. Please see below.")
+                    except PromptTooLongError as e:
+                        ai_response = None
+                        st.error(str(e))
+                    except llm.LLMError as e:
+                        ai_response = None
+                        st.error(f"An error occurred while contacting OpenAI: {e}")
+
+                if ai_response is not None:
+                    # 質問と回答を表示（ストリーミング時は表示済み）
+                    if not answer_displayed:
+                        st.markdown(f"<div class='question'><strong>Question:</strong> {question}</div>", unsafe_allow_html=True)
+                        st.markdown(f"<div class='answer'><strong>Answer:</strong> {ai_response}</div>", unsafe_allow_html=True)
+
+                    # 質問と回答をイベントとして追記（回答の取得元も記録する）
+                    with metrics.span('record_question'):
+                        qa_id = feedback_store.record_question(
+                            question, ai_response, answer_source, user_id=user_id,
+                            entry=answer_entry, latency=time.perf_counter() - submit_started, variant=variant,
+                        )
+                    sync_feedback_to_drive()
+
+                    # 会話にターンを追加し、古いターンの要約をバックグラウンドで更新する
+                    with metrics.span('record_turn'):
+                        if thread_id is None:
+                            thread_id = st.session_state['thread_id'] = conversation_store.create_thread(user_id)
+                        conversation_store.add_turn(thread_id, question, ai_response, qa_id=qa_id)
+                    get_conversation_executor().submit(maintain_conversation, thread_id)
         else:
             st.warning("Please enter a question.")
 
     # 質問履歴の表示
     st.markdown("## 🕘 Question History")
-    if not st.session_state['feedback_data'].empty:
-        for idx, qa in enumerate(reversed(st.session_state['feedback_data'].to_dict('records'))):
-            actual_idx = len(st.session_state['feedback_data']) - idx - 1
-            st.markdown(f"<div class='question'><strong>Question {actual_idx+1}:</strong> {qa['question']}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='answer'><strong>Answer {actual_idx+1}:</strong> {qa['answer']}</div>", unsafe_allow_html=True)
+    # 自分の履歴のみを、絞り込み条件に一致する1ページ分だけ取得する
+    filters = history_filters("history")
+    page_size = config.HISTORY_PAGE_SIZE
+    feedback_data, total, offset = fetch_page(
+        "history_page",
+        page_size,
+        lambda offset: feedback_store.query_history(user_id=user_id, limit=page_size, offset=offset, **filters),
+    )
+    if total:
+        for idx, qa in enumerate(feedback_data.to_dict('records')):
+            number = total - offset - idx
+            qa_id = qa['qa_id']
+            st.markdown(f"<div class='question'><strong>Question {number}:</strong> {qa['question']}</div>", unsafe_allow_html=True)
+            source = str(qa.get('source', ''))
+            cached_tag = " (cached)" if source.startswith('cache') else " (from the manual)" if source == 'direct' else ""
+            st.markdown(f"<div class='answer'><strong>Answer {number}{cached_tag}:</strong> {qa['answer']}</div>", unsafe_allow_html=True)
 
             if pd.isna(qa['feedback']):
                 # フィードバックセクションを回答の直下に配置
@@ -368,23 +900,19 @@ if page == "User":
                 feedback = st.radio(
                     "Was this answer helpful?",
                     ["Yes", "No"],
-                    key=f"feedback_{actual_idx}",
+                    key=f"feedback_{qa_id}",
                     index=0
                 )
-                if st.button("Submit Feedback", key=f"submit_feedback_{actual_idx}"):
-                    st.session_state['feedback_data'].at[actual_idx, 'feedback'] = feedback
+                if st.button("Submit Feedback", key=f"submit_feedback_{qa_id}"):
+                    # フィードバックをイベントとして追記
+                    with metrics.span('record_feedback'):
+                        feedback_store.record_feedback(qa_id, feedback)
                     st.success("Thank you for your feedback!")
-
-                    # 'feedback.csv' のフィードバックを更新
-                    def update_feedback():
-                        st.session_state['feedback_data'].to_csv('feedback.csv', index=False, encoding='utf-8')
-                        # Google Drive にアップロード
-                        upload_file_to_drive(drive_service, 'feedback.csv', folder_id)
-
-                    update_feedback()
+                    sync_feedback_to_drive()
                 st.markdown("</div>", unsafe_allow_html=True)
             else:
-                st.markdown(f"**Feedback {actual_idx+1}:** {qa['feedback']}")
+                st.markdown(f"**Feedback {number}:** {qa['feedback']}")
+        paginate(total, "history_page", page_size)
     else:
         st.info("No questions have been asked yet.")
 
@@ -400,6 +928,15 @@ elif page == "Admin":
         st.error("ADMIN_PASSWORD 環境変数が設定されていません。")
     elif admin_password == stored_admin_password:
         st.success("Accessed the admin page.")
+        if manual_pull_conflicts:
+            st.warning(
+                "These questions were changed both here and on another instance at the same time, "
+                "so both versions were kept. Please review them: " + ", ".join(manual_pull_conflicts[:20])
+                + (f" and {len(manual_pull_conflicts) - 20} more" if len(manual_pull_conflicts) > 20 else "")
+            )
+            if st.button("Dismiss", key="dismiss_manual_pull_conflicts"):
+                manual_pull_conflicts.clear()
+                st.rerun()
 
         # ---------------------------
         # Manage Manual.csv
@@ -407,9 +944,10 @@ elif page == "Admin":
         st.markdown("## ➕ Manage Manual")
 
         # 新しいQ&Aを追加するフォーム
-        with st.expander("Add New Q&A"):
-            new_question = st.text_input("Enter a new question")
-            new_answer = st.text_area("Enter a new answer")
+        # （Manual Gaps の「Draft a new Q&A」で質問が入力された場合は開いた状態で表示する）
+        with st.expander("Add New Q&A", expanded=st.session_state.get('add_form_expanded', False)):
+            new_question = st.text_input("Enter a new question", key="new_question")
+            new_answer = st.text_area("Enter a new answer", key="new_answer")
             set_priority = st.checkbox("Set priority")
             if set_priority:
                 new_priority = st.number_input("Enter priority (1 for high priority)", min_value=1, step=1, value=2, key="new_priority")
@@ -423,109 +961,239 @@ elif page == "Admin":
                         'answer': [new_answer],
                         'priority': [new_priority]
                     })
-                    st.session_state['manual_data'] = pd.concat([st.session_state['manual_data'], new_row], ignore_index=True)
-                    st.session_state['manual_data'].to_csv('manual.csv', index=False, encoding='utf-8')
-                    st.success("New Q&A has been added.")
-                    # Google Drive にアップロード
-                    upload_file_to_drive(drive_service, 'manual.csv', folder_id)
+                    if save_manual_data(append_rows(manual_data, new_row), added=new_row):
+                        st.success("New Q&A has been added.")
                 else:
                     st.warning("Please enter both a question and an answer.")
 
+        # CSV / XLSX / JSONL からの一括取り込みと書き出し
+        with st.expander("Bulk Import / Export"):
+            st.markdown(
+                "Upload a file with `question`, `answer` and optional `priority` columns. "
+                "Rows whose question matches an existing entry (ignoring case, spaces and punctuation) update it; "
+                "other rows are added."
+            )
+            uploaded_file = st.file_uploader("Manual file", type=list(SUPPORTED_FORMATS) + ['json'], key="bulk_import_file")
+            if st.button("Import", disabled=uploaded_file is None):
+                progress_bar = st.progress(0.0, text="Reading the file...")
+                try:
+                    with metrics.span('bulk_import'):
+                        result = import_manual(
+                            manual_data,
+                            uploaded_file,
+                            detect_format(uploaded_file.name),
+                            progress=lambda fraction, rows: progress_bar.progress(fraction, text=f"Read {rows} rows..."),
+                        )
+                except ImportFormatError as e:
+                    result = None
+                    progress_bar.empty()
+                    st.error(str(e))
+                if result is not None:
+                    progress_bar.progress(1.0, text="Saving...")
+                    if result.inserted or result.updated:
+                        # 変更を1回の公開・書き出し・インデックス更新・Drive 同期で反映する
+                        saved = save_manual_data(result.data, added=result.added, removed=result.removed)
+                    else:
+                        saved = True
+                    progress_bar.empty()
+                    if saved:
+                        st.success(
+                            f"Imported: {result.inserted} added, {result.updated} updated, {result.unchanged} unchanged, "
+                            f"{result.duplicates} duplicate(s) in the file, {result.error_count} error(s)."
+                        )
+                    if result.errors:
+                        st.warning(f"{result.error_count} row(s) were skipped.")
+                        st.dataframe(pd.DataFrame(result.errors, columns=['row', 'error']))
+
+            export_format = st.selectbox("Export format", SUPPORTED_FORMATS, key="bulk_export_format")
+            if st.button("Prepare export"):
+                try:
+                    st.session_state['manual_export'] = (export_format, export_manual(manual_store.snapshot().data, export_format))
+                except ImportFormatError as e:
+                    st.error(str(e))
+            if 'manual_export' in st.session_state:
+                exported_format, exported = st.session_state['manual_export']
+                st.download_button(f"Download manual.{exported_format}", exported, file_name=f"manual.{exported_format}")
+
         # ---------------------------
         # Current Manual Data (DataFrame View) with Edit Buttons
         # ---------------------------
         st.markdown("### 📄 Current Manual Data (DataFrame View)")
 
-        manual_data = st.session_state['manual_data']
+        # 検索条件に一致する行のうち1ページ分のみを表示する
+        manual_search = st.text_input("Search manual", key="manual_search").strip()
+        manual_matches = search_manual(manual_data, manual_search)
 
-        if not manual_data.empty:
-            for idx, row in manual_data.iterrows():
-                # 各行に「Edit」ボタンを追加
-                cols = st.columns([8, 2])  # データとボタンの割合を調整
-                with cols[0]:
-                    st.markdown(f"**Question {idx + 1}:** {row['question']}")
-                    # スニペット表示
-                    if len(row['question']) > 100:
-                        display_question = row['question'][:100] + "..."
-                    else:
-                        display_question = row['question']
-                    if len(row['answer']) > 100:
-                        display_answer = row['answer'][:100] + "..."
-                    else:
-                        display_answer = row['answer']
-                    st.markdown(f"**Answer:** {display_answer}")
-                    priority_display = row['priority'] if not pd.isna(row['priority']) else "Not Set"
-                    st.markdown(f"**Priority:** {priority_display}")
-                with cols[1]:
-                    edit_button = st.button("Edit", key=f"edit_button_{idx}")
-
-                if edit_button:
-                    # 編集フォームを表示
-                    with st.expander(f"Editing Q&A {idx + 1}", expanded=True):
-                        # フルテキスト表示と編集フィールド
-                        edited_question = st.text_area("Question", value=row['question'], height=100, key=f"edit_question_{idx}")
-                        edited_answer = st.text_area("Answer", value=row['answer'], height=150, key=f"edit_answer_{idx}")
-                        set_edit_priority = st.checkbox("Set priority", key=f"set_edit_priority_checkbox_{idx}")
-                        if set_edit_priority:
-                            edited_priority = st.number_input(
-                                "Priority", 
-                                min_value=1, 
-                                step=1, 
-                                value=int(row['priority']) if not pd.isna(row['priority']) else 2, 
-                                key=f"edit_priority_{idx}"
-                            )
-                        else:
-                            edited_priority = pd.NA  # 未設定の場合はNaN
-
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            if st.button("Save Changes", key=f"save_changes_{idx}"):
-                                # データの更新
-                                manual_data.at[idx, 'question'] = edited_question
-                                manual_data.at[idx, 'answer'] = edited_answer
-                                manual_data.at[idx, 'priority'] = edited_priority
-                                # セッションステートとファイルに保存
-                                st.session_state['manual_data'] = manual_data
-                                manual_data.to_csv('manual.csv', index=False, encoding='utf-8')
-                                st.success(f"Q&A {idx + 1} has been updated.")
-                                # Google Drive にアップロード
-                                upload_file_to_drive(drive_service, 'manual.csv', folder_id)
-                        with col2:
-                            if st.button("Delete Q&A", key=f"delete_qna_{idx}"):
-                                manual_data = manual_data.drop(idx).reset_index(drop=True)
-                                st.session_state['manual_data'] = manual_data
-                                manual_data.to_csv('manual.csv', index=False, encoding='utf-8')
-                                st.success(f"Q&A {idx + 1} has been deleted.")
-                                # Google Drive にアップロード
-                                upload_file_to_drive(drive_service, 'manual.csv', folder_id)
+        # 一覧では1行ずつ、表では複数の行をまとめて編集する（行はインデックスの ID で識別する）
+        manual_view = st.radio("View", ["List", "Grid"], horizontal=True, key="manual_view")
+
+        if manual_view == "Grid":
+            # 未保存の編集がある間は編集を始めた時のスナップショットを表示し続け（data_editor はデータが変わると
+            # 編集内容を破棄するため）、保存時に現在のバージョンに適用し直す。編集がなければ最新のスナップショットを表示する
+            grid_base = st.session_state.get('manual_grid_base')
+            if grid_base is None or not has_grid_edits(st.session_state.get('manual_grid') or {}):
+                grid_base = manual_snapshot
+                st.session_state['manual_grid_base'] = grid_base
+            grid_matches = search_manual(grid_base.data, manual_search)
+            grid_page, grid_total, _ = fetch_page(
+                "manual_grid_page",
+                config.ADMIN_GRID_PAGE_SIZE,
+                lambda offset: (grid_matches.iloc[offset:offset + config.ADMIN_GRID_PAGE_SIZE], len(grid_matches)),
+            )
+            st.caption(
+                "Edit cells, add rows at the bottom or select rows and delete them, then save all changes at once. "
+                "The id column identifies each entry and does not change when other rows are deleted."
+            )
+            if grid_base.version != manual_snapshot.version:
+                st.info(
+                    "The manual was changed by another session while you were editing. "
+                    "Your changes will be applied on top of the latest version when you save."
+                )
+            grid_data = grid_page[['question', 'answer', 'priority']].reset_index(names='id')
+            st.data_editor(
+                grid_data,
+                key='manual_grid',
+                num_rows="dynamic",
+                hide_index=True,
+                use_container_width=True,
+                disabled=["id"],
+                column_config={
+                    'id': st.column_config.NumberColumn("id", width="small"),
+                    'question': st.column_config.TextColumn("Question", width="medium"),
+                    'answer': st.column_config.TextColumn("Answer", width="large"),
+                    'priority': st.column_config.NumberColumn("Priority", min_value=1, step=1, width="small"),
+                },
+            )
+            edited_grid = apply_grid_edits(grid_data, st.session_state.get('manual_grid') or {})
+            changeset = build_changeset(grid_base.data, edited_grid, grid_page.index.tolist())
+            pending = changeset.inserted + changeset.updated + changeset.deleted
+            st.caption(
+                f"Pending changes: {changeset.updated} updated, {changeset.inserted} added, {changeset.deleted} deleted."
+            )
+            if changeset.errors:
+                st.warning(f"{len(changeset.errors)} row(s) need to be fixed before saving.")
+                st.dataframe(pd.DataFrame(changeset.errors, columns=['row', 'error']), hide_index=True)
+            save_col, discard_col = st.columns(2)
+            with save_col:
+                save_grid = st.button("Save all changes", disabled=not pending or bool(changeset.errors))
+            with discard_col:
+                if st.button("Discard changes", disabled=not pending):
+                    reset_grid()
+                    st.rerun()
+            if save_grid:
+                # 変更した行の数によらず、1回の公開・書き出し・インデックス更新・Drive 同期で反映する
+                if save_manual_data(changeset.data, added=changeset.added, removed=changeset.removed, base=grid_base):
+                    metrics.increment('manual_grid_saves_total')
+                    reset_grid()
+                    st.success(
+                        f"Saved: {changeset.updated} updated, {changeset.inserted} added, {changeset.deleted} deleted."
+                    )
+            paginate(grid_total, "manual_grid_page", config.ADMIN_GRID_PAGE_SIZE)
         else:
-            st.info("No Q&A entries found in manual.csv.")
+            manual_page, manual_total, _ = fetch_page(
+                "manual_page",
+                config.ADMIN_PAGE_SIZE,
+                lambda offset: (manual_matches.iloc[offset:offset + config.ADMIN_PAGE_SIZE], len(manual_matches)),
+            )
+
+            if not manual_page.empty:
+                for idx, row in manual_page.iterrows():
+                    # 各行に「Edit」ボタンを追加
+                    cols = st.columns([8, 2])  # データとボタンの割合を調整
+                    with cols[0]:
+                        st.markdown(f"**Question {idx + 1}:** {row['question']}")
+                        # スニペット表示
+                        if len(row['question']) > 100:
+                            display_question = row['question'][:100] + "..."
+                        else:
+                            display_question = row['question']
+                        if len(row['answer']) > 100:
+                            display_answer = row['answer'][:100] + "..."
+                        else:
+                            display_answer = row['answer']
+                        st.markdown(f"**Answer:** {display_answer}")
+                        priority_display = row['priority'] if not pd.isna(row['priority']) else "Not Set"
+                        st.markdown(f"**Priority:** {priority_display}")
+                    with cols[1]:
+                        # 編集中の行はセッションに保持し、「Save Changes」などを押した後の再実行でもフォームを表示する
+                        if st.button("Edit", key=f"edit_button_{idx}"):
+                            st.session_state['editing_manual_row'] = None if st.session_state.get('editing_manual_row') == idx else idx
+
+                    if st.session_state.get('editing_manual_row') == idx:
+                        # 編集フォームを表示
+                        with st.expander(f"Editing Q&A {idx + 1}", expanded=True):
+                            # フルテキスト表示と編集フィールド
+                            edited_question = st.text_area("Question", value=row['question'], height=100, key=f"edit_question_{idx}")
+                            edited_answer = st.text_area("Answer", value=row['answer'], height=150, key=f"edit_answer_{idx}")
+                            set_edit_priority = st.checkbox(
+                                "Set priority", value=not pd.isna(row['priority']), key=f"set_edit_priority_checkbox_{idx}"
+                            )
+                            if set_edit_priority:
+                                edited_priority = st.number_input(
+                                    "Priority", 
+                                    min_value=1, 
+                                    step=1, 
+                                    value=int(row['priority']) if not pd.isna(row['priority']) else 2, 
+                                    key=f"edit_priority_{idx}"
+                                )
+                            else:
+                                edited_priority = pd.NA  # 未設定の場合はNaN
+
+                            col1, col2 = st.columns(2)
+                            with col1:
+                                if st.button("Save Changes", key=f"save_changes_{idx}"):
+                                    # 共有スナップショットは変更せず、コピーを更新して保存
+                                    updated_data = manual_data.copy()
+                                    updated_data.at[idx, 'question'] = edited_question
+                                    updated_data.at[idx, 'answer'] = edited_answer
+                                    updated_data.at[idx, 'priority'] = edited_priority
+                                    if save_manual_data(updated_data, added=updated_data.loc[[idx]], removed=manual_data.loc[[idx]]):
+                                        st.session_state['editing_manual_row'] = None
+                                        st.success(f"Q&A {idx + 1} has been updated.")
+                            with col2:
+                                if st.button("Delete Q&A", key=f"delete_qna_{idx}"):
+                                    # 他の行の ID が変わらないよう、インデックスは振り直さない
+                                    if save_manual_data(manual_data.drop(idx), removed=manual_data.loc[[idx]]):
+                                        st.session_state['editing_manual_row'] = None
+                                        st.success(f"Q&A {idx + 1} has been deleted.")
+                paginate(manual_total, "manual_page", config.ADMIN_PAGE_SIZE)
+            else:
+                st.info("No Q&A entries found in manual.csv.")
 
         # ---------------------------
         # Manage Feedback.csv
         # ---------------------------
         st.markdown("## 🗑️ Manage Feedback")
 
-        feedback_data = st.session_state['feedback_data']
-        if not feedback_data.empty:
-            for idx, row in feedback_data.iterrows():
+        # 全ユーザーの履歴から、絞り込み条件に一致する1ページ分のみを取得する
+        feedback_filters = history_filters("admin_feedback")
+        feedback_data, feedback_total, feedback_offset = fetch_page(
+            "admin_feedback_page",
+            config.ADMIN_PAGE_SIZE,
+            lambda offset: feedback_store.query_history(limit=config.ADMIN_PAGE_SIZE, offset=offset, **feedback_filters),
+        )
+        # 絞り込みで0件になった場合と、まだ記録がない場合の表示を分けるため、絞り込み前の件数を集計テーブルから取得する
+        feedback_unfiltered_total = feedback_total or feedback_store.question_count()
+        if feedback_total:
+            for idx, row in enumerate(feedback_data.to_dict('records')):
+                number = feedback_total - feedback_offset - idx
                 # 各フィードバックエントリに「Delete」ボタンを追加
                 cols = st.columns([8, 2])  # データとボタンの割合を調整
                 with cols[0]:
-                    st.markdown(f"**Feedback {idx + 1}:**")
+                    st.markdown(f"**Feedback {number}:**")
                     st.markdown(f"**Question:** {row['question']}")
                     st.markdown(f"**Answer:** {row['answer']}")
                     st.markdown(f"**Feedback:** {row['feedback']}")
                 with cols[1]:
-                    delete_feedback_button = st.button("Delete", key=f"delete_feedback_button_{idx}")
+                    delete_feedback_button = st.button("Delete", key=f"delete_feedback_button_{row['qa_id']}")
 
                 if delete_feedback_button:
-                    feedback_data = feedback_data.drop(idx).reset_index(drop=True)
-                    st.session_state['feedback_data'] = feedback_data
-                    feedback_data.to_csv('feedback.csv', index=False, encoding='utf-8')
-                    st.success(f"Feedback {idx + 1} has been deleted.")
-                    # Google Drive にアップロード
-                    upload_file_to_drive(drive_service, 'feedback.csv', folder_id)
+                    feedback_store.record_delete(row['qa_id'])
+                    st.success(f"Feedback {number} has been deleted.")
+                    sync_feedback_to_drive()
+            paginate(feedback_total, "admin_feedback_page", config.ADMIN_PAGE_SIZE)
+        elif feedback_unfiltered_total:
+            st.info("No feedback matches the filter.")
         else:
             st.info("There is no feedback to display.")
 
@@ -533,8 +1201,9 @@ elif page == "Admin":
         # Display Current Manual Data (DataFrame View) with Edit Buttons
         # ---------------------------
         st.markdown("## 📄 Current Manual Data (DataFrame View)")
-        if not st.session_state['manual_data'].empty:
-            st.dataframe(st.session_state['manual_data'])
+        manual_data = manual_store.snapshot().data
+        if not manual_data.empty:
+            st.dataframe(manual_data)
         else:
             st.info("No data in manual.csv.")
 
@@ -542,15 +1211,99 @@ elif page == "Admin":
         # Display Current Feedback Data
         # ---------------------------
         st.markdown("## 📊 All Feedback")
-        if not st.session_state['feedback_data'].empty:
-            st.dataframe(st.session_state['feedback_data'])
-            positive_feedback = st.session_state['feedback_data'][st.session_state['feedback_data']['feedback'] == 'Yes'].shape[0]
-            negative_feedback = st.session_state['feedback_data'][st.session_state['feedback_data']['feedback'] == 'No'].shape[0]
+        if feedback_total:
+            # 上の絞り込み条件で表示中のページのみを表として表示する
+            st.dataframe(feedback_data)
+            # 件数はイベントごとに更新している集計テーブルから取得する
+            feedback_counts = feedback_store.feedback_counts()
+            positive_feedback = feedback_counts.get('Yes', 0)
+            negative_feedback = feedback_counts.get('No', 0)
             st.markdown(f"**Helpful:** {positive_feedback}")
             st.markdown(f"**Not Helpful:** {negative_feedback}")
+        elif feedback_unfiltered_total:
+            st.info("No feedback matches the filter.")
         else:
             st.warning("There is no feedback yet.")
 
+        # ---------------------------
+        # Feedback Analytics（集計テーブルのみを参照するため、履歴の件数によらず一定の時間で表示できる）
+        # ---------------------------
+        st.markdown("## 📈 Feedback Analytics")
+        analytics_days = st.selectbox("Period", [7, 30, 90, 365], index=1, format_func=lambda d: f"Last {d} days", key="analytics_days")
+        analytics_since = time.time() - analytics_days * 24 * 3600
+        daily = feedback_store.daily_stats(since=analytics_since)
+        if not daily.empty:
+            rated = daily['yes'].sum() + daily['no'].sum()
+            latency, latency_trend = feedback_store.latency_stats(since=analytics_since)
+            cols = st.columns(4)
+            cols[0].metric("Questions", int(daily['questions'].sum()))
+            cols[1].metric("Helpful ratio", f"{daily['yes'].sum() / rated:.0%}" if rated else "—")
+            cols[2].metric("Latency p50", f"{latency['p50']:.1f}s" if latency['p50'] is not None else "—")
+            cols[3].metric("Latency p95", f"{latency['p95']:.1f}s" if latency['p95'] is not None else "—")
+
+            st.markdown("**Questions and feedback per day (UTC)**")
+            st.line_chart(daily.set_index('day')[['questions', 'yes', 'no']])
+            st.markdown("**Helpful ratio per day**")
+            st.line_chart(daily.set_index('day')[['helpful_ratio']])
+            if not latency_trend.empty:
+                st.markdown("**Answer latency per day (seconds, upper bound of the bucket)**")
+                st.line_chart(latency_trend.set_index('day'))
+        else:
+            st.info("No questions in this period.")
+
+        st.markdown("**Manual entries with the lowest helpful ratio**")
+        entries = feedback_store.entry_stats()
+        if not entries.empty:
+            # 集計は行のハッシュで保持しているため、現在のマニュアルの質問を表示する（削除・変更された行は空欄）
+            entry_rows = manual_index.get_rows(entries['entry'].tolist())
+            entries = entries.merge(entry_rows[['row_hash', 'question']], how='left', left_on='entry', right_on='row_hash')
+            st.dataframe(entries[['question', 'asked', 'yes', 'no', 'helpful_ratio']])
+        else:
+            st.info("No feedback on answers generated from the manual yet.")
+
+        st.markdown("**Most-asked unanswered questions** (rated \"No\" or no matching manual entry)")
+        unanswered = feedback_store.unanswered_questions()
+        if not unanswered.empty:
+            st.dataframe(unanswered)
+        else:
+            st.info("No unanswered questions.")
+
+        # ---------------------------
+        # Manual Gaps（gap_mining.py の結果を読み込み、近い質問のまとまりごとに新しい Q&A の下書きを作る）
+        # ---------------------------
+        st.markdown("## 🧩 Manual Gaps")
+        st.caption(
+            "Similar questions rated \"No\" or without a matching manual entry, grouped offline by `gap_mining.py` "
+            "(run it from cron, or use the button below)."
+        )
+        if st.button("Recompute gap clusters"):
+            with st.spinner("Clustering unanswered questions..."):
+                with metrics.span('gap_mining'):
+                    gap_mining.run(feedback_store, config.GAP_MINING_PATH, limit=200)
+        gap_result = load_gap_clusters(
+            config.GAP_MINING_PATH,
+            os.path.getmtime(config.GAP_MINING_PATH) if os.path.exists(config.GAP_MINING_PATH) else None,
+        )
+        if gap_result and gap_result['clusters']:
+            generated_at = datetime.fromtimestamp(gap_result['generated_at'], tz=timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
+            st.caption(
+                f"{len(gap_result['clusters'])} cluster(s) from {gap_result['questions']} question(s), generated {generated_at}."
+            )
+            # 結果の作成後にマニュアルへ追加された質問は追加済みとして表示する
+            manual_questions = {normalize_question(q) for q in manual_data['question']}
+            gap_count = st.number_input("Clusters to show", min_value=1, max_value=len(gap_result['clusters']),
+                                        value=min(10, len(gap_result['clusters'])), key="gap_count")
+            for gap in gap_result['clusters'][:gap_count]:
+                added_tag = " ✅ added" if normalize_question(gap['question']) in manual_questions else ""
+                with st.expander(f"{gap['weight']} unanswered · {gap['size']} question(s): {gap['question']}{added_tag}"):
+                    st.markdown(
+                        f"Asked {gap['asked']} time(s) · rated \"No\" {gap['not_helpful']} · no match {gap['no_match']}"
+                    )
+                    st.markdown("\n".join(f"- {example}" for example in gap['examples']))
+                    st.button("Draft a new Q&A", key=f"draft_{gap['id']}", on_click=draft_from_gap, args=(gap,))
+        else:
+            st.info("No gap clusters yet. Run `python gap_mining.py` or click \"Recompute gap clusters\".")
+
         # ---------------------------
         # Download Files
         # ---------------------------
@@ -561,11 +1314,45 @@ elif page == "Admin":
                     st.download_button('Download manual.csv', f, file_name='manual.csv')
             except Exception as e:
                 st.error(f"Failed to read manual.csv for download: {e}")
-        if os.path.exists('feedback.csv'):
+        # feedback.csv は要求された時にのみイベントストアから生成する
+        if st.button("Prepare feedback.csv"):
             try:
-                with open('feedback.csv', 'rb') as f:
-                    st.download_button('Download feedback.csv', f, file_name='feedback.csv')
+                st.session_state['feedback_csv'] = feedback_store.to_csv_bytes()
             except Exception as e:
-                st.error(f"Failed to read feedback.csv for download: {e}")
+                st.error(f"Failed to export feedback.csv for download: {e}")
+        if 'feedback_csv' in st.session_state:
+            st.download_button('Download feedback.csv', st.session_state['feedback_csv'], file_name='feedback.csv')
+
+        # ---------------------------
+        # Performance Metrics（URL に ?debug=1 を付けた場合のみ表示）
+        # ---------------------------
+        if st.query_params.get('debug') == '1':
+            st.markdown("## ⏱️ Performance Metrics")
+            st.button("Refresh metrics")
+            histograms = metrics.REGISTRY.histograms()
+            if histograms:
+                def metric_label(summary):
+                    labels = ", ".join(f"{k}={v}" for k, v in summary['labels'].items())
+                    return f"{summary['name']} {{{labels}}}" if labels else summary['name']
+
+                st.dataframe(pd.DataFrame([
+                    {'metric': metric_label(h), 'count': h['count'], 'mean': h['mean'], 'p50': h['p50'], 'p95': h['p95'], 'p99': h['p99']}
+                    for h in histograms
+                ]))
+                selected = st.selectbox("Histogram", histograms, format_func=metric_label, key="metrics_histogram")
+                samples = metrics.REGISTRY.recent(selected['name'], **selected['labels'])
+                if samples:
+                    # 直近の値の分布（ミリ秒）を棒グラフで表示する
+                    counts, edges = np.histogram(np.array(samples) * 1000, bins=min(20, len(samples)))
+                    st.bar_chart(pd.DataFrame({'count': counts}, index=[f"{edge:.1f}" for edge in edges[1:]]))
+                    st.caption(f"Latest {len(samples)} samples, bucketed by upper bound in milliseconds.")
+            else:
+                st.info("No timings have been recorded yet.")
+            counters = metrics.REGISTRY.counters()
+            if counters:
+                st.dataframe(pd.DataFrame([
+                    {'counter': c['name'], 'labels': ", ".join(f"{k}={v}" for k, v in c['labels'].items()), 'value': c['value']}
+                    for c in counters
+                ]))
     else:
         st.error("Incorrect password.")
@@ -0,0 +1,321 @@
+"""
+質問のリストに対して User ページと同じシステムプロンプト・マニュアル行の選択で回答を生成し、
+JSONL に書き出すバッチ処理（manual.csv の変更による回答の変化を確認する回帰評価用）。
+
+    # feedback.db に記録された全ての質問に回答し、前回の結果との差分を表示する
+    python batch_answer.py run --output runs/new.jsonl --baseline runs/old.jsonl
+
+    # 質問ファイル（.txt / .csv / .jsonl）を使い、OpenAI の代わりに決定的なフェイクモデルで回答する
+    python batch_answer.py run --questions questions.txt --output runs/fake.jsonl --fake-model
+
+    # 2つの結果の差分のみを表示する
+    python batch_answer.py diff runs/old.jsonl runs/new.jsonl --report diff.jsonl
+
+回答は1件ごとに出力ファイルへ追記し、定期的に fsync する。同じ --output で再実行すると
+回答済みの質問を飛ばして続きから処理する（エラーになった質問は再度問い合わせる）。
+OpenAI への問い合わせはアプリと同じディスパッチャーを使うため、OPENAI_REQUESTS_PER_MINUTE・
+OPENAI_TOKENS_PER_MINUTE・OPENAI_MAX_CONCURRENCY の上限に従う（大量に処理する場合は TPM を確認すること）。
+"""
+import argparse
+import difflib
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+import config
+import llm
+import retrieval
+from feedback_store import FeedbackStore
+from manual_index import ManualIndex
+from manual_store import read_manual_csv
+from prompt_builder import PromptBuilder, PromptTooLongError
+
+DEFAULT_MANUAL_PATH = 'manual.csv'
+FAKE_MODEL = 'fake'
+
+
+# -------------------------------
+# Questions
+# -------------------------------
+def question_id(question):
+    """
+    質問テキストから再開・差分の照合に使う ID を作る関数
+    """
+    return hashlib.sha1(question.encode('utf-8')).hexdigest()[:16]
+
+
+def load_questions(path=None):
+    """
+    質問のリストを重複を除いて読み込む関数。
+    path を省略した場合は feedback.db に記録された質問（最新のフィードバック付き）を古い順に返す。
+    .csv は question 列（feedback.csv の形式）、.jsonl は question キー、それ以外は1行1問として読み込む。
+    戻り値は (質問, フィードバック) のリスト。
+    """
+    if path is None:
+        history = FeedbackStore(config.FEEDBACK_DB_PATH).history()
+        pairs = zip(history['question'], history['feedback'])
+    elif path.lower().endswith('.csv'):
+        data = pd.read_csv(path, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+        feedback = data['feedback'] if 'feedback' in data.columns else [None] * len(data)
+        pairs = zip(data['question'], feedback)
+    elif path.lower().endswith(('.jsonl', '.json')):
+        with open(path, encoding='utf-8-sig') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        pairs = ((r.get('question'), r.get('feedback')) for r in records)
+    else:
+        with open(path, encoding='utf-8-sig') as f:
+            pairs = [(line, None) for line in f]
+
+    questions = {}
+    for question, feedback in pairs:
+        question = str(question).strip() if isinstance(question, str) else ''
+        if not question:
+            continue
+        # 同じ質問が複数回ある場合は最新のフィードバックを残す
+        feedback = feedback if isinstance(feedback, str) and feedback else questions.get(question)
+        questions[question] = feedback
+    return list(questions.items())
+
+
+# -------------------------------
+# Manual and Model
+# -------------------------------
+def open_index(manual_path, index_path):
+    """
+    検索インデックスを開き、指定したマニュアルとの差分を反映して返す関数。
+    稼働中のアプリのインデックス（MANUAL_INDEX_PATH）を書き換えないよう、既定ではマニュアルと同じ場所の
+    <名前>_batch_index.db を使う（次回の実行では差分のみを反映する）。
+    """
+    if index_path is None:
+        index_path = os.path.splitext(manual_path)[0] + '_batch_index.db'
+    try:
+        embedding_backend = retrieval.get_embedding_backend(
+            config.RETRIEVAL_EMBEDDING_BACKEND, config.RETRIEVAL_EMBEDDING_MODEL,
+            cache_size=config.RETRIEVAL_EMBEDDING_CACHE_SIZE,
+        )
+    except ValueError as e:
+        print(f"Embedding backend is disabled: {e}", file=sys.stderr)
+        embedding_backend = None
+    index = ManualIndex(
+        index_path, embedding_backend=embedding_backend, embedding_batch_size=config.RETRIEVAL_EMBEDDING_BATCH_SIZE
+    )
+    index.sync(read_manual_csv(manual_path))
+    return index
+
+
+def fake_complete(messages):
+    """
+    メッセージから決定的な回答を返すフェイクモデル（OpenAI に接続しない検証用）。
+    プロンプトの要約値を含めるため、マニュアル行の選択が変わると回答も変わる。
+    """
+    question = messages[-1]['content'].rsplit("\n", 1)[-1]
+    digest = hashlib.sha1(json.dumps(messages, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+    return f"This is a fake answer to: {question} [prompt {digest}]"
+
+
+# -------------------------------
+# Batch Run
+# -------------------------------
+def read_results(path):
+    """
+    出力ファイルの記録を質問 ID ごとに返す関数（同じ ID は後の記録を優先し、途中で切れた最終行は無視する）
+    """
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            results[record['id']] = record
+    return results
+
+
+def answer_question(prompt_builder, complete, model, question, feedback):
+    """
+    1件の質問に User ページと同じ手順で回答し、出力ファイルに書き出す記録を返す関数
+    """
+    record = {
+        'id': question_id(question), 'question': question, 'feedback': feedback, 'model': model,
+        'manual_version': prompt_builder.index.version(), 'answer': None, 'error': None,
+    }
+    start = time.perf_counter()
+    try:
+        try:
+            rows = prompt_builder.retrieve(question)
+        except Exception:
+            rows = prompt_builder.retrieve(question, use_embeddings=False)
+        messages = prompt_builder.build(question, rows)
+        record['rows'] = list(rows['row_hash'])
+        record['prompt_tokens'] = sum(retrieval.count_tokens(m['content']) for m in messages)
+        record['answer'] = complete(messages)
+    except (PromptTooLongError, llm.LLMError) as e:
+        record['error'] = str(e)
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def run(args):
+    """
+    質問ごとの回答を並行して生成し、1件ずつ出力ファイルに追記する関数
+    """
+    index = open_index(args.manual, args.index_path)
+    questions = load_questions(args.questions)
+    # 同じモデル・同じマニュアルで回答済みの質問のみ飛ばす
+    manual_version = index.version()
+    done = {
+        key for key, record in read_results(args.output).items()
+        if record.get('error') is None and record.get('model') == args.model
+        and record.get('manual_version') == manual_version
+    }
+    pending = [(q, fb) for q, fb in questions if question_id(q) not in done]
+    print(f"{len(questions)} question(s), {len(questions) - len(pending)} already answered, {len(pending)} to run",
+          file=sys.stderr)
+
+    prompt_builder = PromptBuilder(
+        index,
+        top_k=config.RETRIEVAL_TOP_K,
+        token_budget=config.RETRIEVAL_TOKEN_BUDGET,
+        prefix_token_budget=config.PROMPT_PREFIX_TOKEN_BUDGET,
+        max_prompt_tokens=config.PROMPT_MAX_TOKENS,
+        min_match_coverage=config.RETRIEVAL_MIN_MATCH_COVERAGE,
+    )
+    complete = fake_complete if args.fake_model else llm.complete
+
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    completed = errors = 0
+    with open(args.output, 'a', encoding='utf-8') as output, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(answer_question, prompt_builder, complete, args.model, question, feedback)
+            for question, feedback in pending
+        ]
+        try:
+            for future in as_completed(futures):
+                record = future.result()
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                completed += 1
+                errors += record['error'] is not None
+                # checkpoint_every 件ごとにディスクへ確実に書き込む（中断後はここから再開できる）
+                if completed % args.checkpoint_every == 0 or completed == len(futures):
+                    os.fsync(output.fileno())
+                    elapsed = time.perf_counter() - start
+                    print(f"{completed}/{len(futures)} answered ({errors} error(s), "
+                          f"{completed / elapsed:.1f}/s)", file=sys.stderr)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            output.flush()
+            os.fsync(output.fileno())
+            print(f"Interrupted after {completed} answer(s); run the same command again to resume.", file=sys.stderr)
+            return 130
+
+    if args.baseline:
+        report = diff_results(read_results(args.baseline), read_results(args.output))
+        print_diff(report, args.report)
+    return 1 if errors else 0
+
+
+# -------------------------------
+# Diff
+# -------------------------------
+def diff_results(baseline, current):
+    """
+    2つの結果を質問 ID で突き合わせ、変化の種類ごとの一覧を返す関数
+    """
+    report = {'changed': [], 'unchanged': 0, 'added': [], 'missing': [], 'fixed': [], 'broken': []}
+    for key, record in current.items():
+        before = baseline.get(key)
+        if before is None:
+            report['added'].append(record)
+            continue
+        if before.get('error') and not record.get('error'):
+            report['fixed'].append(record)
+        elif record.get('error') and not before.get('error'):
+            report['broken'].append(record)
+        elif before.get('answer') == record.get('answer'):
+            report['unchanged'] += 1
+        else:
+            similarity = difflib.SequenceMatcher(None, before.get('answer') or '', record.get('answer') or '').ratio()
+            report['changed'].append({
+                'id': key, 'question': record['question'], 'feedback': record.get('feedback'),
+                'similarity': round(similarity, 3), 'before': before.get('answer'), 'after': record.get('answer'),
+                'rows_added': sorted(set(record.get('rows') or []) - set(before.get('rows') or [])),
+                'rows_removed': sorted(set(before.get('rows') or []) - set(record.get('rows') or [])),
+            })
+    report['missing'] = [record for key, record in baseline.items() if key not in current]
+    # 変化の大きい回答から確認できるよう、類似度の低い順に並べる
+    report['changed'].sort(key=lambda item: item['similarity'])
+    return report
+
+
+def print_diff(report, report_path=None, limit=20):
+    """
+    差分の概要を表示し、report_path を指定した場合は変化した回答を JSONL で書き出す関数
+    """
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            for item in report['changed']:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    print(
+        f"changed: {len(report['changed'])}, unchanged: {report['unchanged']}, "
+        f"new: {len(report['added'])}, missing: {len(report['missing'])}, "
+        f"fixed errors: {len(report['fixed'])}, new errors: {len(report['broken'])}"
+    )
+    for item in report['changed'][:limit]:
+        tag = f" [feedback: {item['feedback']}]" if item['feedback'] else ""
+        print(f"\n--- {item['question']}{tag} (similarity {item['similarity']})")
+        print(f"- {item['before']}")
+        print(f"+ {item['after']}")
+    for record in report['broken'][:limit]:
+        print(f"\n!!! {record['question']}: {record['error']}")
+
+
+def diff(args):
+    report = diff_results(read_results(args.baseline), read_results(args.current))
+    print_diff(report, args.report, limit=args.limit)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='質問に回答して JSONL に書き出す')
+    run_parser.add_argument('--questions', help='質問ファイル（.txt / .csv / .jsonl、省略時は feedback.db の全質問）')
+    run_parser.add_argument('--output', required=True, help='回答を追記する JSONL ファイル（再実行時は続きから処理する）')
+    run_parser.add_argument('--manual', default=DEFAULT_MANUAL_PATH, help='評価するマニュアルの CSV')
+    run_parser.add_argument('--index-path', help='検索インデックスの保存先（省略時は <マニュアル名>_batch_index.db）')
+    run_parser.add_argument('--concurrency', type=int, default=config.OPENAI_MAX_CONCURRENCY,
+                            help='同時に処理する質問の数')
+    run_parser.add_argument('--checkpoint-every', type=int, default=50, help='fsync して進捗を表示する間隔（件数）')
+    run_parser.add_argument('--fake-model', action='store_true', help='OpenAI の代わりに決定的なフェイクモデルを使う')
+    run_parser.add_argument('--baseline', help='差分を表示する前回の結果')
+    run_parser.add_argument('--report', help='変化した回答を書き出す JSONL ファイル')
+    run_parser.set_defaults(func=run)
+
+    diff_parser = subparsers.add_parser('diff', help='2つの結果の差分を表示する')
+    diff_parser.add_argument('baseline')
+    diff_parser.add_argument('current')
+    diff_parser.add_argument('--report', help='変化した回答を書き出す JSONL ファイル')
+    diff_parser.add_argument('--limit', type=int, default=20, help='表示する件数')
+    diff_parser.set_defaults(func=diff)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        args.model = FAKE_MODEL if args.fake_model else llm.MODEL
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+LLMDispatcher のスループットとレイテンシをローカルのフェイク OpenAI サーバーに対して計測するスクリプト。
+
+    python bench/dispatcher_bench.py --requests 200 --concurrency 50 --latency 0.5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+import fake_openai_server  # noqa: E402
+
+
+def percentile(values, p):
+    """
+    値のリストから p パーセンタイルを返す関数
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50, help='同時に問い合わせるスレッド（セッション）数')
+    parser.add_argument('--distinct', type=int, default=0, help='異なる質問の数（0 の場合は全て異なる質問）')
+    parser.add_argument('--latency', type=float, default=0.5, help='フェイクサーバーの応答時間（秒）')
+    parser.add_argument('--rpm', type=int, default=100000)
+    parser.add_argument('--tpm', type=int, default=10000000)
+    parser.add_argument('--max-concurrency', type=int, default=20)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    args = parser.parse_args()
+
+    server = fake_openai_server.start_server(latency=args.latency)
+    os.environ['OPENAI_API_BASE'] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ.setdefault('OPENAI_API_KEY', 'fake-key')
+
+    from llm_dispatcher import LLMDispatcher
+
+    dispatcher = LLMDispatcher(
+        'gpt-4o',
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_concurrency=args.max_concurrency,
+    )
+
+    def run(i):
+        question = f"question {i % args.distinct if args.distinct else i}"
+        messages = [{'role': 'user', 'content': question}]
+        start = time.perf_counter()
+        if args.stream:
+            first_token = None
+            for _ in dispatcher.stream(messages):
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+            return time.perf_counter() - start, first_token
+        dispatcher.complete(messages)
+        return time.perf_counter() - start, None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(run, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    dispatcher.close()
+
+    latencies = [r[0] for r in results]
+    first_tokens = [r[1] for r in results if r[1] is not None]
+    report = {
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'server_latency': args.latency,
+        'elapsed_seconds': elapsed,
+        'throughput_rps': args.requests / elapsed,
+        'latency_mean': statistics.mean(latencies),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'first_token_p50': percentile(first_tokens, 50),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
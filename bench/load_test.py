@@ -0,0 +1,415 @@
+"""
+streamlit run で起動した app.py に複数のセッションから WebSocket で同時に接続し、
+Submit・フィードバック送信・Admin の保存のレイテンシ（p50/p95/p99）、スループット、
+セッションあたりのメモリ使用量（サーバープロセスの RSS の増加分）を計測するスクリプト。
+OpenAI と Google Drive はローカルのフェイクサーバー（tools/）に向け、マニュアルは合成データを使用する。
+
+    python bench/load_test.py --rows 100 10000 100000 --sessions 20 --iterations 3 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+import pandas as pd  # noqa: E402
+from streamlit.proto.BackMsg_pb2 import BackMsg  # noqa: E402
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg  # noqa: E402
+from streamlit.proto.WidgetStates_pb2 import WidgetState  # noqa: E402
+from streamlit.testing.v1.element_tree import parse_tree_from_messages  # noqa: E402
+from tornado.websocket import websocket_connect  # noqa: E402
+
+import fake_drive_server  # noqa: E402
+import fake_openai_server  # noqa: E402
+
+ADMIN_PASSWORD = 'load-test'
+FAQ_ROWS = 9
+
+TOPICS = ['注文', '支払い', '配送', '返品', '請求書', 'アカウント', 'パスワード', '見積もり', '在庫', '通知']
+ACTIONS = ['変更', '確認', '取り消し', '登録', '削除', '更新', '再送', '設定']
+
+
+# -------------------------------
+# Synthetic Data
+# -------------------------------
+def generate_manual(path, rows, seed=0):
+    """
+    指定した行数の合成マニュアル（priority, question, answer）を CSV に書き出す関数。
+    priority=1 の行は FAQ ボタンとして表示されるため先頭の数行のみとする。
+    """
+    rng = random.Random(seed)
+    records = []
+    for i in range(rows):
+        topic = rng.choice(TOPICS)
+        action = rng.choice(ACTIONS)
+        records.append({
+            'priority': 1 if i < FAQ_ROWS else rng.choice([2, 3, 4, 5, None]),
+            'question': f"{topic}の{action}方法を教えてください（No.{i}）",
+            'answer': f"{topic}の{action}は、マイページの「{topic}」メニューから行えます。"
+                      f"手順 {i} を参照し、完了後に確認メールが届くことを確認してください。",
+        })
+    pd.DataFrame(records).astype({'priority': 'Int64'}).to_csv(path, index=False, encoding='utf-8-sig')
+
+
+# -------------------------------
+# Statistics
+# -------------------------------
+def percentile(values, p):
+    """
+    値のリストから p パーセンタイルを返す関数
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(values):
+    """
+    レイテンシのリストを集計する関数
+    """
+    return {
+        'count': len(values),
+        'mean': statistics.mean(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+    }
+
+
+def process_memory(pid):
+    """
+    プロセスの現在の RSS と最大 RSS（バイト）を /proc から読み取る関数（Linux のみ）
+    """
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    values[key] = int(value.split()[0]) * 1024
+    except OSError:
+        return None, None
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+# -------------------------------
+# Streamlit Server
+# -------------------------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_app(workdir, env, timeout=60):
+    """
+    作業ディレクトリで streamlit run app.py を起動し、応答するようになるまで待つ関数
+    """
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run', os.path.join(ROOT, 'app.py'),
+         '--server.headless', 'true', '--server.port', str(port), '--server.address', '127.0.0.1',
+         '--browser.gatherUsageStats', 'false', '--server.fileWatcherType', 'none'],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("streamlit exited before becoming healthy")
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/_stcore/health', timeout=1):
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("streamlit did not become healthy in time")
+
+
+# -------------------------------
+# Simulated Session
+# -------------------------------
+class Session:
+    """
+    ブラウザと同じプロトコル（BackMsg / ForwardMsg）で app.py を操作する1つのユーザーセッション。
+    ブラウザと同様に、操作したウィジェットの値を保持して再実行ごとに送信する。
+    """
+
+    def __init__(self, port, timeout):
+        self.url = f'ws://127.0.0.1:{port}/_stcore/stream'
+        self.timeout = timeout
+        self.connection = None
+        self.query_string = ''
+        self.widget_values = {}
+        self.message_cache = {}
+        self.tree = None
+        self.errors = []
+
+    async def open(self):
+        self.connection = await websocket_connect(self.url, subprotocols=['streamlit'])
+        return await self.rerun()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    async def rerun(self, triggers=()):
+        """
+        保持しているウィジェットの値とトリガー（ボタンのクリック）を送って再実行し、
+        スクリプトの実行が終わるまでの時間を返す関数
+        """
+        msg = BackMsg()
+        msg.rerun_script.query_string = self.query_string
+        ids = self._widget_ids()
+        for widget_id, state in self.widget_values.items():
+            if ids is None or widget_id in ids:
+                msg.rerun_script.widget_states.widgets.append(state)
+        msg.rerun_script.widget_states.widgets.extend(triggers)
+        start = time.perf_counter()
+        await self.connection.write_message(msg.SerializeToString(), binary=True)
+        messages = await self._receive_run()
+        elapsed = time.perf_counter() - start
+        self.tree = parse_tree_from_messages(messages)
+        return elapsed
+
+    async def _receive_run(self):
+        messages = []
+        while True:
+            payload = await asyncio.wait_for(self.connection.read_message(), self.timeout)
+            if payload is None:
+                raise RuntimeError("the websocket was closed by the server")
+            msg = ForwardMsg()
+            msg.ParseFromString(payload)
+            kind = msg.WhichOneof('type')
+            if kind == 'ref_hash':
+                # 同じ内容のメッセージは参照（ハッシュ）のみで送られるため、保持しておいた本体に置き換える
+                cached = ForwardMsg()
+                cached.CopyFrom(self.message_cache[msg.ref_hash])
+                cached.metadata.CopyFrom(msg.metadata)
+                msg = cached
+                kind = msg.WhichOneof('type')
+            elif msg.metadata.cacheable:
+                self.message_cache[msg.hash] = msg
+            if kind == 'new_session':
+                messages = []
+            elif kind == 'page_info_changed':
+                self.query_string = msg.page_info_changed.query_string
+            elif kind == 'delta':
+                messages.append(msg)
+            elif kind == 'script_finished':
+                if msg.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return messages
+
+    def _widget_ids(self):
+        if self.tree is None:
+            return None
+        return {node.id for node in self.tree if hasattr(node, 'id')}
+
+    def _find(self, kind, label=None, key=None, sidebar=False):
+        block = self.tree.sidebar if sidebar else self.tree.main
+        for node in block.get(kind):
+            if (label is None or node.label == label) and (key is None or node.key == key):
+                return node
+        return None
+
+    def _set(self, node, **value):
+        state = WidgetState(id=node.id, **value)
+        self.widget_values[node.id] = state
+
+    async def _click(self, node):
+        elapsed = await self.rerun([WidgetState(id=node.id, trigger_value=True)])
+        # 計測対象の操作で表示されたエラー（例外、st.error）を記録する
+        self.errors.extend(str(e.value) for e in self.tree.exception)
+        self.errors.extend(str(e.value) for e in self.tree.error)
+        return elapsed
+
+    # ---------------------------
+    # User Actions
+    # ---------------------------
+    async def submit(self, question):
+        self._set(self._find('text_input', label='Enter your question:'), string_value=question)
+        return await self._click(self._find('button', label='Submit'))
+
+    async def feedback(self, value):
+        button = next((b for b in self.tree.main.get('button') if b.label == 'Submit Feedback'), None)
+        if button is None:
+            return None
+        radio = self._find('radio', key='feedback_' + button.key[len('submit_feedback_'):])
+        self._set(radio, int_value=list(radio.options).index(value))
+        return await self._click(button)
+
+    async def open_admin(self):
+        selectbox = self._find('selectbox', key='page_selection', sidebar=True)
+        self._set(selectbox, int_value=list(selectbox.options).index('Admin'))
+        await self.rerun()
+        self._set(self._find('text_input', label='Enter the password', sidebar=True), string_value=ADMIN_PASSWORD)
+        await self.rerun()
+
+    async def admin_save(self, question, answer):
+        """
+        Q&A を追加し、(再実行の時間, 保存できたかどうか) を返す関数
+        """
+        self._set(self._find('text_input', label='Enter a new question'), string_value=question)
+        self._set(self._find('text_area', label='Enter a new answer'), string_value=answer)
+        elapsed = await self._click(self._find('button', label='Add Q&A'))
+        return elapsed, any(e.value == 'New Q&A has been added.' for e in self.tree.success)
+
+
+async def run_session(session_no, port, args):
+    """
+    1つのセッションで Submit → フィードバック送信を繰り返し、最後に Admin の保存を行う関数
+    """
+    rng = random.Random(session_no)
+    session = Session(port, args.timeout)
+    timings = {'submit': [], 'feedback': [], 'admin_save': [], 'admin_save_failed': []}
+    try:
+        await session.open()
+        for i in range(args.iterations):
+            question = f"{rng.choice(TOPICS)}の{rng.choice(ACTIONS)}方法を教えてください"
+            if not args.repeat_questions:
+                question += f"（{session_no}-{i}）"
+            timings['submit'].append(await session.submit(question))
+            elapsed = await session.feedback(rng.choice(['Yes', 'No']))
+            if elapsed is not None:
+                timings['feedback'].append(elapsed)
+        if args.admin_saves:
+            await session.open_admin()
+            for i in range(args.admin_saves):
+                # 保存に失敗した操作（競合など）は成功時のレイテンシに含めず、別の系列として記録する
+                elapsed, saved = await session.admin_save(f"負荷試験の質問 {session_no}-{i}", f"負荷試験の回答 {session_no}-{i}")
+                timings['admin_save' if saved else 'admin_save_failed'].append(elapsed)
+    except Exception as e:
+        session.errors.append(f"{type(e).__name__}: {e}")
+    finally:
+        session.close()
+    return timings, session.errors
+
+
+async def run_sessions(port, args):
+    return await asyncio.gather(*(run_session(n, port, args) for n in range(args.sessions)))
+
+
+# -------------------------------
+# Benchmark
+# -------------------------------
+def run_benchmark(rows, args, env, drive_server):
+    """
+    指定した行数のマニュアルを一時ディレクトリに生成し、アプリを起動して全セッションを実行する関数
+    """
+    workdir = tempfile.mkdtemp(prefix=f'qa-bot-load-{rows}-')
+    generate_manual(os.path.join(workdir, 'manual.csv'), rows)
+    drive_requests_before = len(drive_server.state.requests)
+    process, port = start_app(workdir, env)
+    try:
+        # 初回の実行で共有リソース（インデックス構築など）を作成し、その時間を別途記録する
+        async def warmup():
+            session = Session(port, args.warmup_timeout)
+            elapsed = await session.open()
+            session.close()
+            return elapsed, session.errors
+
+        warmup_seconds, warmup_errors = asyncio.run(warmup())
+        memory_before, _ = process_memory(process.pid)
+
+        start = time.perf_counter()
+        results = asyncio.run(run_sessions(port, args))
+        elapsed = time.perf_counter() - start
+        memory_after, memory_peak = process_memory(process.pid)
+
+        # デバウンス中の Drive へのアップロードが完了するのを待つ
+        time.sleep(args.debounce + 1)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    timings = {'submit': [], 'feedback': [], 'admin_save': [], 'admin_save_failed': []}
+    errors = list(warmup_errors)
+    for session_timings, session_errors in results:
+        for name, values in session_timings.items():
+            timings[name].extend(values)
+        errors.extend(session_errors)
+    operations = sum(len(values) for values in timings.values())
+    memory_per_session = None
+    if memory_before is not None and memory_after is not None:
+        memory_per_session = (memory_after - memory_before) / args.sessions
+
+    return {
+        'rows': rows,
+        'sessions': args.sessions,
+        'iterations': args.iterations,
+        'warmup_seconds': warmup_seconds,
+        'elapsed_seconds': elapsed,
+        'throughput_ops_per_second': operations / elapsed,
+        'submit': summarize(timings['submit']),
+        'feedback': summarize(timings['feedback']),
+        'admin_save': summarize(timings['admin_save']),
+        'admin_save_failed': summarize(timings['admin_save_failed']),
+        'memory_rss_before_bytes': memory_before,
+        'memory_rss_after_bytes': memory_after,
+        'memory_rss_peak_bytes': memory_peak,
+        'memory_per_session_bytes': memory_per_session,
+        'drive_requests': len(drive_server.state.requests) - drive_requests_before,
+        'errors': {message: errors.count(message) for message in sorted(set(errors))},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 10000, 100000], help='合成マニュアルの行数（複数指定可）')
+    parser.add_argument('--sessions', type=int, default=10, help='同時に接続するセッション数')
+    parser.add_argument('--iterations', type=int, default=3, help='セッションごとの Submit の回数')
+    parser.add_argument('--admin-saves', type=int, default=1, help='セッションごとの Admin の保存回数')
+    parser.add_argument('--repeat-questions', action='store_true', help='質問を重複させ、回答キャッシュが効く状況を計測する')
+    parser.add_argument('--openai-latency', type=float, default=0.5, help='フェイク OpenAI サーバーの応答時間（秒）')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='ストリーミングの断片ごとの遅延（秒）')
+    parser.add_argument('--drive-latency', type=float, default=0.1, help='フェイク Drive サーバーの応答時間（秒）')
+    parser.add_argument('--debounce', type=float, default=1.0, help='Drive へのアップロードのデバウンス時間（秒）')
+    parser.add_argument('--timeout', type=float, default=120, help='1回のスクリプト実行を待つ最大時間（秒）')
+    parser.add_argument('--warmup-timeout', type=float, default=3600, help='初回の実行（インデックス構築を含む）を待つ最大時間（秒）')
+    parser.add_argument('--keep', action='store_true', help='一時ディレクトリを削除しない')
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    args = parser.parse_args()
+
+    openai_server = fake_openai_server.start_server(latency=args.openai_latency, chunk_delay=args.chunk_delay)
+    drive_server = fake_drive_server.start_server(latency=args.drive_latency)
+    env = dict(os.environ)
+    # 本物の Drive に接続しないように認証情報を外す
+    env.pop('GDRIVE_CREDENTIALS', None)
+    env.update({
+        'OPENAI_API_BASE': f"http://127.0.0.1:{openai_server.server_port}/v1",
+        'OPENAI_API_KEY': 'fake-key',
+        'GDRIVE_API_ENDPOINT': f"http://127.0.0.1:{drive_server.server_port}",
+        'DRIVE_SYNC_DEBOUNCE_SECONDS': str(args.debounce),
+        'ADMIN_PASSWORD': ADMIN_PASSWORD,
+    })
+
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'runs': [run_benchmark(rows, args, env, drive_server) for rows in args.rows],
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import os
+
+# -------------------------------
+# Configuration
+# -------------------------------
+# 各種設定値は環境変数から読み込む（未設定の場合はデフォルト値を使用）
+
+
+def _get_int(name, default):
+    """
+    環境変数を整数として読み込む関数（未設定・不正な値の場合はデフォルト値を返す）
+    """
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+# OpenAI に送るマニュアル行の最大件数（top-k）
+RETRIEVAL_TOP_K = _get_int("RETRIEVAL_TOP_K", 8)
+
+# 質問ごとに関連度と優先度で選択するマニュアル行のトークン数の上限
+RETRIEVAL_TOKEN_BUDGET = _get_int("RETRIEVAL_TOKEN_BUDGET", 3000)
+
+# 最も関連度の高い行を「該当あり」とみなす、質問のトークン（idf で重み付け）のうちその行に含まれる割合の下限
+# （下回る場合は該当なしとして記録し、未解決の質問の集計に含める）
+RETRIEVAL_MIN_MATCH_COVERAGE = float(os.getenv("RETRIEVAL_MIN_MATCH_COVERAGE") or 0.35)
+
+# 埋め込みバックエンド（空の場合は BM25 のみ、"openai" で OpenAI Embeddings を併用）
+RETRIEVAL_EMBEDDING_BACKEND = os.getenv("RETRIEVAL_EMBEDDING_BACKEND", "").strip().lower()
+
+# OpenAI Embeddings で使用するモデル
+RETRIEVAL_EMBEDDING_MODEL = os.getenv("RETRIEVAL_EMBEDDING_MODEL", "text-embedding-3-small")
+
+# 埋め込みを1回の API 呼び出しで取得するマニュアル行の件数（バッチごとにインデックスへ保存する）
+RETRIEVAL_EMBEDDING_BATCH_SIZE = _get_int("RETRIEVAL_EMBEDDING_BATCH_SIZE", 256)
+
+# メモリ上にキャッシュする埋め込みベクトルの最大件数（超えた場合は最も長く使われていないものから破棄する）
+RETRIEVAL_EMBEDDING_CACHE_SIZE = _get_int("RETRIEVAL_EMBEDDING_CACHE_SIZE", 1024)
+
+# マニュアル検索インデックス（SQLite）の保存先
+MANUAL_INDEX_PATH = os.getenv("MANUAL_INDEX_PATH", "manual_index.db")
+
+# 回答キャッシュ（SQLite）の保存先
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "answer_cache.db")
+
+# 回答キャッシュの最大件数と有効期限（秒）
+ANSWER_CACHE_MAX_ENTRIES = _get_int("ANSWER_CACHE_MAX_ENTRIES", 1000)
+ANSWER_CACHE_TTL_SECONDS = _get_int("ANSWER_CACHE_TTL_SECONDS", 7 * 24 * 3600)
+
+# 近似一致と判定する類似度のしきい値（0〜1、空の場合は近似一致を使用しない）
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD") or 0) or None
+
+# 回答をストリーミングで表示するかどうか（"0" で無効）
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "1").strip().lower() not in ("0", "false", "no", "")
+
+# 質問・回答・フィードバックのイベントログ（SQLite）の保存先
+FEEDBACK_DB_PATH = os.getenv("FEEDBACK_DB_PATH", "feedback.db")
+
+# Google Drive API のエンドポイント（ローカルのフェイクサーバーで検証する場合に変更する）
+DEFAULT_GDRIVE_API_ENDPOINT = "https://www.googleapis.com"
+GDRIVE_API_ENDPOINT = os.getenv("GDRIVE_API_ENDPOINT", DEFAULT_GDRIVE_API_ENDPOINT)
+
+# Google Drive への同期で、同じファイルへのアップロードをまとめる待ち時間（秒）
+DRIVE_SYNC_DEBOUNCE_SECONDS = float(os.getenv("DRIVE_SYNC_DEBOUNCE_SECONDS") or 5)
+
+# 同期待ちのファイル数の上限と、アップロード失敗時の再試行回数
+DRIVE_SYNC_MAX_PENDING = _get_int("DRIVE_SYNC_MAX_PENDING", 100)
+DRIVE_SYNC_MAX_RETRIES = _get_int("DRIVE_SYNC_MAX_RETRIES", 5)
+
+# 複数のプロセスで Drive のフォルダを共有する場合に、他のプロセスによる manual.csv・feedback.csv の変更を確認する間隔（秒、0 の場合は確認しない）
+DRIVE_PULL_INTERVAL_SECONDS = float(os.getenv("DRIVE_PULL_INTERVAL_SECONDS") or 0)
+
+# 質問履歴と管理者ページの一覧で1ページに表示する件数
+HISTORY_PAGE_SIZE = _get_int("HISTORY_PAGE_SIZE", 10)
+ADMIN_PAGE_SIZE = _get_int("ADMIN_PAGE_SIZE", 20)
+
+# 管理者ページの表形式の編集で1ページに表示する行数
+ADMIN_GRID_PAGE_SIZE = _get_int("ADMIN_GRID_PAGE_SIZE", 200)
+
+# OpenAI のレート制限（1分あたりのリクエスト数・トークン数）と同時実行数の上限
+OPENAI_REQUESTS_PER_MINUTE = _get_int("OPENAI_REQUESTS_PER_MINUTE", 500)
+OPENAI_TOKENS_PER_MINUTE = _get_int("OPENAI_TOKENS_PER_MINUTE", 30000)
+OPENAI_MAX_CONCURRENCY = _get_int("OPENAI_MAX_CONCURRENCY", 20)
+
+# OpenAI へのリクエストごとのタイムアウト（秒）と、429/5xx 時の再試行回数
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS") or 60)
+OPENAI_MAX_RETRIES = _get_int("OPENAI_MAX_RETRIES", 3)
+
+# Prometheus 形式のメトリクスを公開するポート（0 の場合は公開しない）
+METRICS_PORT = _get_int("METRICS_PORT", 0)
+
+# 処理段階ごとの所要時間を JSON で書き出すローテーションログの保存先（空の場合は書き出さない）
+METRICS_LOG_PATH = os.getenv("METRICS_LOG_PATH", "")
+
+# システムメッセージに固定で含める優先度1の行のトークン数の上限（0 の場合は含めない）
+PROMPT_PREFIX_TOKEN_BUDGET = _get_int("PROMPT_PREFIX_TOKEN_BUDGET", 1500)
+
+# プロンプト全体のトークン数の上限（モデルのコンテキスト長から回答の分を差し引いた値）
+PROMPT_MAX_TOKENS = _get_int("PROMPT_MAX_TOKENS", 120000)
+
+# 会話（スレッド）の保存先（SQLite）
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH", "conversations.db")
+
+# フォローアップの質問のプロンプトにそのまま含める直近のターン数と、要約を含めた会話の履歴のトークン数の上限
+CONVERSATION_MAX_TURNS = _get_int("CONVERSATION_MAX_TURNS", 4)
+CONVERSATION_TOKEN_BUDGET = _get_int("CONVERSATION_TOKEN_BUDGET", 2000)
+
+# 直近のターンより前の会話を OpenAI で要約してプロンプトに含めるかどうか（"0" で無効）
+CONVERSATION_SUMMARY_ENABLED = os.getenv("CONVERSATION_SUMMARY_ENABLED", "1").strip().lower() not in ("0", "false", "no", "")
+
+# この日数以上更新されていない会話は圧縮してアーカイブに移す
+CONVERSATION_ARCHIVE_DAYS = _get_int("CONVERSATION_ARCHIVE_DAYS", 7)
+
+# 回答できなかった質問のクラスター（gap_mining.py の結果）の保存先
+GAP_MINING_PATH = os.getenv("GAP_MINING_PATH", "gap_clusters.json")
+
+# 優先度1の行（FAQ）の回答を起動時とマニュアルの変更時にバックグラウンドで事前に生成するかどうか（"0" で無効）
+FAQ_WARMUP_ENABLED = os.getenv("FAQ_WARMUP_ENABLED", "1").strip().lower() not in ("0", "false", "no", "")
+
+# 事前に生成した回答の保存先（SQLite）
+FAQ_ANSWERS_PATH = os.getenv("FAQ_ANSWERS_PATH", "faq_answers.db")
+
+# FAQ に加えて回答を事前に生成する、よく聞かれる質問の件数（0 の場合は FAQ のみ）と同時実行数
+FAQ_WARMUP_TOP_QUESTIONS = _get_int("FAQ_WARMUP_TOP_QUESTIONS", 20)
+FAQ_WARMUP_CONCURRENCY = _get_int("FAQ_WARMUP_CONCURRENCY", 4)
+
+# マニュアルの質問と表記の揺れ（全角・半角、カタカナ・ひらがな、空白・記号）のみが異なる質問に、
+# OpenAI を呼び出さずにマニュアルの回答をそのまま返すかどうか
+# （off: 使わない、on: 常に使う、ab: 一致した質問のうち DIRECT_MATCH_AB_PERCENT % の利用者にのみ使い、feedback.csv の variant 列で比較する）
+DIRECT_MATCH_MODE = (os.getenv("DIRECT_MATCH_MODE") or "off").strip().lower()
+DIRECT_MATCH_AB_PERCENT = _get_int("DIRECT_MATCH_AB_PERCENT", 50)
@@ -0,0 +1,308 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+from normalize import normalize_question
+from retrieval import count_tokens
+
+# -------------------------------
+# Conversation Store
+# -------------------------------
+# 会話の一覧に表示するタイトル（最初の質問）の最大文字数
+TITLE_LENGTH = 80
+
+# 前のターンを指す表現（これらを含む質問は会話の文脈がないと答えられないものとして扱う）
+CONTEXT_WORDS = (
+    'それ', 'その', 'そこ', 'これ', 'この', 'ここ', 'あれ', 'あの', '上記', '前述', 'さっき', '先ほど', '先程',
+    '前の', '今の', '他に', 'ほかに', '具体的に', '詳しく', 'もっと', '続き',
+)
+CONTEXT_WORDS_EN = ('it', 'that', 'this', 'these', 'those', 'they', 'them', 'more', 'else')
+
+# 正規化した長さがこれ以下の質問（「なぜ？」「例は？」など）も文脈に依存するものとして扱う
+SHORT_QUESTION_LENGTH = 5
+
+
+def depends_on_context(question):
+    """
+    質問が前のターンを前提にしているか（指示語を含む、または極端に短いか）を返す関数。
+    前提にしない質問は会話の履歴なしで回答し、回答キャッシュを共有できるようにする。
+    """
+    normalized = normalize_question(question)
+    if len(normalized) <= SHORT_QUESTION_LENGTH:
+        return True
+    if any(word in normalized for word in CONTEXT_WORDS):
+        return True
+    words = set(question.lower().replace('?', ' ').replace(',', ' ').replace('.', ' ').split())
+    return bool(words & set(CONTEXT_WORDS_EN))
+
+
+class ConversationStore:
+    """
+    ユーザーごとの会話（スレッド）と各ターンの質問・回答を SQLite（WAL モード）に保存するクラス。
+    セッションにはスレッド ID のみを保持し、プロンプトに含める直近のターンと要約は必要な時にのみ読み込む。
+    一定期間更新されていないスレッドはターンをまとめて zlib で圧縮したアーカイブに移し、
+    再び使われた時に展開して戻す。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._archived_at = 0.0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS threads (
+                thread_id TEXT PRIMARY KEY,
+                user_id TEXT,
+                title TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                turn_count INTEGER NOT NULL DEFAULT 0,
+                summary TEXT,
+                summary_turns INTEGER NOT NULL DEFAULT 0,
+                archived INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS threads_user_updated_at ON threads (user_id, updated_at);
+            CREATE INDEX IF NOT EXISTS threads_archived_updated_at ON threads (archived, updated_at);
+            CREATE TABLE IF NOT EXISTS turns (
+                thread_id TEXT NOT NULL,
+                turn INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                qa_id TEXT,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (thread_id, turn)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS archive (
+                thread_id TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+            """
+        )
+
+    # ---------------------------
+    # Threads
+    # ---------------------------
+    def create_thread(self, user_id):
+        """
+        新しいスレッドを作成し、その ID を返す関数
+        """
+        thread_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO threads (thread_id, user_id, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (thread_id, user_id, now, now),
+            )
+        return thread_id
+
+    def latest_thread(self, user_id):
+        """
+        ユーザーが最後に使用したアーカイブされていないスレッドの ID を返す関数（ない場合は None）
+        """
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT thread_id FROM threads
+                WHERE user_id = ? AND archived = 0 AND turn_count > 0
+                ORDER BY updated_at DESC LIMIT 1
+                """,
+                (user_id,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def list_threads(self, user_id, limit=20):
+        """
+        ユーザーのスレッドを新しい順に返す関数（アーカイブ済みのスレッドも含む）
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT thread_id, title, updated_at, turn_count, archived FROM threads
+                WHERE user_id = ? AND turn_count > 0
+                ORDER BY updated_at DESC LIMIT ?
+                """,
+                (user_id, limit),
+            ).fetchall()
+        return [
+            {'thread_id': t, 'title': title, 'updated_at': updated_at, 'turn_count': count, 'archived': bool(archived)}
+            for t, title, updated_at, count, archived in rows
+        ]
+
+    def add_turn(self, thread_id, question, answer, qa_id=None):
+        """
+        スレッドにターンを追加する関数（アーカイブ済みの場合は先に展開して戻す）
+        """
+        tokens = count_tokens(question) + count_tokens(answer)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._restore(thread_id)
+                turn_count = self._conn.execute(
+                    "SELECT turn_count FROM threads WHERE thread_id = ?", (thread_id,)
+                ).fetchone()[0]
+                self._conn.execute(
+                    "INSERT INTO turns (thread_id, turn, created_at, qa_id, question, answer, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, turn_count + 1, now, qa_id, question, answer, tokens),
+                )
+                self._conn.execute(
+                    """
+                    UPDATE threads SET turn_count = turn_count + 1, updated_at = ?, title = COALESCE(title, ?)
+                    WHERE thread_id = ?
+                    """,
+                    (now, question[:TITLE_LENGTH], thread_id),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return turn_count + 1
+
+    def turns(self, thread_id, after=0):
+        """
+        スレッドの after 番目より後のターンを古い順に返す関数（アーカイブ済みの場合は展開して読み込む）
+        """
+        with self._lock:
+            archived = self._conn.execute(
+                "SELECT archived FROM threads WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+            if archived and archived[0]:
+                data = self._load_archive(thread_id)
+                return [turn for turn in data['turns'] if turn['turn'] > after]
+            rows = self._conn.execute(
+                """
+                SELECT turn, created_at, qa_id, question, answer, tokens FROM turns
+                WHERE thread_id = ? AND turn > ? ORDER BY turn
+                """,
+                (thread_id, after),
+            ).fetchall()
+        return [_turn_dict(row) for row in rows]
+
+    # ---------------------------
+    # Prompt Context
+    # ---------------------------
+    def context(self, thread_id, max_turns, token_budget):
+        """
+        プロンプトに含める (要約, 直近のターン) を返す関数。
+        要約に含まれていないターンのうち新しい max_turns 件を、要約と合わせて token_budget に収まるよう古いものから外す。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, summary_turns, turn_count FROM threads WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+        if row is None:
+            return None, []
+        summary, summary_turns, turn_count = row
+        after = max(summary_turns, turn_count - max_turns)
+        turns = self.turns(thread_id, after=after) if max_turns > 0 else []
+        summary_tokens = count_tokens(summary) if summary else 0
+        if summary_tokens > token_budget:
+            summary, summary_tokens = None, 0
+        used = summary_tokens
+        kept = []
+        for turn in reversed(turns):
+            if used + turn['tokens'] > token_budget:
+                break
+            used += turn['tokens']
+            kept.append(turn)
+        return summary, kept[::-1]
+
+    def pending_summary(self, thread_id, keep_turns):
+        """
+        直近の keep_turns 件より前で、まだ要約に含まれていないターンがある場合に
+        (現在の要約, 要約に加えるターン) を返す関数（ない場合は None）
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, summary_turns, turn_count FROM threads WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        summary, summary_turns, turn_count = row
+        last = turn_count - keep_turns
+        if last <= summary_turns:
+            return None
+        turns = [turn for turn in self.turns(thread_id, after=summary_turns) if turn['turn'] <= last]
+        return summary, turns
+
+    def set_summary(self, thread_id, summary, summary_turns):
+        """
+        スレッドの要約を保存する関数（既により新しいターンまでの要約がある場合は何もしない）
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE threads SET summary = ?, summary_turns = ? WHERE thread_id = ? AND summary_turns < ?",
+                (summary, summary_turns, thread_id, summary_turns),
+            )
+
+    # ---------------------------
+    # Archive
+    # ---------------------------
+    def archive_idle(self, max_idle_seconds, interval=0):
+        """
+        max_idle_seconds 以上更新されていないスレッドのターンを圧縮してアーカイブに移し、移した件数を返す関数。
+        interval を指定した場合、前回の実行から interval 秒以内は何もしない。
+        """
+        now = time.time()
+        cutoff = now - max_idle_seconds
+        with self._lock:
+            if now - self._archived_at < interval:
+                return 0
+            self._archived_at = now
+            thread_ids = [row[0] for row in self._conn.execute(
+                "SELECT thread_id FROM threads WHERE archived = 0 AND updated_at < ?", (cutoff,)
+            )]
+            for thread_id in thread_ids:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = self._conn.execute(
+                        """
+                        SELECT turn, created_at, qa_id, question, answer, tokens FROM turns
+                        WHERE thread_id = ? ORDER BY turn
+                        """,
+                        (thread_id,),
+                    ).fetchall()
+                    data = zlib.compress(
+                        json.dumps({'turns': [_turn_dict(row) for row in rows]}, ensure_ascii=False).encode('utf-8'), 9
+                    )
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO archive (thread_id, data) VALUES (?, ?)", (thread_id, data)
+                    )
+                    self._conn.execute("DELETE FROM turns WHERE thread_id = ?", (thread_id,))
+                    self._conn.execute("UPDATE threads SET archived = 1 WHERE thread_id = ?", (thread_id,))
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        return len(thread_ids)
+
+    def _load_archive(self, thread_id):
+        row = self._conn.execute("SELECT data FROM archive WHERE thread_id = ?", (thread_id,)).fetchone()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8')) if row else {'turns': []}
+
+    def _restore(self, thread_id):
+        """
+        アーカイブ済みのスレッドのターンを展開して turns テーブルに戻す関数（トランザクション内で呼び出す）
+        """
+        archived = self._conn.execute("SELECT archived FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+        if not archived or not archived[0]:
+            return
+        turns = self._load_archive(thread_id)['turns']
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO turns (thread_id, turn, created_at, qa_id, question, answer, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(thread_id, t['turn'], t['created_at'], t['qa_id'], t['question'], t['answer'], t['tokens']) for t in turns],
+        )
+        self._conn.execute("DELETE FROM archive WHERE thread_id = ?", (thread_id,))
+        self._conn.execute("UPDATE threads SET archived = 0 WHERE thread_id = ?", (thread_id,))
+
+
+def _turn_dict(row):
+    turn, created_at, qa_id, question, answer, tokens = row
+    return {'turn': turn, 'created_at': created_at, 'qa_id': qa_id, 'question': question, 'answer': answer, 'tokens': tokens}
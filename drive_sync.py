@@ -0,0 +1,393 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------
+# Google Drive REST Client
+# -------------------------------
+class DriveClient:
+    """
+    Google Drive v3 REST API の必要な部分のみを扱う軽量クライアント。
+    session には認証済みの requests.Session（google.auth の AuthorizedSession など）を渡す。
+    """
+
+    def __init__(self, session, folder_id, endpoint="https://www.googleapis.com", timeout=60):
+        self.session = session
+        self.folder_id = folder_id
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = timeout
+
+    def find_file(self, file_name):
+        """
+        フォルダ内のファイルを名前で検索し、メタデータ（id, name, modifiedTime, md5Checksum）を返す関数
+        """
+        response = self.session.get(
+            f"{self.endpoint}/drive/v3/files",
+            params={
+                'q': f"name='{file_name}' and '{self.folder_id}' in parents and trashed=false",
+                'fields': 'files(id, name, modifiedTime, md5Checksum)',
+            },
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        files = response.json().get('files', [])
+        return files[0] if files else None
+
+    def download_file(self, file_id, file_path):
+        """
+        ファイルの内容をダウンロードして file_path に書き出す関数（一時ファイルに書いてから置き換える）
+        """
+        response = self.session.get(
+            f"{self.endpoint}/drive/v3/files/{file_id}", params={'alt': 'media'}, timeout=self.timeout, stream=True,
+        )
+        response.raise_for_status()
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+        os.replace(tmp_path, file_path)
+
+    def _resumable_upload(self, method, url, metadata, file_path):
+        response = self.session.request(
+            method,
+            url,
+            params={'uploadType': 'resumable', 'fields': 'id, name, modifiedTime, md5Checksum'},
+            data=json.dumps(metadata),
+            headers={'Content-Type': 'application/json; charset=UTF-8'},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        with open(file_path, 'rb') as f:
+            response = self.session.put(response.headers['Location'], data=f, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def create_file(self, file_path):
+        """
+        ファイルをフォルダに新規アップロードし、メタデータを返す関数
+        """
+        metadata = {'name': os.path.basename(file_path), 'parents': [self.folder_id]}
+        return self._resumable_upload('POST', f"{self.endpoint}/upload/drive/v3/files", metadata, file_path)
+
+    def update_file(self, file_id, file_path):
+        """
+        既存のファイルの内容を更新し、メタデータを返す関数
+        """
+        return self._resumable_upload('PATCH', f"{self.endpoint}/upload/drive/v3/files/{file_id}", {}, file_path)
+
+
+# -------------------------------
+# Background Sync Worker
+# -------------------------------
+class DriveSyncWorker:
+    """
+    Google Drive へのアップロードをバックグラウンドスレッドで行うワーカー。
+    同じファイルへのアップロード要求は debounce_seconds の間まとめて1回にし、
+    失敗時は指数バックオフで再試行する。ファイル ID はプロセス内でキャッシュする。
+    """
+
+    def __init__(self, client_factory, debounce_seconds=5.0, max_pending=100, max_retries=5, backoff_seconds=1.0):
+        self.client_factory = client_factory
+        self.debounce_seconds = debounce_seconds
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.last_error = None
+        self._client = None
+        self._file_ids = {}
+        self._pending = {}
+        self._busy = False
+        self._uploading = set()
+        self._flushing = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='drive-sync', daemon=True)
+
+    def start(self):
+        """
+        ワーカースレッドを起動し、プロセス終了時に未送信のファイルを送信するよう登録する関数
+        """
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def schedule(self, file_path, prepare=None, on_uploaded=None):
+        """
+        ファイルのアップロードを予約する関数。prepare はアップロード直前に、on_uploaded はアップロードが
+        成功した後にワーカー内で呼ばれ、ファイルの書き出しや同期した内容の記録などに使用する。
+        予約数が上限に達している場合は False を返す。
+        """
+        with self._cond:
+            if file_path not in self._pending and len(self._pending) >= self.max_pending:
+                logger.warning("Drive sync queue is full; dropping upload of %s", file_path)
+                return False
+            due = self._pending[file_path][0] if file_path in self._pending else time.monotonic() + self.debounce_seconds
+            self._pending[file_path] = (due, prepare, on_uploaded)
+            self._cond.notify()
+        return True
+
+    def is_uploading(self, file_path):
+        """
+        ファイルのアップロードを実行中の場合に True を返す関数
+        """
+        with self._cond:
+            return file_path in self._uploading
+
+    def flush(self, timeout=None):
+        """
+        予約済みのアップロードを待たずに実行し、完了するまで待つ関数（完了した場合は True を返す）
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            try:
+                while self._pending or self._busy:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._flushing = False
+
+    def stop(self, timeout=30):
+        """
+        未送信のファイルを送信してからワーカーを停止する関数
+        """
+        if self._thread.is_alive():
+            self.flush(timeout)
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.monotonic()
+                    due = [path for path, (at, *_) in self._pending.items() if self._flushing or at <= now]
+                    if due:
+                        jobs = [(path, *self._pending.pop(path)[1:]) for path in due]
+                        self._uploading = set(due)
+                        self._busy = True
+                        break
+                    timeout = min((at for at, *_ in self._pending.values()), default=now + 60) - now
+                    self._cond.wait(max(timeout, 0))
+            try:
+                for path, prepare, on_uploaded in jobs:
+                    self._sync(path, prepare, on_uploaded)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._uploading = set()
+                    self._cond.notify_all()
+
+    def _sync(self, file_path, prepare, on_uploaded=None):
+        if self._client is None:
+            try:
+                self._client = self.client_factory()
+            except Exception as e:
+                # 認証情報の設定誤りは再試行しても解決しないため、そのまま記録する
+                self.last_error = f"Google Drive authentication failed: {e}"
+                logger.error(self.last_error)
+                return
+        file_name = os.path.basename(file_path)
+        for attempt in range(self.max_retries + 1):
+            try:
+                if prepare is not None:
+                    with metrics.span('drive_prepare', file=file_name):
+                        prepare()
+                with metrics.span('drive_upload', file=file_name):
+                    self._upload(file_path)
+                metrics.increment('drive_uploads_total', file=file_name, outcome='success')
+                self.last_error = None
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    metrics.increment('drive_uploads_total', file=file_name, outcome='error')
+                    self.last_error = f"Failed to upload {file_name} to Google Drive: {e}"
+                    logger.error(self.last_error)
+                    return
+                metrics.increment('drive_uploads_total', file=file_name, outcome='retry')
+                delay = self.backoff_seconds * (2 ** attempt) * (0.5 + random.random())
+                logger.warning("Drive upload of %s failed (%s); retrying in %.1fs", file_path, e, delay)
+                time.sleep(delay)
+        if on_uploaded is not None:
+            try:
+                on_uploaded()
+            except Exception:
+                logger.exception("Post-upload callback for %s failed", file_name)
+
+    def _upload(self, file_path):
+        file_name = os.path.basename(file_path)
+        file_id = self._file_ids.get(file_name)
+        if file_id is None:
+            existing = self._client.find_file(file_name)
+            file_id = existing['id'] if existing else None
+        if file_id is not None:
+            try:
+                metadata = self._client.update_file(file_id, file_path)
+            except Exception as e:
+                # ファイルが削除されていた場合は ID を破棄して再検索させる
+                if getattr(getattr(e, 'response', None), 'status_code', None) == 404:
+                    self._file_ids.pop(file_name, None)
+                raise
+            logger.info("Updated %s in Google Drive.", file_name)
+        else:
+            metadata = self._client.create_file(file_path)
+            logger.info("Uploaded %s to Google Drive.", file_name)
+        self._file_ids[file_name] = metadata['id']
+
+
+# -------------------------------
+# Background Pull
+# -------------------------------
+def file_md5(file_path):
+    """
+    ファイルの MD5（Google Drive の md5Checksum と同じ形式）を返す関数（ファイルがない場合は None）
+    """
+    if not os.path.exists(file_path):
+        return None
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DrivePullWorker:
+    """
+    複数のプロセスで同じ Google Drive フォルダを共有するため、登録したファイルの変更を定期的に確認し、
+    変更されたファイルのみをダウンロードして反映するワーカー。
+    確認は interval_seconds ごとにファイルのメタデータ（md5Checksum）を取得するだけで、
+    前回取り込んだ内容・ローカルのファイルと同じ場合（自分がアップロードした場合を含む）はダウンロードしない。
+    取り込みはローカルの変更を残して差分を反映する（on_change で行う）ため、アップロードの予約中でも取り込む。
+    アップロードを実行中のファイルは次の確認まで取り込まない（アップロードの直前には pull で取り込む）。
+    """
+
+    def __init__(self, client_factory, interval_seconds=30.0, sync_worker=None):
+        self.client_factory = client_factory
+        self.interval_seconds = interval_seconds
+        self.sync_worker = sync_worker
+        self.last_error = None
+        self._client = None
+        self._handlers = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._pull_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='drive-pull', daemon=True)
+
+    def register(self, file_path, on_change):
+        """
+        確認するファイルを登録する関数。変更があった場合、ダウンロードしたファイルのパスを引数に
+        on_change がワーカー内で呼ばれる（ファイルはその後削除される）。
+        """
+        with self._lock:
+            self._handlers[file_path] = on_change
+        return self
+
+    def start(self):
+        """
+        ワーカースレッドを起動し（最初の確認はすぐに行う）、プロセス終了時に停止するよう登録する関数
+        """
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self, timeout=30):
+        """
+        ワーカーを停止する関数（取り込み中のファイルがある場合は完了するまで待つ）
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped:
+            self.poll()
+            self._wake.wait(self.interval_seconds)
+
+    def _ensure_client(self):
+        if self._client is None:
+            try:
+                self._client = self.client_factory()
+            except Exception as e:
+                self.last_error = f"Google Drive authentication failed: {e}"
+                logger.error(self.last_error)
+                return False
+        return True
+
+    def poll(self):
+        """
+        登録した全てのファイルの変更を確認して取り込み、取り込んだファイルのパスのリストを返す関数
+        """
+        if not self._ensure_client():
+            return []
+        with self._lock:
+            handlers = list(self._handlers.items())
+        pulled = []
+        for file_path, on_change in handlers:
+            file_name = os.path.basename(file_path)
+            if self.sync_worker is not None and self.sync_worker.is_uploading(file_path):
+                continue
+            try:
+                with metrics.span('drive_poll', file=file_name), self._pull_lock:
+                    if self._pull(file_path, on_change):
+                        pulled.append(file_path)
+                self.last_error = None
+            except Exception as e:
+                metrics.increment('drive_pulls_total', file=file_name, outcome='error')
+                self.last_error = f"Failed to pull {file_name} from Google Drive: {e}"
+                logger.error(self.last_error)
+        return pulled
+
+    def pull(self, file_path):
+        """
+        登録したファイルの変更を、定期的な確認を待たずに確認して取り込む関数（取り込んだ場合は True を返す）。
+        アップロードの直前（prepare）に呼び、他のプロセスの変更を上書きしないよう先に取り込むために使う。
+        """
+        if not self._ensure_client():
+            raise RuntimeError(self.last_error)
+        with self._lock:
+            on_change = self._handlers[file_path]
+        with self._pull_lock:
+            return self._pull(file_path, on_change)
+
+    def _pull(self, file_path, on_change):
+        file_name = os.path.basename(file_path)
+        remote = self._client.find_file(file_name)
+        if remote is None:
+            return False
+        checksum = remote.get('md5Checksum')
+        if checksum and (checksum == self._seen.get(file_path) or checksum == file_md5(file_path)):
+            self._seen[file_path] = checksum
+            return False
+        download_path = f"{file_path}.remote"
+        with metrics.span('drive_download', file=file_name):
+            self._client.download_file(remote['id'], download_path)
+        checksum = checksum or file_md5(download_path)
+        try:
+            with metrics.span('drive_apply', file=file_name):
+                on_change(download_path)
+        finally:
+            if os.path.exists(download_path):
+                os.remove(download_path)
+        self._seen[file_path] = checksum
+        metrics.increment('drive_pulls_total', file=file_name, outcome='success')
+        logger.info("Pulled %s from Google Drive (modified %s).", file_name, remote.get('modifiedTime'))
+        return True
@@ -0,0 +1,201 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from conversation_store import depends_on_context
+from normalize import NORMALIZATION_VERSION, normalize_question
+from llm import LLMError
+from prompt_builder import PromptTooLongError
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------
+# Precomputed FAQ Answers
+# -------------------------------
+class FAQAnswerStore:
+    """
+    事前に生成した回答を SQLite（WAL モード）に保存するクラス。
+    キーは優先度1の行の場合はその行のハッシュ（'row:<ハッシュ>'）、よく聞かれる質問の場合は
+    正規化した質問と検索で選ばれた行のハッシュから作り、内容が変わった行の回答のみを作り直せるようにする。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS faq_answers (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                normalized TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                entry TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS faq_answers_normalized ON faq_answers (normalized);
+            """
+        )
+        # 正規化の方法が変わった場合は、保存済みの質問を正規化し直す
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != NORMALIZATION_VERSION:
+            rows = self._conn.execute("SELECT key, question FROM faq_answers").fetchall()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "UPDATE faq_answers SET normalized = ? WHERE key = ?",
+                    [(normalize_question(question), key) for key, question in rows],
+                )
+                self._conn.execute(f"PRAGMA user_version = {NORMALIZATION_VERSION}")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, question):
+        """
+        質問に一致する事前生成の回答を (回答, マニュアル行のハッシュ) で返す関数（ない場合は None）。
+        優先度1の行の回答をよく聞かれる質問の回答より優先する。
+        """
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer, entry FROM faq_answers WHERE normalized = ? ORDER BY kind = 'faq' DESC LIMIT 1",
+                (normalized,),
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def keys(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT key FROM faq_answers")}
+
+    def put(self, key, kind, question, answer, entry=None):
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO faq_answers (key, kind, normalized, question, answer, entry, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (key, kind, normalize_question(question), question, answer, entry, time.time()),
+            )
+
+    def retain(self, keys):
+        """
+        keys に含まれない（内容が変わった行・削除された行の）回答を削除し、削除した件数を返す関数
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS current_keys (key TEXT PRIMARY KEY)")
+                self._conn.execute("DELETE FROM current_keys")
+                self._conn.executemany("INSERT OR IGNORE INTO current_keys (key) VALUES (?)", [(k,) for k in keys])
+                deleted = self._conn.execute(
+                    "DELETE FROM faq_answers WHERE key NOT IN (SELECT key FROM current_keys)"
+                ).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return deleted
+
+
+# -------------------------------
+# Background Warm-up
+# -------------------------------
+class FAQWarmer:
+    """
+    優先度1の行（と、popular_questions を指定した場合はよく聞かれる質問）の回答を
+    バックグラウンドのスレッドで事前に生成するクラス。
+    schedule() を呼ぶたびに対象を計算し直し、キーが変わらない回答はそのまま使い、
+    変わったものと新しいものだけを OpenAI に問い合わせる。
+    """
+
+    def __init__(self, store, index, prompt_builder, complete, popular_questions=None, concurrency=4):
+        self.store = store
+        self.index = index
+        self.prompt_builder = prompt_builder
+        self.complete = complete
+        self.popular_questions = popular_questions
+        self.concurrency = concurrency
+        self._event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='faq-warmup', daemon=True)
+        self._thread.start()
+
+    def schedule(self):
+        """
+        回答の事前生成を予約する関数（実行中に呼ばれた場合は終了後にもう1回実行する）
+        """
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            try:
+                with metrics.span('faq_warmup'):
+                    self.warm()
+            except Exception:
+                logger.exception("FAQ warm-up failed")
+
+    def targets(self):
+        """
+        事前生成の対象を (キー, 種類, 質問, 関連するマニュアル行, 回答の元になった行) のリストで返す関数
+        """
+        targets = []
+        faq_questions = set()
+        for row in self.index.priority_rows(1).itertuples():
+            faq_questions.add(normalize_question(row.question))
+            targets.append((f"row:{row.row_hash}", 'faq', row.question, None, row.row_hash))
+        if self.popular_questions is not None:
+            for question in self.popular_questions():
+                normalized = normalize_question(question)
+                # 前のターンを前提にした質問は会話によって回答が変わるため、履歴なしの回答を事前生成しない
+                if not normalized or normalized in faq_questions or depends_on_context(question):
+                    continue
+                rows = self._retrieve(question)
+                digest = hashlib.sha1("\x1f".join([normalized, *rows['row_hash']]).encode('utf-8')).hexdigest()
+                targets.append((f"q:{digest}", 'popular', question, rows, rows.attrs.get('top_match')))
+        return targets
+
+    def _retrieve(self, question):
+        try:
+            return self.prompt_builder.retrieve(question)
+        except Exception:
+            return self.prompt_builder.retrieve(question, use_embeddings=False)
+
+    def warm(self):
+        """
+        古くなった回答を削除し、まだない回答を生成する関数。生成した件数を返す。
+        """
+        targets = self.targets()
+        self.store.retain([t[0] for t in targets])
+        existing = self.store.keys()
+        missing = [t for t in targets if t[0] not in existing]
+        if not missing:
+            return 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(self._answer, missing))
+        return sum(results)
+
+    def _answer(self, target):
+        key, kind, question, rows, entry = target
+        try:
+            if rows is None:
+                rows = self._retrieve(question)
+            answer = self.complete(self.prompt_builder.build(question, rows))
+        except (LLMError, PromptTooLongError) as e:
+            # 生成できなかった回答は次の実行で再度試す
+            logger.warning("Failed to precompute the answer to %r: %s", question, e)
+            metrics.increment('faq_warmup_answers_total', outcome='error')
+            return 0
+        self.store.put(key, kind, question, answer, entry=entry)
+        metrics.increment('faq_warmup_answers_total', outcome='success')
+        return 1
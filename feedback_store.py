@@ -0,0 +1,711 @@
+import bisect
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+from normalize import normalize_question
+
+# -------------------------------
+# Feedback Event Store
+# -------------------------------
+HISTORY_COLUMNS = ['qa_id', 'asked_at', 'question', 'answer', 'feedback', 'feedback_at', 'source', 'user_id', 'variant']
+
+# フィードバックの絞り込みで「未評価」を表す値
+NOT_RATED = 'Not rated'
+
+# 回答までの時間を集計するバケットの上限（秒、約1.25倍ずつ 0.05〜120 秒）
+LATENCY_BUCKETS = tuple(round(0.05 * 1.25 ** i, 3) for i in range(36))
+
+# 集計テーブルの形式のバージョン（変更した場合は起動時にイベントから作り直す）
+# 2: 質問の正規化でカタカナとひらがなを区別しなくなった
+AGGREGATES_VERSION = 2
+
+# feedback.csv の列（削除した Q&A は qa_id と deleted_at のみの行として書き出し、他のプロセスに削除を伝える）
+EXPORT_COLUMNS = HISTORY_COLUMNS + ['deleted_at']
+
+_HISTORY_SELECT = """
+    SELECT q.qa_id, q.created_at, q.question, q.answer, f.feedback, f.created_at, q.source, q.user_id, q.variant
+    FROM events q
+    LEFT JOIN events f ON f.qa_id = q.qa_id AND f.kind = 'feedback'
+"""
+
+_EXPORT_SELECT = """
+    SELECT q.qa_id, q.created_at, q.question, q.answer, f.feedback, f.created_at, q.source, q.user_id, q.variant, NULL
+    FROM events q
+    LEFT JOIN events f ON f.qa_id = q.qa_id AND f.kind = 'feedback'
+"""
+
+
+class FeedbackStore:
+    """
+    質問・回答・フィードバックを追記専用のイベントとして SQLite（WAL モード）に保存するクラス。
+    各イベントは1回の INSERT で記録し、feedback.csv は必要な時にのみ書き出す。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_id TEXT NOT NULL UNIQUE,
+                qa_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                question TEXT,
+                answer TEXT,
+                feedback TEXT,
+                source TEXT
+            );
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(events)")}
+        if 'user_id' not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN user_id TEXT")
+        # entry: 最も関連度の高いマニュアル行のハッシュ（検索で該当がなかった場合は空文字列、不明な場合は NULL）
+        # latency: 質問から回答を表示するまでの時間（秒）
+        if 'entry' not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN entry TEXT")
+        if 'latency' not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN latency REAL")
+        # variant: A/B 比較の対象となった質問で、利用者に割り当てた方式（'direct' または 'llm'）
+        if 'variant' not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN variant TEXT")
+        self._conn.executescript(
+            """
+            CREATE INDEX IF NOT EXISTS events_qa_id ON events (qa_id, kind);
+            CREATE INDEX IF NOT EXISTS events_kind_created_at ON events (kind, created_at);
+            CREATE INDEX IF NOT EXISTS events_kind_user_created_at ON events (kind, user_id, created_at);
+            """
+        )
+        self._fts = self._create_fts()
+        self._create_aggregates()
+
+    def _create_fts(self):
+        """
+        質問・回答の全文検索用に FTS5（trigram）のインデックスを作成する関数（利用できない場合は False を返す）
+        """
+        try:
+            exists = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events_fts'"
+            ).fetchone()
+            self._conn.executescript(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+                    question, answer, content='events', content_rowid='seq', tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS events_fts_insert AFTER INSERT ON events
+                WHEN new.kind = 'question' BEGIN
+                    INSERT INTO events_fts (rowid, question, answer) VALUES (new.seq, new.question, new.answer);
+                END;
+                """
+            )
+            if not exists:
+                self._conn.execute(
+                    "INSERT INTO events_fts (rowid, question, answer) SELECT seq, question, answer FROM events WHERE kind = 'question'"
+                )
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    # ---------------------------
+    # Append Events
+    # ---------------------------
+    def _append(self, event_id, qa_id, kind, created_at, question=None, answer=None, feedback=None, source=None,
+                user_id=None, entry=None, latency=None, variant=None):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._conn.execute(
+                    """
+                    INSERT OR IGNORE INTO events
+                        (event_id, qa_id, kind, created_at, question, answer, feedback, source, user_id, entry, latency,
+                         variant)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (event_id, qa_id, kind, created_at, question, answer, feedback, source, user_id, entry, latency,
+                     variant),
+                )
+                inserted = cursor.rowcount == 1
+                if inserted:
+                    self._update_aggregates(kind, qa_id, created_at, question, feedback, source, entry, latency)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return inserted
+
+    def record_question(self, question, answer, source, user_id=None, entry=None, latency=None, variant=None):
+        """
+        質問と回答のイベントを追記し、その Q&A の ID を返す関数
+        """
+        qa_id = uuid.uuid4().hex
+        self._append(qa_id, qa_id, 'question', time.time(), question=question, answer=answer, source=source,
+                     user_id=user_id, entry=entry, latency=latency, variant=variant)
+        return qa_id
+
+    def record_feedback(self, qa_id, feedback):
+        """
+        Q&A に対するフィードバック（Yes/No）のイベントを追記する関数
+        """
+        self._append(f"{qa_id}:feedback", qa_id, 'feedback', time.time(), feedback=feedback)
+
+    def record_delete(self, qa_id):
+        """
+        Q&A を履歴から除外する削除イベントを追記する関数
+        """
+        self._append(f"{qa_id}:delete", qa_id, 'delete', time.time())
+
+    def is_empty(self):
+        """
+        イベントが1件も記録されていないかどうかを返す関数
+        """
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM events LIMIT 1").fetchone() is None
+
+    # ---------------------------
+    # Incremental Aggregates
+    # ---------------------------
+    def _create_aggregates(self):
+        """
+        管理者ページの集計を保持するテーブルを作成する関数。
+        各イベントの追記と同じトランザクションで差分を加算するため、表示時にイベント全体を走査しない。
+        テーブルがない場合（以前のバージョンのデータベース）はイベントから1回だけ作り直す。
+        """
+        self._conn.create_function('normalize_question', 1, normalize_question, deterministic=True)
+        self._conn.create_function('latency_bucket', 1, _latency_bucket, deterministic=True)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT PRIMARY KEY,
+                questions INTEGER NOT NULL DEFAULT 0,
+                yes INTEGER NOT NULL DEFAULT 0,
+                no INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS entry_stats (
+                entry TEXT PRIMARY KEY,
+                asked INTEGER NOT NULL DEFAULT 0,
+                yes INTEGER NOT NULL DEFAULT 0,
+                no INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS question_stats (
+                normalized TEXT PRIMARY KEY,
+                question TEXT,
+                asked INTEGER NOT NULL DEFAULT 0,
+                no INTEGER NOT NULL DEFAULT 0,
+                unmatched INTEGER NOT NULL DEFAULT 0,
+                unanswered INTEGER NOT NULL DEFAULT 0,
+                last_asked REAL
+            );
+            CREATE INDEX IF NOT EXISTS question_stats_unanswered ON question_stats (unanswered, asked);
+            CREATE INDEX IF NOT EXISTS question_stats_asked ON question_stats (asked);
+            CREATE TABLE IF NOT EXISTS latency_stats (
+                day TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, bucket)
+            ) WITHOUT ROWID;
+            """
+        )
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'aggregates_version'").fetchone()
+        if row is None or int(row[0]) != AGGREGATES_VERSION:
+            self.rebuild_aggregates()
+
+    def rebuild_aggregates(self):
+        """
+        削除されていないイベントから集計テーブルを作り直す関数
+        """
+        live = "NOT EXISTS (SELECT 1 FROM events d WHERE d.qa_id = {0}.qa_id AND d.kind = 'delete')"
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table in ('daily_stats', 'entry_stats', 'question_stats', 'latency_stats'):
+                    self._conn.execute(f"DELETE FROM {table}")
+                self._conn.execute(
+                    f"""
+                    INSERT INTO daily_stats (day, questions)
+                    SELECT strftime('%Y-%m-%d', q.created_at, 'unixepoch'), COUNT(*) FROM events q
+                    WHERE q.kind = 'question' AND {live.format('q')}
+                    GROUP BY 1
+                    """
+                )
+                self._conn.execute(
+                    f"""
+                    INSERT INTO daily_stats (day, yes, no)
+                    SELECT strftime('%Y-%m-%d', f.created_at, 'unixepoch'),
+                           COUNT(CASE WHEN f.feedback = 'Yes' THEN 1 END), COUNT(CASE WHEN f.feedback = 'No' THEN 1 END)
+                    FROM events f
+                    WHERE f.kind = 'feedback' AND {live.format('f')}
+                    GROUP BY 1
+                    ON CONFLICT(day) DO UPDATE SET yes = excluded.yes, no = excluded.no
+                    """
+                )
+                self._conn.execute(
+                    f"""
+                    INSERT INTO entry_stats (entry, asked, yes, no)
+                    SELECT q.entry, COUNT(*),
+                           COUNT(CASE WHEN f.feedback = 'Yes' THEN 1 END), COUNT(CASE WHEN f.feedback = 'No' THEN 1 END)
+                    FROM events q LEFT JOIN events f ON f.qa_id = q.qa_id AND f.kind = 'feedback'
+                    WHERE q.kind = 'question' AND q.entry IS NOT NULL AND q.entry != '' AND {live.format('q')}
+                    GROUP BY q.entry
+                    """
+                )
+                self._conn.execute(
+                    f"""
+                    INSERT INTO question_stats (normalized, question, asked, no, unmatched, unanswered, last_asked)
+                    SELECT normalized, question, asked, no, unmatched, no + unmatched, last_asked FROM (
+                        SELECT normalize_question(q.question) AS normalized, q.question AS question,
+                               MAX(q.created_at) AS last_asked, COUNT(*) AS asked,
+                               COUNT(CASE WHEN f.feedback = 'No' THEN 1 END) AS no,
+                               COUNT(CASE WHEN q.entry = '' THEN 1 END) AS unmatched
+                        FROM events q LEFT JOIN events f ON f.qa_id = q.qa_id AND f.kind = 'feedback'
+                        WHERE q.kind = 'question' AND {live.format('q')}
+                        GROUP BY 1
+                    ) WHERE normalized != ''
+                    """
+                )
+                self._conn.execute(
+                    f"""
+                    INSERT INTO latency_stats (day, bucket, count)
+                    SELECT strftime('%Y-%m-%d', q.created_at, 'unixepoch'), latency_bucket(q.latency), COUNT(*)
+                    FROM events q
+                    WHERE q.kind = 'question' AND q.latency IS NOT NULL AND {live.format('q')}
+                    GROUP BY 1, 2
+                    """
+                )
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('aggregates_version', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (str(AGGREGATES_VERSION),),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _update_aggregates(self, kind, qa_id, created_at, question, feedback, source, entry, latency):
+        """
+        追記したイベントの分だけ集計テーブルを更新する関数（_append のトランザクション内で呼び出す）
+        """
+        if kind == 'question':
+            # 他のプロセスから削除が先に届いていた Q&A は集計しない
+            if not self._conn.execute("SELECT 1 FROM events WHERE qa_id = ? AND kind = 'delete'", (qa_id,)).fetchone():
+                self._count_question(created_at, question, entry, latency, 1)
+            return
+        asked = self._conn.execute(
+            "SELECT created_at, question, entry, latency FROM events WHERE qa_id = ? AND kind = 'question'", (qa_id,)
+        ).fetchone()
+        if kind == 'feedback':
+            # 削除済みの Q&A へのフィードバックは集計しない
+            if self._conn.execute("SELECT 1 FROM events WHERE qa_id = ? AND kind = 'delete'", (qa_id,)).fetchone():
+                return
+            self._count_feedback(created_at, feedback, asked, 1)
+        elif kind == 'delete':
+            # 削除した Q&A の質問とフィードバックの分を差し引く
+            rated = self._conn.execute(
+                "SELECT created_at, feedback FROM events WHERE qa_id = ? AND kind = 'feedback'", (qa_id,)
+            ).fetchone()
+            if asked is not None:
+                self._count_question(*asked, -1)
+            if rated is not None:
+                self._count_feedback(rated[0], rated[1], asked, -1)
+
+    def _count_question(self, created_at, question, entry, latency, sign):
+        day = _day(created_at)
+        self._conn.execute(
+            "INSERT INTO daily_stats (day, questions) VALUES (?, ?) "
+            "ON CONFLICT(day) DO UPDATE SET questions = questions + excluded.questions",
+            (day, sign),
+        )
+        if entry:
+            self._conn.execute(
+                "INSERT INTO entry_stats (entry, asked) VALUES (?, ?) "
+                "ON CONFLICT(entry) DO UPDATE SET asked = asked + excluded.asked",
+                (entry, sign),
+            )
+        normalized = normalize_question(question)
+        if normalized:
+            unmatched = sign if entry == '' else 0
+            self._conn.execute(
+                """
+                INSERT INTO question_stats (normalized, question, asked, unmatched, unanswered, last_asked)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(normalized) DO UPDATE SET
+                    question = CASE WHEN excluded.last_asked >= last_asked THEN excluded.question ELSE question END,
+                    last_asked = MAX(last_asked, excluded.last_asked),
+                    asked = asked + excluded.asked,
+                    unmatched = unmatched + excluded.unmatched,
+                    unanswered = unanswered + excluded.unanswered
+                """,
+                (normalized, question, sign, unmatched, unmatched, created_at),
+            )
+        if latency is not None:
+            self._conn.execute(
+                "INSERT INTO latency_stats (day, bucket, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(day, bucket) DO UPDATE SET count = count + excluded.count",
+                (day, _latency_bucket(latency), sign),
+            )
+
+    def _count_feedback(self, created_at, feedback, asked, sign):
+        yes = sign if feedback == 'Yes' else 0
+        no = sign if feedback == 'No' else 0
+        self._conn.execute(
+            "INSERT INTO daily_stats (day, yes, no) VALUES (?, ?, ?) "
+            "ON CONFLICT(day) DO UPDATE SET yes = yes + excluded.yes, no = no + excluded.no",
+            (_day(created_at), yes, no),
+        )
+        if asked is None:
+            return
+        _, question, entry, _ = asked
+        if entry:
+            self._conn.execute(
+                "INSERT INTO entry_stats (entry, yes, no) VALUES (?, ?, ?) "
+                "ON CONFLICT(entry) DO UPDATE SET yes = yes + excluded.yes, no = no + excluded.no",
+                (entry, yes, no),
+            )
+        normalized = normalize_question(question)
+        if normalized and no:
+            self._conn.execute(
+                "UPDATE question_stats SET no = no + ?, unanswered = unanswered + ? WHERE normalized = ?",
+                (no, no, normalized),
+            )
+
+    # ---------------------------
+    # Analytics
+    # ---------------------------
+    def daily_stats(self, since=None):
+        """
+        日ごと（UTC）の質問数・フィードバック数と Helpful の割合をデータフレームで返す関数（since は UNIX 時刻）
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, questions, yes, no FROM daily_stats WHERE day >= ? ORDER BY day",
+                (_day(since) if since is not None else '',),
+            ).fetchall()
+        data = pd.DataFrame(rows, columns=['day', 'questions', 'yes', 'no'])
+        rated = data['yes'] + data['no']
+        data['helpful_ratio'] = (data['yes'] / rated).where(rated > 0)
+        data['day'] = pd.to_datetime(data['day'])
+        return data
+
+    def entry_stats(self, min_feedback=1, limit=20):
+        """
+        マニュアル行ごとの質問数・フィードバック数を Helpful の割合が低い順に返す関数（フィードバックが min_feedback 件以上の行のみ）
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT entry, asked, yes, no, CAST(yes AS REAL) / (yes + no) AS ratio FROM entry_stats
+                WHERE yes + no >= MAX(?, 1)
+                ORDER BY ratio, no DESC LIMIT ?
+                """,
+                (min_feedback, limit),
+            ).fetchall()
+        return pd.DataFrame(rows, columns=['entry', 'asked', 'yes', 'no', 'helpful_ratio'])
+
+    def unanswered_questions(self, limit=20):
+        """
+        「No」と評価された回数とマニュアルに該当がなかった回数の多い質問を返す関数
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT question, asked, no, unmatched, last_asked FROM question_stats
+                WHERE unanswered > 0
+                ORDER BY unanswered DESC, asked DESC LIMIT ?
+                """,
+                (limit,),
+            ).fetchall()
+        data = pd.DataFrame(rows, columns=['question', 'asked', 'not_helpful', 'no_match', 'last_asked'])
+        data['last_asked'] = pd.to_datetime(data['last_asked'], unit='s', utc=True)
+        return data
+
+    def popular_questions(self, limit=20):
+        """
+        質問された回数の多い質問（正規化した質問ごとに最新の表記）を多い順に返す関数
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT question, asked FROM question_stats WHERE asked > 0 ORDER BY asked DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return pd.DataFrame(rows, columns=['question', 'asked'])
+
+    def latency_stats(self, since=None, percentiles=(50, 95, 99)):
+        """
+        回答までの時間のパーセンタイルを、期間全体 (辞書) と日ごと (データフレーム) で返す関数。
+        値はバケットの上限で近似する。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, bucket, count FROM latency_stats WHERE day >= ? AND count > 0 ORDER BY day, bucket",
+                (_day(since) if since is not None else '',),
+            ).fetchall()
+        total = {}
+        by_day = {}
+        for day, bucket, count in rows:
+            total[bucket] = total.get(bucket, 0) + count
+            by_day.setdefault(day, {})[bucket] = count
+        overall = dict(zip((f"p{p}" for p in percentiles), _bucket_percentiles(total, percentiles)))
+        trend = pd.DataFrame(
+            [[day, *_bucket_percentiles(counts, percentiles)] for day, counts in by_day.items()],
+            columns=['day'] + [f"p{p}" for p in percentiles],
+        )
+        trend['day'] = pd.to_datetime(trend['day'])
+        return overall, trend
+
+    # ---------------------------
+    # Materialization
+    # ---------------------------
+    def history(self):
+        """
+        削除されていない Q&A を、最新のフィードバックと合わせて古い順のデータフレームで返す関数
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                _HISTORY_SELECT + """
+                WHERE q.kind = 'question'
+                  AND NOT EXISTS (SELECT 1 FROM events d WHERE d.qa_id = q.qa_id AND d.kind = 'delete')
+                ORDER BY q.created_at, q.seq
+                """
+            ).fetchall()
+        return self._to_dataframe(rows)
+
+    @staticmethod
+    def _to_dataframe(rows):
+        data = pd.DataFrame(rows, columns=HISTORY_COLUMNS)
+        data['feedback'] = data['feedback'].astype(object).where(data['feedback'].notna(), pd.NA)
+        for column in ('asked_at', 'feedback_at'):
+            data[column] = pd.to_datetime(data[column], unit='s', utc=True)
+        return data
+
+    def query_history(self, user_id=None, feedback=None, text=None, since=None, until=None, limit=20, offset=0):
+        """
+        条件に一致する Q&A を新しい順に1ページ分取得し、(データフレーム, 該当件数) を返す関数。
+        feedback には 'Yes'、'No'、NOT_RATED のいずれか、since / until には UNIX 時刻を指定する。
+        """
+        conditions = [
+            "q.kind = 'question'",
+            "NOT EXISTS (SELECT 1 FROM events d WHERE d.qa_id = q.qa_id AND d.kind = 'delete')",
+        ]
+        params = []
+        if user_id is not None:
+            conditions.append("q.user_id = ?")
+            params.append(user_id)
+        if since is not None:
+            conditions.append("q.created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("q.created_at < ?")
+            params.append(until)
+        if feedback == NOT_RATED:
+            conditions.append("f.feedback IS NULL")
+        elif feedback:
+            conditions.append("f.feedback = ?")
+            params.append(feedback)
+        if text:
+            if self._fts and len(text) >= 3:
+                conditions.append("q.seq IN (SELECT rowid FROM events_fts WHERE events_fts MATCH ?)")
+                params.append('"' + text.replace('"', '""') + '"')
+            else:
+                pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                conditions.append("(q.question LIKE ? ESCAPE '\\' OR q.answer LIKE ? ESCAPE '\\')")
+                params.extend([pattern, pattern])
+        where = " WHERE " + " AND ".join(conditions)
+        with self._lock:
+            total = self._conn.execute(
+                "SELECT COUNT(*) FROM events q LEFT JOIN events f ON f.qa_id = q.qa_id AND f.kind = 'feedback'" + where,
+                params,
+            ).fetchone()[0]
+            rows = self._conn.execute(
+                _HISTORY_SELECT + where + " ORDER BY q.created_at DESC, q.seq DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return self._to_dataframe(rows), total
+
+    def question_count(self):
+        """
+        削除されていない Q&A の件数を返す関数（集計テーブルから取得する）
+        """
+        with self._lock:
+            return int(self._conn.execute("SELECT TOTAL(questions) FROM daily_stats").fetchone()[0])
+
+    def feedback_counts(self):
+        """
+        削除されていない Q&A のフィードバック値ごとの件数を辞書で返す関数（集計テーブルから取得する）
+        """
+        with self._lock:
+            yes, no = self._conn.execute("SELECT TOTAL(yes), TOTAL(no) FROM daily_stats").fetchone()
+        return {'Yes': int(yes), 'No': int(no)}
+
+    def export_frame(self):
+        """
+        feedback.csv に書き出す内容をデータフレームで返す関数。
+        時刻は UNIX 時刻（秒）のまま書き出し、読み込み直しても値が変わらないようにする。
+        行の順序はイベントの内容のみで決まるため、同じイベントを持つプロセスは同じ内容を書き出す。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                _EXPORT_SELECT + """
+                WHERE q.kind = 'question'
+                  AND NOT EXISTS (SELECT 1 FROM events d WHERE d.qa_id = q.qa_id AND d.kind = 'delete')
+                ORDER BY q.created_at, q.qa_id
+                """
+            ).fetchall()
+            tombstones = self._conn.execute(
+                """
+                SELECT qa_id, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, created_at FROM events
+                WHERE kind = 'delete' ORDER BY created_at, qa_id
+                """
+            ).fetchall()
+        return pd.DataFrame(rows + tombstones, columns=EXPORT_COLUMNS)
+
+    def to_csv_bytes(self):
+        """
+        履歴を feedback.csv 形式の UTF-8 バイト列として書き出す関数
+        """
+        buffer = io.StringIO()
+        self.export_frame().to_csv(buffer, index=False)
+        return buffer.getvalue().encode('utf-8')
+
+    def export_csv(self, path):
+        """
+        履歴を CSV ファイルに書き出す関数（一時ファイルに書いてから置き換える）
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.to_csv_bytes())
+        os.replace(tmp_path, path)
+
+    # ---------------------------
+    # Migration
+    # ---------------------------
+    def import_legacy_csv(self, path):
+        """
+        以前の形式の feedback.csv（question, answer, feedback[, source]）をイベントとして取り込む関数。
+        行の内容から ID を決めるため、同じファイルを複数回取り込んでも重複しない。
+        """
+        data = _read_feedback_csv(path)
+        imported = 0
+        now = time.time()
+        # 取り込み済みのイベントは書き込みを省略する（他のプロセスの feedback.csv を繰り返し取り込む場合に備える）
+        with self._lock:
+            existing = {row[0] for row in self._conn.execute("SELECT event_id FROM events")}
+        for position, row in enumerate(data.to_dict('records')):
+            if 'qa_id' in row and isinstance(row['qa_id'], str):
+                qa_id = row['qa_id']
+            else:
+                content = f"{position}\x1f{row.get('question')}\x1f{row.get('answer')}"
+                qa_id = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            deleted_at = _timestamp(row.get('deleted_at'))
+            if deleted_at is not None:
+                # 他のプロセスで削除された Q&A（削除のイベントのみを取り込む）
+                if f"{qa_id}:delete" not in existing:
+                    self._append(f"{qa_id}:delete", qa_id, 'delete', deleted_at)
+                continue
+            asked_at = _timestamp(row.get('asked_at'))
+            created_at = asked_at if asked_at is not None else now + position * 1e-6
+            source = row.get('source') if pd.notna(row.get('source')) else 'llm'
+            user_id = row.get('user_id') if pd.notna(row.get('user_id')) else None
+            variant = row.get('variant') if pd.notna(row.get('variant')) else None
+            if qa_id not in existing and self._append(
+                qa_id, qa_id, 'question', created_at,
+                question=row.get('question'), answer=row.get('answer'), source=source, user_id=user_id,
+                variant=variant,
+            ):
+                imported += 1
+            if pd.notna(row.get('feedback')) and f"{qa_id}:feedback" not in existing:
+                feedback_at = _timestamp(row.get('feedback_at'))
+                self._append(f"{qa_id}:feedback", qa_id, 'feedback',
+                             feedback_at if feedback_at is not None else created_at,
+                             feedback=row['feedback'])
+        return imported
+
+    def merge_csv(self, path):
+        """
+        他のプロセスが書き出した feedback.csv のイベント（削除を含む）を取り込み、
+        (取り込んだ質問の件数, ファイルにないイベントがあるか) を返す関数。
+        ファイルにないイベントがある場合は、このプロセスの履歴を書き出して送り返す必要がある。
+        """
+        imported = self.import_legacy_csv(path)
+        remote = _read_feedback_csv(path)
+        if 'qa_id' not in remote.columns:
+            return imported, True
+        return imported, bool(_exported_events(self.export_frame()) - _exported_events(remote))
+
+
+def _day(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def _latency_bucket(seconds):
+    return bisect.bisect_left(LATENCY_BUCKETS, seconds)
+
+
+def _bucket_percentiles(counts, percentiles):
+    """
+    バケットごとの件数からパーセンタイルを計算する関数（各値はバケットの上限。上限を超えるバケットは最大の境界値とする）
+    """
+    total = sum(counts.values())
+    values = []
+    for p in percentiles:
+        if not total:
+            values.append(None)
+            continue
+        target = p / 100 * total
+        cumulative = 0
+        for bucket in sorted(counts):
+            cumulative += counts[bucket]
+            if cumulative >= target:
+                values.append(LATENCY_BUCKETS[min(bucket, len(LATENCY_BUCKETS) - 1)])
+                break
+    return values
+
+
+def _read_feedback_csv(path):
+    # 書き出した UNIX 時刻が読み込み直しても変わらないよう、浮動小数点数は厳密に読み込む
+    try:
+        return pd.read_csv(path, encoding='utf-8', float_precision='round_trip')
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=EXPORT_COLUMNS)
+
+
+def _timestamp(value):
+    """
+    feedback.csv の時刻（UNIX 時刻、または以前の形式の日時の文字列）を UNIX 時刻に変換する関数（空の場合は None）
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return pd.to_datetime(value, utc=True).timestamp()
+
+
+def _exported_events(data):
+    """
+    feedback.csv の行が表すイベントの ID の集合を返す関数（削除された Q&A は削除のイベントのみ）
+    """
+    events = set()
+    deleted = data['deleted_at'] if 'deleted_at' in data.columns else pd.Series([None] * len(data), dtype=object)
+    for qa_id, feedback, deleted_at in zip(data['qa_id'], data['feedback'], deleted):
+        if _timestamp(deleted_at) is not None:
+            events.add(f"{qa_id}:delete")
+            continue
+        events.add(qa_id)
+        if feedback is not None and not pd.isna(feedback):
+            events.add(f"{qa_id}:feedback")
+    return events
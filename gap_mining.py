@@ -0,0 +1,192 @@
+"""
+「No」と評価された質問とマニュアルに該当がなかった質問を MinHash/LSH で近い質問ごとにまとめ、
+件数の多い順に並べて JSON に書き出すバッチ処理（管理者ページはこの結果を読み込んで新しい Q&A の下書きを表示する）。
+
+    python gap_mining.py --output gap_clusters.json --threshold 0.5
+
+質問は FeedbackStore の集計テーブル（正規化した質問ごとの件数）から読み込むため、ログの件数ではなく
+異なる質問の数に比例した時間で処理できる。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+
+import numpy as np
+
+import config
+from normalize import normalize_question
+from feedback_store import FeedbackStore
+
+# -------------------------------
+# MinHash / LSH
+# -------------------------------
+# ハッシュ関数の係数に使うメルセンヌ素数（2^31 - 1）
+_PRIME = (1 << 31) - 1
+
+DEFAULT_NUM_PERM = 64
+DEFAULT_BANDS = 16
+DEFAULT_SHINGLE_SIZE = 3
+DEFAULT_THRESHOLD = 0.5
+
+
+def shingles(text, size=DEFAULT_SHINGLE_SIZE):
+    """
+    正規化した質問を文字 n-gram に分割し、各 n-gram のハッシュ値（31ビット）の配列を返す関数
+    """
+    normalized = normalize_question(text)
+    grams = {normalized[i:i + size] for i in range(max(1, len(normalized) - size + 1))}
+    return np.fromiter((zlib.crc32(g.encode('utf-8')) % _PRIME for g in grams), dtype=np.int64, count=len(grams))
+
+
+def minhash_signatures(texts, num_perm=DEFAULT_NUM_PERM, shingle_size=DEFAULT_SHINGLE_SIZE, seed=1, chunk_size=50000):
+    """
+    全ての質問の MinHash シグネチャ（質問数 × num_perm の配列）を計算する関数。
+    n-gram のハッシュ値を1つの配列に連結し、ハッシュ関数ごとの最小値を np.minimum.reduceat でまとめて求める。
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _PRIME, size=(num_perm, 1), dtype=np.int64)
+    b = rng.integers(0, _PRIME, size=(num_perm, 1), dtype=np.int64)
+    hashed = [shingles(text, shingle_size) for text in texts]
+    signatures = np.empty((len(texts), num_perm), dtype=np.int64)
+    # 連結した配列が大きくなりすぎないよう、質問を区切って計算する
+    start = 0
+    while start < len(hashed):
+        end = start
+        total = 0
+        while end < len(hashed) and (total == 0 or total + len(hashed[end]) <= chunk_size):
+            total += len(hashed[end])
+            end += 1
+        values = np.concatenate(hashed[start:end])
+        offsets = np.cumsum([0] + [len(h) for h in hashed[start:end - 1]])
+        permuted = (a * values[np.newaxis, :] + b) % _PRIME
+        signatures[start:end] = np.minimum.reduceat(permuted, offsets, axis=1).T
+        start = end
+    return signatures
+
+
+def cluster(signatures, bands=DEFAULT_BANDS, threshold=DEFAULT_THRESHOLD):
+    """
+    LSH（シグネチャを bands 個の帯に分け、いずれかの帯が一致する質問を候補とする）で近い質問をまとめ、
+    各質問のクラスター番号の配列を返す関数。候補はシグネチャの一致率（Jaccard 類似度の推定値）が
+    threshold 以上の場合のみ同じクラスターとする。類似した質問が連鎖して無関係な質問までまとまらないよう、
+    クラスター同士は代表（最初の質問）のシグネチャも threshold 以上一致する場合のみ統合する。
+    """
+    count, num_perm = signatures.shape
+    rows = num_perm // bands
+    parent = np.arange(count)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        block = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+        # 同じ帯の値を持つ質問が隣り合うよう並べ替え、各グループの先頭の質問と比較する
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], count]
+        for group_start, group_end in zip(starts, ends):
+            if group_end - group_start < 2:
+                continue
+            members = order[group_start:group_end]
+            head = members[0]
+            similarity = (signatures[members[1:]] == signatures[head]).mean(axis=1)
+            for member in members[1:][similarity >= threshold]:
+                root_a, root_b = find(head), find(member)
+                if root_a != root_b and (signatures[root_a] == signatures[root_b]).mean() >= threshold:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+    return np.array([find(i) for i in range(count)])
+
+
+# -------------------------------
+# Gap Mining
+# -------------------------------
+def mine_gaps(questions, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM, bands=DEFAULT_BANDS, max_examples=10):
+    """
+    FeedbackStore.unanswered_questions のデータフレームから近い質問のクラスターを作り、
+    件数（「No」の評価と該当なしの回数の合計）の多い順のリストを返す関数
+    """
+    if questions.empty:
+        return []
+    questions = questions.reset_index(drop=True)
+    signatures = minhash_signatures(questions['question'].tolist(), num_perm=num_perm)
+    labels = cluster(signatures, bands=bands, threshold=threshold)
+    questions = questions.assign(
+        cluster=labels, weight=questions['not_helpful'] + questions['no_match'],
+    )
+    clusters = []
+    for _, members in questions.groupby('cluster', sort=False):
+        members = members.sort_values(['weight', 'asked'], ascending=False)
+        representative = members.iloc[0]
+        clusters.append({
+            'question': representative['question'],
+            'size': len(members),
+            'weight': int(members['weight'].sum()),
+            'asked': int(members['asked'].sum()),
+            'not_helpful': int(members['not_helpful'].sum()),
+            'no_match': int(members['no_match'].sum()),
+            'last_asked': members['last_asked'].max().isoformat(),
+            'examples': members['question'].head(max_examples).tolist(),
+        })
+    clusters.sort(key=lambda c: (-c['weight'], -c['asked']))
+    for rank, item in enumerate(clusters, start=1):
+        item['id'] = f"gap-{rank}-{zlib.crc32(normalize_question(item['question']).encode('utf-8')):08x}"
+    return clusters
+
+
+def run(store, output_path, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM, bands=DEFAULT_BANDS, limit=None):
+    """
+    FeedbackStore から未解決の質問を読み込んでクラスターを作り、JSON に書き出して結果を返す関数
+    """
+    start = time.perf_counter()
+    questions = store.unanswered_questions(limit=-1)
+    clusters = mine_gaps(questions, threshold=threshold, num_perm=num_perm, bands=bands)
+    if limit:
+        clusters = clusters[:limit]
+    result = {
+        'generated_at': time.time(),
+        'seconds': round(time.perf_counter() - start, 3),
+        'questions': len(questions),
+        'threshold': threshold,
+        'clusters': clusters,
+    }
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, output_path)
+    return result
+
+
+def load_result(path):
+    """
+    書き出した結果を読み込む関数（まだない場合は None）
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', default=config.GAP_MINING_PATH, help='結果を書き出す JSON ファイル')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='同じクラスターとする Jaccard 類似度')
+    parser.add_argument('--num-perm', type=int, default=DEFAULT_NUM_PERM, help='MinHash のハッシュ関数の数')
+    parser.add_argument('--bands', type=int, default=DEFAULT_BANDS, help='LSH の帯の数（num-perm の約数）')
+    parser.add_argument('--limit', type=int, default=200, help='書き出すクラスターの最大数（0 の場合は全て）')
+    args = parser.parse_args()
+    result = run(FeedbackStore(config.FEEDBACK_DB_PATH), args.output, threshold=args.threshold,
+                 num_perm=args.num_perm, bands=args.bands, limit=args.limit)
+    print(f"{result['questions']} question(s) -> {len(result['clusters'])} cluster(s) in {result['seconds']}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+import functools
+import os
+
+# -------------------------------
+# OpenAI Client
+# -------------------------------
+class LLMError(Exception):
+    """
+    OpenAI への問い合わせに失敗した場合に送出される例外
+    """
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai():
+    """
+    openai モジュールを初回使用時にのみ読み込み、API キーを設定して返す関数（プロセスごとに1回のみ実行）
+    """
+    import openai
+
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    return openai
+
+
+# -------------------------------
+# Prompt
+# -------------------------------
+MODEL = "gpt-4o"
+
+SYSTEM_PROMPT = (
+    "You are an assistant who answers the user's questions based solely on the provided manual."
+    " Please answer in the same language as the user's question."
+    " Do not provide information not included in the manual, but use the knowledge from the manual to answer flexibly."
+)
+
+
+# -------------------------------
+# Completion
+# -------------------------------
+@functools.lru_cache(maxsize=None)
+def get_dispatcher():
+    """
+    OpenAI への問い合わせを行う非同期ディスパッチャーを返す関数（プロセスごとに1つ）
+    """
+    import config
+    from llm_dispatcher import LLMDispatcher
+
+    return LLMDispatcher(
+        MODEL,
+        requests_per_minute=config.OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute=config.OPENAI_TOKENS_PER_MINUTE,
+        max_concurrency=config.OPENAI_MAX_CONCURRENCY,
+        timeout=config.OPENAI_TIMEOUT_SECONDS,
+        max_retries=config.OPENAI_MAX_RETRIES,
+    )
+
+
+def complete(messages):
+    """
+    OpenAI に問い合わせ、回答全文を返す関数
+    """
+    return get_dispatcher().complete(messages)
+
+
+def stream_completion(messages):
+    """
+    OpenAI のストリーミング API に問い合わせ、生成されたテキストの断片を順に返すジェネレーター
+    """
+    return get_dispatcher().stream(messages)
@@ -0,0 +1,293 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+import aiohttp
+
+import metrics
+from llm import LLMError, get_openai
+from retrieval import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# ストリーミングの終了を表す値
+_STREAM_END = object()
+
+
+# -------------------------------
+# Rate Limiting
+# -------------------------------
+class TokenBucket:
+    """
+    1分あたりの上限（capacity_per_minute）に合わせて補充されるトークンバケット
+    """
+
+    def __init__(self, capacity_per_minute):
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        """
+        指定量が使用可能になるまで待ってから消費する関数（上限を超える量は上限として扱う）
+        """
+        amount = min(float(amount), self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+# -------------------------------
+# Stream Sharing
+# -------------------------------
+class _StreamBroadcast:
+    """
+    実行中のストリーミングの問い合わせの断片を、同じメッセージを待つ全ての呼び出し元に配信するクラス。
+    途中から加わった呼び出し元には、それまでに生成された断片を先に渡す。
+    """
+
+    def __init__(self):
+        self.future = None
+        self.waiters = 0
+        self._tokens = []
+        self._subscribers = []
+        self._done = False
+        self._lock = threading.Lock()
+
+    def publish(self, token):
+        with self._lock:
+            self._tokens.append(token)
+            for subscriber in self._subscribers:
+                subscriber.put(token)
+
+    def finish(self, _future=None):
+        with self._lock:
+            self._done = True
+            for subscriber in self._subscribers:
+                subscriber.put(_STREAM_END)
+
+    def subscribe(self):
+        tokens = queue.Queue()
+        with self._lock:
+            for token in self._tokens:
+                tokens.put(token)
+            if self._done:
+                tokens.put(_STREAM_END)
+            self._subscribers.append(tokens)
+        return tokens
+
+
+def _message_key(messages):
+    return hashlib.sha1(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# -------------------------------
+# Async Dispatcher
+# -------------------------------
+def _is_retryable(error):
+    openai = get_openai()
+    if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                          openai.error.Timeout, openai.error.APIConnectionError, openai.error.TryAgain,
+                          asyncio.TimeoutError)):
+        return True
+    status = getattr(error, 'http_status', None)
+    return isinstance(error, openai.error.APIError) and (status is None or status >= 500)
+
+
+class LLMDispatcher:
+    """
+    プロセスで1つのイベントループ上で OpenAI への問い合わせを非同期に実行するディスパッチャー。
+    接続を共有する HTTP セッション、RPM/TPM のトークンバケット、同時実行数の上限、
+    429/5xx に対するジッター付きの再試行、リクエストごとのタイムアウトを備える。
+    同じメッセージへの同時の問い合わせは1回の API 呼び出しにまとめる（ストリーミングでは断片を全ての呼び出し元に配信する）。
+    """
+
+    def __init__(self, model, requests_per_minute=500, tokens_per_minute=30000, max_concurrency=20,
+                 timeout=60.0, max_retries=3, backoff_seconds=1.0, completion_token_estimate=500):
+        self.model = model
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.completion_token_estimate = completion_token_estimate
+        self._in_flight = {}
+        self._in_flight_streams = {}
+        self._in_flight_lock = threading.Lock()
+        self._closed = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='llm-dispatcher', daemon=True)
+        self._thread.start()
+        self._run(self._setup(requests_per_minute, tokens_per_minute, max_concurrency)).result()
+        atexit.register(self.close)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def _setup(self, requests_per_minute, tokens_per_minute, max_concurrency):
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_concurrency))
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+
+    def close(self):
+        """
+        HTTP セッションを閉じ、イベントループを停止する関数
+        """
+        with self._in_flight_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._run(self._session.close()).result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    # ---------------------------
+    # Request Execution
+    # ---------------------------
+    async def _call(self, messages, stream, on_token=None):
+        openai = get_openai()
+        # openai ライブラリが共有セッションを使うように、タスクごとに設定する
+        openai.aiosession.set(self._session)
+        prompt_tokens = sum(count_tokens(m['content']) for m in messages)
+        emitted = []
+        if on_token is not None:
+            def on_token(token, forward=on_token):
+                emitted.append(True)
+                forward(token)
+        for attempt in range(self.max_retries + 1):
+            await self._request_bucket.acquire(1)
+            await self._token_bucket.acquire(prompt_tokens + self.completion_token_estimate)
+            try:
+                async with self._semaphore:
+                    # request_timeout（aiohttp の total）がストリームの読み込みを含む全体の時間を制限する
+                    with metrics.span('openai_request', stream=str(stream).lower()):
+                        text, usage = await self._request(openai, messages, stream, on_token)
+            except Exception as e:
+                # ストリーミングで既に表示したトークンがある場合は重複するため再試行しない
+                if attempt == self.max_retries or emitted or not _is_retryable(e):
+                    metrics.increment('openai_requests_total', outcome='error')
+                    raise
+                metrics.increment('openai_requests_total', outcome='retry')
+                delay = self.backoff_seconds * (2 ** attempt) * (0.5 + random.random())
+                logger.warning("OpenAI request failed (%s); retrying in %.1fs", e, delay)
+                await asyncio.sleep(delay)
+                continue
+            metrics.increment('openai_requests_total', outcome='success')
+            # usage が返されなかった場合（互換 API など）は推定値を記録する
+            estimated = 'true' if usage is None else 'false'
+            if usage is None:
+                usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': count_tokens(text)}
+            metrics.increment('openai_tokens_total', usage['prompt_tokens'], kind='prompt', estimated=estimated)
+            metrics.increment('openai_tokens_total', usage['completion_tokens'], kind='completion', estimated=estimated)
+            return text
+
+    async def _request(self, openai, messages, stream, on_token):
+        """
+        1回の API 呼び出しを行い、回答全文と usage（返されなかった場合は None）を返す関数
+        """
+        start = time.perf_counter()
+        if not stream:
+            response = await openai.ChatCompletion.acreate(
+                model=self.model, messages=messages, request_timeout=self.timeout
+            )
+            return response['choices'][0]['message']['content'], response.get('usage')
+        response = await openai.ChatCompletion.acreate(
+            model=self.model, messages=messages, stream=True, request_timeout=self.timeout,
+            stream_options={'include_usage': True},
+        )
+        text = ""
+        usage = None
+        async for chunk in response:
+            # include_usage を指定すると、最後の断片（choices が空）に usage が含まれる
+            if chunk.get('usage'):
+                usage = chunk['usage']
+            choices = chunk.get('choices') or []
+            content = choices[0].get('delta', {}).get('content') if choices else None
+            if content:
+                if not text:
+                    metrics.observe('openai_first_token_seconds', time.perf_counter() - start)
+                text += content
+                on_token(content)
+        return text, usage
+
+    # ---------------------------
+    # Public API (called from Streamlit threads)
+    # ---------------------------
+    def complete(self, messages):
+        """
+        回答全文を返す関数。同じメッセージの問い合わせが実行中の場合はその結果を共有する。
+        呼び出し元が中断された場合（セッション終了など）、他に待っている呼び出し元がなければ取り消す。
+        """
+        key = _message_key(messages)
+        with self._in_flight_lock:
+            if key in self._in_flight:
+                future, waiters = self._in_flight[key]
+                self._in_flight[key] = (future, waiters + 1)
+            else:
+                future = self._run(self._call(messages, stream=False))
+                self._in_flight[key] = (future, 1)
+        try:
+            return future.result(self.timeout * (self.max_retries + 1))
+        except LLMError:
+            raise
+        except Exception as e:
+            if isinstance(e, get_openai().error.OpenAIError) or isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+                raise LLMError(str(e) or type(e).__name__) from e
+            raise
+        finally:
+            with self._in_flight_lock:
+                future, waiters = self._in_flight[key]
+                if waiters == 1:
+                    del self._in_flight[key]
+                    future.cancel()
+                else:
+                    self._in_flight[key] = (future, waiters - 1)
+
+    def stream(self, messages):
+        """
+        生成されたテキストの断片を順に返すジェネレーター。同じメッセージの問い合わせが実行中の場合はその断片を共有する。
+        ジェネレーターが途中で閉じられた場合（セッション終了など）、他に待っている呼び出し元がなければ問い合わせを取り消す。
+        """
+        key = _message_key(messages)
+        with self._in_flight_lock:
+            broadcast = self._in_flight_streams.get(key)
+            if broadcast is None:
+                broadcast = _StreamBroadcast()
+                broadcast.future = self._run(self._call(messages, stream=True, on_token=broadcast.publish))
+                broadcast.future.add_done_callback(broadcast.finish)
+                self._in_flight_streams[key] = broadcast
+            broadcast.waiters += 1
+        tokens = broadcast.subscribe()
+        try:
+            while True:
+                token = tokens.get(timeout=self.timeout * (self.max_retries + 1))
+                if token is _STREAM_END:
+                    break
+                yield token
+            broadcast.future.result()
+        except queue.Empty as e:
+            raise LLMError("Timed out while waiting for the OpenAI stream.") from e
+        except (asyncio.TimeoutError, TimeoutError) as e:
+            raise LLMError("Timed out while waiting for the OpenAI stream.") from e
+        except Exception as e:
+            if isinstance(e, get_openai().error.OpenAIError):
+                raise LLMError(str(e)) from e
+            raise
+        finally:
+            with self._in_flight_lock:
+                broadcast.waiters -= 1
+                if broadcast.waiters == 0:
+                    del self._in_flight_streams[key]
+                    broadcast.future.cancel()
@@ -0,0 +1,342 @@
+import codecs
+import csv
+import io
+import json
+import os
+import sqlite3
+from collections import namedtuple
+
+import pandas as pd
+
+from normalize import normalize_question
+from manual_store import MANUAL_COLUMNS, append_rows
+
+# -------------------------------
+# Bulk Import / Export of the Manual
+# -------------------------------
+SUPPORTED_FORMATS = ('csv', 'xlsx', 'jsonl')
+
+ImportResult = namedtuple(
+    'ImportResult',
+    ['data', 'added', 'removed', 'inserted', 'updated', 'unchanged', 'duplicates', 'errors', 'error_count'],
+)
+
+
+class ImportFormatError(Exception):
+    """
+    ファイル全体を読み込めない場合（形式の誤り、必須列の不足、openpyxl の未インストールなど）に送出される例外
+    """
+
+
+def detect_format(file_name):
+    """
+    ファイル名の拡張子から形式（csv / xlsx / jsonl）を判定する関数
+    """
+    extension = os.path.splitext(file_name)[1].lower().lstrip('.')
+    if extension == 'json':
+        extension = 'jsonl'
+    if extension not in SUPPORTED_FORMATS:
+        raise ImportFormatError(f"Unsupported file type: .{extension} (use {', '.join(SUPPORTED_FORMATS)})")
+    return extension
+
+
+# ---------------------------
+# Streaming Readers
+# ---------------------------
+def _check_columns(columns):
+    missing = [c for c in ('question', 'answer') if c not in columns]
+    if missing:
+        raise ImportFormatError(f"Missing required column(s): {', '.join(missing)}")
+
+
+def _chunk(records, columns, line_numbers):
+    # インデックスに元のファイルの行番号を持たせ、読み飛ばした行があってもエラーの行番号がずれないようにする
+    return pd.DataFrame(records, columns=columns, index=pd.Index(line_numbers, dtype='int64'))
+
+
+def _iter_csv(file, chunk_size, errors):
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text, strict=True)
+    try:
+        header = next(reader, None)
+        if header is None:
+            raise ImportFormatError("The CSV file is empty.")
+        columns = [c.strip() for c in header]
+        _check_columns(columns)
+        records = []
+        line_numbers = []
+        line_number = reader.line_num + 1
+        for fields in reader:
+            if fields and len(fields) != len(columns):
+                errors.append((line_number, f"Malformed CSV line ({','.join(fields)[:200]})"))
+            elif fields:
+                records.append(fields)
+                line_numbers.append(line_number)
+                if len(records) >= chunk_size:
+                    yield _chunk(records, columns, line_numbers)
+                    records = []
+                    line_numbers = []
+            # 引用符内の改行を含む行は複数行にまたがるため、次の行の開始位置は reader.line_num から求める
+            line_number = reader.line_num + 1
+        if records:
+            yield _chunk(records, columns, line_numbers)
+    except csv.Error as e:
+        raise ImportFormatError(f"Failed to parse the CSV file at line {line_number}: {e}") from e
+    except UnicodeDecodeError as e:
+        raise ImportFormatError(f"Failed to parse the CSV file: {e}") from e
+    finally:
+        # アップロードされたファイル自体は閉じない
+        text.detach()
+
+
+def _iter_jsonl(file, chunk_size, errors):
+    records = []
+    line_numbers = []
+    try:
+        for line_number, line in enumerate(codecs.getreader('utf-8-sig')(file), start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("each line must be a JSON object")
+            except ValueError as e:
+                errors.append((line_number, f"Invalid JSON ({e})"))
+                continue
+            records.append(record)
+            line_numbers.append(line_number)
+            if len(records) >= chunk_size:
+                yield _chunk(records, MANUAL_COLUMNS, line_numbers)
+                records = []
+                line_numbers = []
+    except UnicodeDecodeError as e:
+        raise ImportFormatError(f"Failed to decode the JSONL file as UTF-8: {e}") from e
+    if records:
+        yield _chunk(records, MANUAL_COLUMNS, line_numbers)
+
+
+def _iter_xlsx(file, chunk_size, errors):
+    try:
+        import openpyxl
+    except ImportError as e:
+        raise ImportFormatError("Importing .xlsx files requires the openpyxl package.") from e
+    try:
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    except Exception as e:
+        raise ImportFormatError(f"Failed to open the Excel file: {e}") from e
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(c).strip() if c is not None else '' for c in header]
+        _check_columns(columns)
+        records = []
+        line_numbers = []
+        for row_number, row in enumerate(rows, start=2):
+            values = list(row[:len(columns)]) + [None] * (len(columns) - len(row))
+            records.append(['' if v is None else str(v) for v in values])
+            line_numbers.append(row_number)
+            if len(records) >= chunk_size:
+                yield _chunk(records, columns, line_numbers)
+                records = []
+                line_numbers = []
+        if records:
+            yield _chunk(records, columns, line_numbers)
+    finally:
+        workbook.close()
+
+
+def iter_chunks(file, fmt, chunk_size, errors):
+    """
+    ファイルを chunk_size 行ずつのデータフレームとして順に返すジェネレーター（ファイル全体は読み込まない）。
+    各データフレームのインデックスは元のファイルの行番号（CSV・Excel は見出しが1行目）。
+    行単位で読み込めなかったものは errors に (行番号, メッセージ) として追加する。
+    """
+    readers = {'csv': _iter_csv, 'jsonl': _iter_jsonl, 'xlsx': _iter_xlsx}
+    return readers[fmt](file, chunk_size, errors)
+
+
+# ---------------------------
+# Validation
+# ---------------------------
+def _text(value):
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ''
+    return str(value).strip()
+
+
+def _parse_priority(value):
+    if _text(value) == '':
+        return None
+    try:
+        number = float(str(value).strip())
+    except ValueError:
+        number = None
+    if number is None or not number.is_integer() or number < 1:
+        raise ValueError(f"priority must be a positive integer (got {value!r})")
+    return int(number)
+
+
+def validate_chunk(chunk):
+    """
+    データフレームの各行を検証し、(正規化した質問, 質問, 回答, 優先度, 行番号) のリストとエラーのリストを返す関数
+    （行番号はデータフレームのインデックスに設定された元のファイルの行番号）
+    """
+    valid = []
+    errors = []
+    if 'priority' not in chunk.columns:
+        chunk = chunk.assign(priority=None)
+    for row_number, question, answer, priority in zip(chunk.index, chunk['question'], chunk['answer'], chunk['priority']):
+        row_number = int(row_number)
+        question = _text(question)
+        answer = _text(answer)
+        if not question or not answer:
+            errors.append((row_number, "Both question and answer are required."))
+            continue
+        try:
+            priority = _parse_priority(priority)
+        except ValueError as e:
+            errors.append((row_number, str(e)))
+            continue
+        normalized = normalize_question(question)
+        if not normalized:
+            errors.append((row_number, "The question has no letters or digits."))
+            continue
+        valid.append((normalized, question, answer, priority, row_number))
+    return valid, errors
+
+
+# ---------------------------
+# Import
+# ---------------------------
+def import_manual(manual_data, file, fmt, chunk_size=1000, progress=None, max_errors=1000):
+    """
+    ファイルを少しずつ読み込んで検証し、正規化した質問で重複を除いてマニュアルに反映する関数。
+    読み込んだ行は一時的な SQLite に格納するため、メモリ使用量はファイルの大きさに依存しない。
+    同じ質問が既存のマニュアルにある場合は回答と優先度を更新し、ない場合は末尾に追加する。
+    ファイル内で質問が重複する場合は後の行を採用する。
+    progress には (読み込んだ割合, 読み込んだ行数) を受け取る関数を渡せる。
+    戻り値の data・added・removed をそのまま save_manual_data に渡して1回で保存する。
+    """
+    errors = []
+    dropped_errors = 0
+    total_size = _file_size(file)
+    staging = sqlite3.connect('')  # ディスク上の一時データベース（接続を閉じると削除される）
+    try:
+        staging.execute(
+            "CREATE TABLE rows (normalized TEXT PRIMARY KEY, question TEXT, answer TEXT, priority INTEGER, row_number INTEGER)"
+        )
+        rows_read = 0
+        valid_count = 0
+        for chunk in iter_chunks(file, fmt, chunk_size, errors):
+            valid, chunk_errors = validate_chunk(chunk)
+            errors.extend(chunk_errors)
+            rows_read += len(chunk)
+            valid_count += len(valid)
+            staging.executemany(
+                """
+                INSERT INTO rows (normalized, question, answer, priority, row_number) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(normalized) DO UPDATE SET
+                    question = excluded.question, answer = excluded.answer,
+                    priority = excluded.priority, row_number = excluded.row_number
+                """,
+                valid,
+            )
+            # メモリに保持するエラーは max_errors 件までとし、それ以降は件数のみ数える
+            if len(errors) > max_errors:
+                dropped_errors += len(errors) - max_errors
+                del errors[max_errors:]
+            if progress is not None:
+                progress(min(1.0, _file_position(file) / total_size) if total_size else 0.0, rows_read)
+        if not rows_read and not errors:
+            raise ImportFormatError("No rows were found in the file.")
+        duplicates = valid_count - staging.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+        result = _merge(manual_data, staging, chunk_size)
+    finally:
+        staging.close()
+    return result._replace(duplicates=duplicates, errors=errors, error_count=len(errors) + dropped_errors)
+
+
+def _merge(manual_data, staging, chunk_size):
+    """
+    一時データベースに格納した行を既存のマニュアルと突き合わせ、新しいデータフレームと差分を作る関数
+    """
+    positions = {}
+    for pos, question in enumerate(manual_data['question']):
+        normalized = normalize_question(question)
+        if normalized:
+            positions.setdefault(normalized, pos)
+    data = manual_data.copy()
+    updated_positions = []
+    new_rows = []
+    unchanged = 0
+    cursor = staging.execute("SELECT normalized, question, answer, priority FROM rows ORDER BY row_number")
+    while True:
+        batch = cursor.fetchmany(chunk_size)
+        if not batch:
+            break
+        for normalized, question, answer, priority in batch:
+            pos = positions.get(normalized)
+            if pos is None:
+                new_rows.append((question, answer, priority))
+                continue
+            current = manual_data.iloc[pos]
+            current_priority = None if pd.isna(current['priority']) else int(current['priority'])
+            if (current['question'], current['answer'], current_priority) == (question, answer, priority):
+                unchanged += 1
+                continue
+            data.iat[pos, data.columns.get_loc('question')] = question
+            data.iat[pos, data.columns.get_loc('answer')] = answer
+            data.iat[pos, data.columns.get_loc('priority')] = pd.NA if priority is None else priority
+            updated_positions.append(pos)
+
+    appended = pd.DataFrame(new_rows, columns=MANUAL_COLUMNS)
+    appended['priority'] = pd.array(appended['priority'].tolist(), dtype='Int64')
+    # 既存の行の ID（インデックス）は変えずに末尾に追加する
+    data = append_rows(data, appended)
+    data['priority'] = data['priority'].astype('Int64')
+    removed = manual_data.iloc[updated_positions][MANUAL_COLUMNS]
+    added = pd.concat([data.iloc[updated_positions][MANUAL_COLUMNS], appended], ignore_index=True)
+    return ImportResult(data, added, removed, len(new_rows), len(updated_positions), unchanged, 0, [], 0)
+
+
+def _file_size(file):
+    try:
+        position = file.tell()
+        file.seek(0, io.SEEK_END)
+        size = file.tell()
+        file.seek(position)
+        return size
+    except (AttributeError, OSError):
+        return 0
+
+
+def _file_position(file):
+    try:
+        return file.tell()
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+# ---------------------------
+# Export
+# ---------------------------
+def export_manual(data, fmt):
+    """
+    マニュアルを指定した形式（csv / xlsx / jsonl）のバイト列に変換する関数
+    """
+    data = data[MANUAL_COLUMNS]
+    if fmt == 'csv':
+        return data.to_csv(index=False).encode('utf-8')
+    if fmt == 'jsonl':
+        return data.to_json(orient='records', lines=True, force_ascii=False).encode('utf-8')
+    if fmt == 'xlsx':
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError as e:
+            raise ImportFormatError("Exporting .xlsx files requires the openpyxl package.") from e
+        buffer = io.BytesIO()
+        data.to_excel(buffer, index=False, engine='openpyxl')
+        return buffer.getvalue()
+    raise ImportFormatError(f"Unsupported export format: {fmt}")
@@ -0,0 +1,466 @@
+import hashlib
+import math
+import sqlite3
+import threading
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from normalize import NORMALIZATION_VERSION, normalize_question
+from retrieval import count_tokens, token_counter_name, tokenize
+
+# -------------------------------
+# Row Hashing
+# -------------------------------
+_VERSION_MODULUS = 2 ** 128
+
+
+def _clean(value):
+    if pd.isna(value):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def row_hash(question, answer, priority):
+    """
+    マニュアル1行の内容からハッシュ値を計算する関数（インデックスのキーとして使用）
+    """
+    content = "\x1f".join([_clean(question), _clean(answer), _clean(priority)])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def question_key(question):
+    """
+    正規化した質問のハッシュ値を返す関数（表記の揺れのみが異なる質問の直接一致に使用。正規化すると空になる場合は None）
+    """
+    normalized = normalize_question(_clean(question))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest() if normalized else None
+
+
+def dataframe_row_hashes(data):
+    """
+    データフレームの各行のハッシュ値をリストで返す関数
+    """
+    return [row_hash(q, a, p) for q, a, p in zip(data['question'], data['answer'], data['priority'])]
+
+
+# -------------------------------
+# On-disk Manual Index
+# -------------------------------
+class ManualIndex:
+    """
+    manual.csv の BM25 転置インデックス（と任意の埋め込みベクトル）を SQLite に保存するクラス。
+    各行は内容のハッシュ値をキーとし、追加・削除された行のみを差分更新する。
+    """
+
+    def __init__(self, path, embedding_backend=None, k1=1.5, b=0.75, mmap_size=256 * 1024 * 1024,
+                 embedding_batch_size=256):
+        self.path = path
+        self.embedding_backend = embedding_backend
+        self.embedding_batch_size = max(1, int(embedding_batch_size))
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                row_hash TEXT PRIMARY KEY,
+                question TEXT,
+                answer TEXT,
+                priority INTEGER,
+                length INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                tokens INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                row_hash TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, row_hash)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_row_hash ON postings (row_hash);
+            CREATE TABLE IF NOT EXISTS vectors (
+                row_hash TEXT PRIMARY KEY,
+                vector BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(docs)")}
+        if 'tokens' not in columns:
+            self._conn.execute("ALTER TABLE docs ADD COLUMN tokens INTEGER")
+        # question_key: 正規化した質問のハッシュ値（直接一致の検索に使用）
+        if 'question_key' not in columns:
+            self._conn.execute("ALTER TABLE docs ADD COLUMN question_key TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS docs_question_key ON docs (question_key)")
+        self._dense_cache = None
+        self._refresh_token_counts()
+        self._refresh_question_keys()
+
+    # ---------------------------
+    # Metadata
+    # ---------------------------
+    def _get_meta(self, key, default):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return type(default)(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self._conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, str(value)),
+        )
+
+    def _refresh_token_counts(self):
+        """
+        トークン数が未計算の行（または数え方が変わった場合は全ての行）のトークン数を計算して保存する関数
+        """
+        with self._lock:
+            counter = token_counter_name()
+            if self._get_meta('token_counter', '') != counter:
+                self._conn.execute("UPDATE docs SET tokens = NULL")
+            rows = self._conn.execute("SELECT row_hash, question, answer FROM docs WHERE tokens IS NULL").fetchall()
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "UPDATE docs SET tokens = ? WHERE row_hash = ?",
+                    [(count_tokens(f"{q}\n{a}"), h) for h, q, a in rows],
+                )
+                self._set_meta('token_counter', counter)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _refresh_question_keys(self):
+        """
+        正規化の方法が変わった場合（または列を追加した場合）に全ての行の question_key を計算し直す関数
+        """
+        with self._lock:
+            if self._get_meta('normalization', 0) == NORMALIZATION_VERSION:
+                return
+            rows = self._conn.execute("SELECT row_hash, question FROM docs").fetchall()
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "UPDATE docs SET question_key = ? WHERE row_hash = ?", [(question_key(q), h) for h, q in rows],
+                )
+                self._set_meta('normalization', NORMALIZATION_VERSION)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def version(self):
+        """
+        マニュアル全体の内容を表すバージョンハッシュを返す関数（行の順序には依存しない）
+        """
+        with self._lock:
+            return format(self._get_meta('version', 0), '032x')
+
+    # ---------------------------
+    # Incremental Updates
+    # ---------------------------
+    def add_rows(self, rows):
+        """
+        データフレームの行をインデックスに追加する関数（同一内容の行は参照数のみ増やす）
+        """
+        if rows.empty:
+            return
+        with self._lock:
+            new_rows = []
+            self._conn.execute("BEGIN")
+            try:
+                num_docs = self._get_meta('num_docs', 0)
+                total_length = self._get_meta('total_length', 0)
+                version = self._get_meta('version', 0)
+                for question, answer, priority in zip(rows['question'], rows['answer'], rows['priority']):
+                    h = row_hash(question, answer, priority)
+                    updated = self._conn.execute(
+                        "UPDATE docs SET count = count + 1 WHERE row_hash = ?", (h,)
+                    ).rowcount
+                    if not updated:
+                        text = f"{_clean(question)}\n{_clean(answer)}"
+                        term_counts = Counter(tokenize(text))
+                        length = sum(term_counts.values())
+                        # プロンプトに含める際のトークン数は、行の内容が変わった（ハッシュが変わった）時のみ計算する
+                        self._conn.execute(
+                            """
+                            INSERT INTO docs (row_hash, question, answer, priority, length, count, tokens, question_key)
+                            VALUES (?, ?, ?, ?, ?, 1, ?, ?)
+                            """,
+                            (h, _clean(question), _clean(answer), None if pd.isna(priority) else int(priority), length,
+                             count_tokens(text), question_key(question)),
+                        )
+                        self._conn.executemany(
+                            "INSERT INTO postings (term, row_hash, tf) VALUES (?, ?, ?)",
+                            [(term, h, tf) for term, tf in term_counts.items()],
+                        )
+                        num_docs += 1
+                        total_length += length
+                        new_rows.append((h, f"{_clean(question)}\n{_clean(answer)}"))
+                    version = (version + int(h, 16)) % _VERSION_MODULUS
+                self._set_meta('num_docs', num_docs)
+                self._set_meta('total_length', total_length)
+                self._set_meta('version', version)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if new_rows and self.embedding_backend is not None:
+                self._store_vectors(new_rows)
+
+    def remove_rows(self, rows):
+        """
+        データフレームの行をインデックスから削除する関数（参照数が0になった行のみ削除する）
+        """
+        if rows.empty:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                num_docs = self._get_meta('num_docs', 0)
+                total_length = self._get_meta('total_length', 0)
+                version = self._get_meta('version', 0)
+                for h in dataframe_row_hashes(rows):
+                    doc = self._conn.execute("SELECT length, count FROM docs WHERE row_hash = ?", (h,)).fetchone()
+                    if doc is None:
+                        continue
+                    length, count = doc
+                    if count > 1:
+                        self._conn.execute("UPDATE docs SET count = count - 1 WHERE row_hash = ?", (h,))
+                    else:
+                        self._conn.execute("DELETE FROM docs WHERE row_hash = ?", (h,))
+                        self._conn.execute("DELETE FROM postings WHERE row_hash = ?", (h,))
+                        self._conn.execute("DELETE FROM vectors WHERE row_hash = ?", (h,))
+                        num_docs -= 1
+                        total_length -= length
+                    version = (version - int(h, 16)) % _VERSION_MODULUS
+                self._set_meta('num_docs', num_docs)
+                self._set_meta('total_length', total_length)
+                self._set_meta('version', version)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._dense_cache = None
+
+    def sync(self, manual_data):
+        """
+        インデックスの内容をデータフレームに合わせる関数（変更された行のみを差分更新する）
+        """
+        with self._lock:
+            wanted = Counter(dataframe_row_hashes(manual_data))
+            stored = Counter(dict(self._conn.execute("SELECT row_hash, count FROM docs").fetchall()))
+            to_add = wanted - stored
+            to_remove = stored - wanted
+            if to_remove:
+                removed = []
+                remove_hashes = list(to_remove)
+                for start in range(0, len(remove_hashes), 500):
+                    chunk = remove_hashes[start:start + 500]
+                    removed.extend(self._conn.execute(
+                        f"SELECT question, answer, priority, row_hash FROM docs WHERE row_hash IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall())
+                removed_rows = pd.DataFrame(
+                    [r[:3] for r in removed for _ in range(to_remove[r[3]])],
+                    columns=['question', 'answer', 'priority'],
+                )
+                self.remove_rows(removed_rows)
+            if to_add:
+                hashes = dataframe_row_hashes(manual_data)
+                positions = []
+                for pos, h in enumerate(hashes):
+                    if to_add[h] > 0:
+                        positions.append(pos)
+                        to_add[h] -= 1
+                self.add_rows(manual_data.iloc[positions])
+            if self.embedding_backend is not None:
+                missing = self._conn.execute(
+                    "SELECT row_hash, question || char(10) || answer FROM docs WHERE row_hash NOT IN (SELECT row_hash FROM vectors)"
+                ).fetchall()
+                if missing:
+                    self._store_vectors(missing)
+
+    def _store_vectors(self, items):
+        # 埋め込みはバッチごとに取得・コミットする（途中で失敗しても保存済みのバッチは次回の sync で再計算しない）
+        for start in range(0, len(items), self.embedding_batch_size):
+            batch = items[start:start + self.embedding_batch_size]
+            vectors = self.embedding_backend.embed([text for _, text in batch])
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO vectors (row_hash, vector) VALUES (?, ?)",
+                    [(h, np.asarray(v, dtype=np.float32).tobytes()) for (h, _), v in zip(batch, vectors)],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._dense_cache = None
+
+    # ---------------------------
+    # Search
+    # ---------------------------
+    def search(self, query, top_k):
+        """
+        BM25 でクエリに対するスコア上位 top_k 件の (行ハッシュ, スコア) を返す関数
+        """
+        term_counts = Counter(tokenize(query))
+        if not term_counts:
+            return []
+        with self._lock:
+            num_docs = self._get_meta('num_docs', 0)
+            if not num_docs:
+                return []
+            avg_length = self._get_meta('total_length', 0) / num_docs
+            terms = list(term_counts)
+            doc_freqs = dict(self._conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({','.join('?' * len(terms))}) GROUP BY term",
+                terms,
+            ).fetchall())
+            rows = self._conn.execute(
+                f"""
+                SELECT p.term, p.row_hash, p.tf, d.length
+                FROM postings p JOIN docs d ON d.row_hash = p.row_hash
+                WHERE p.term IN ({','.join('?' * len(terms))})
+                """,
+                terms,
+            ).fetchall()
+        scores = Counter()
+        for term, h, tf, length in rows:
+            df = doc_freqs[term]
+            idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+            scores[h] += term_counts[term] * idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores.most_common(top_k)
+
+    def match_coverage(self, query, row_hash):
+        """
+        クエリのトークンのうち行に含まれるものの割合を idf で重み付けして返す関数（0〜1）。
+        BM25 のスコアは文字 n-gram が1つでも一致すれば正になるため、関連のない質問を除くのに使用する。
+        """
+        term_counts = Counter(tokenize(query))
+        if not term_counts:
+            return 0.0
+        terms = list(term_counts)
+        placeholders = ','.join('?' * len(terms))
+        with self._lock:
+            num_docs = self._get_meta('num_docs', 0)
+            doc_freqs = dict(self._conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term", terms,
+            ).fetchall())
+            matched = {row[0] for row in self._conn.execute(
+                f"SELECT term FROM postings WHERE row_hash = ? AND term IN ({placeholders})", [row_hash, *terms],
+            )}
+        total = 0.0
+        covered = 0.0
+        for term, count in term_counts.items():
+            df = doc_freqs.get(term, 0)
+            weight = count * math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            total += weight
+            if term in matched:
+                covered += weight
+        return covered / total if total else 0.0
+
+    def dense_search(self, query_vector, top_k):
+        """
+        保存済みの埋め込みベクトルとのコサイン類似度で上位 top_k 件の (行ハッシュ, 類似度) を返す関数
+        """
+        with self._lock:
+            if self._dense_cache is None:
+                items = self._conn.execute("SELECT row_hash, vector FROM vectors").fetchall()
+                if not items:
+                    return []
+                matrix = np.vstack([np.frombuffer(v, dtype=np.float32) for _, v in items])
+                matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+                self._dense_cache = ([h for h, _ in items], matrix)
+            hashes, matrix = self._dense_cache
+        query = np.asarray(query_vector, dtype=np.float32)
+        similarities = matrix @ (query / max(np.linalg.norm(query), 1e-12))
+        order = np.argsort(-similarities)[:top_k]
+        return [(hashes[i], float(similarities[i])) for i in order]
+
+    def direct_match(self, question):
+        """
+        正規化した質問が一致するマニュアル行を探し、(回答, 行ハッシュ) を返す関数。
+        一致する行がない場合と、一致する行の回答が複数に分かれる場合（どれが正しいか判断できない）は None を返す。
+        """
+        key = question_key(question)
+        if key is None:
+            return None
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_hash, answer FROM docs WHERE question_key = ? ORDER BY priority IS NULL, priority, row_hash",
+                (key,),
+            ).fetchall()
+        if not rows or len({answer for _, answer in rows}) > 1:
+            return None
+        return rows[0][1], rows[0][0]
+
+    def get_rows(self, hashes):
+        """
+        行ハッシュのリストに対応するマニュアル行を、指定された順序のデータフレームで返す関数
+        """
+        columns = ['row_hash', 'question', 'answer', 'priority', 'tokens']
+        if not hashes:
+            return pd.DataFrame(columns=columns)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT row_hash, question, answer, priority, tokens FROM docs WHERE row_hash IN ({','.join('?' * len(hashes))})",
+                list(hashes),
+            ).fetchall()
+        by_hash = {r[0]: r for r in rows}
+        return pd.DataFrame([by_hash[h] for h in hashes if h in by_hash], columns=columns)
+
+    def priority_hashes(self, limit):
+        """
+        優先度の高い順に行ハッシュを返す関数（検索結果がない場合の代替として使用）
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_hash FROM docs ORDER BY priority IS NULL, priority LIMIT ?", (limit,)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def priority_rows(self, priority=1):
+        """
+        指定した優先度の行を全て返す関数（FAQ の回答の事前計算に使用する）
+        """
+        columns = ['row_hash', 'question', 'answer', 'priority', 'tokens']
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_hash, question, answer, priority, tokens FROM docs WHERE priority = ? ORDER BY question, row_hash",
+                (priority,),
+            ).fetchall()
+        return pd.DataFrame(rows, columns=columns)
+
+    def prefix_rows(self, token_budget, priority=1):
+        """
+        プロンプトの固定の前置部分に含める行（指定した優先度の行）を、token_budget の範囲で返す関数。
+        順序は行の内容のみで決まるため、マニュアルが変わらない限り同じ結果になる。
+        """
+        columns = ['row_hash', 'question', 'answer', 'priority', 'tokens']
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_hash, question, answer, priority, tokens FROM docs WHERE priority = ? ORDER BY question, answer, row_hash",
+                (priority,),
+            ).fetchall()
+        selected = []
+        used_tokens = 0
+        for row in rows:
+            cost = row[4] + 1
+            if used_tokens + cost > token_budget:
+                break
+            selected.append(row)
+            used_tokens += cost
+        return pd.DataFrame(selected, columns=columns)
@@ -0,0 +1,322 @@
+import threading
+from collections import Counter, namedtuple
+
+import pandas as pd
+
+# -------------------------------
+# Shared Manual Store
+# -------------------------------
+ManualSnapshot = namedtuple('ManualSnapshot', ['version', 'data'])
+
+# 他のプロセスのマニュアルを取り込んだ結果（conflicts は両方で変更された質問、local_changes は取り込み後も
+# Google Drive にない変更が残っているかどうか）
+ManualMerge = namedtuple('ManualMerge', ['snapshot', 'conflicts', 'local_changes'])
+
+
+class ManualVersionConflict(Exception):
+    """
+    編集元のスナップショットより新しいバージョンが既に公開されている場合に送出される例外
+    """
+
+
+class ManualStore:
+    """
+    プロセス内の全セッションで共有するマニュアルのデータフレーム。
+    セッションは読み取り専用のスナップショットを参照し、変更はコピーしたデータを
+    新しいバージョンとして公開する（公開済みのスナップショットは変更しない）。
+    直近 history_size 件のバージョンについて編集・削除した行 ID を保持し、古いスナップショットからの変更の適用し直しに使用する。
+    また、他のプロセスの変更を取り込む際の共通の祖先として、最後に Google Drive と同期した内容を保持する。
+    """
+
+    def __init__(self, data, history_size=100):
+        self._lock = threading.Lock()
+        self._snapshot = ManualSnapshot(1, data)
+        self.history_size = history_size
+        # バージョン番号 -> そのバージョンで編集・削除した行 ID（None は全体の置き換え）
+        self._touched = {}
+        self._synced = data
+
+    def snapshot(self):
+        """
+        現在のスナップショット（バージョン番号とデータフレーム）を返す関数。
+        返されたデータフレームは他のセッションと共有されるため、変更してはならない。
+        """
+        return self._snapshot
+
+    def publish(self, data, base_version, base_data=None, on_publish=None):
+        """
+        変更後のデータフレームを新しいバージョンとして公開し、新しいスナップショットを返す関数。
+        base_data（編集元のスナップショットのデータ）を指定した場合、base_version 以降に他のセッションが公開していても、
+        追加した行と、他のバージョンで変更されていない行の編集・削除を現在のバージョンに適用し直して公開する。
+        base_data を指定しない場合（全体の置き換え）と、同じ行が他のバージョンで編集・削除されていた場合は
+        ManualVersionConflict を送出する。
+        on_publish（manual.csv の書き出しなど）は新しいスナップショットを引数にロックを保持したまま呼ばれるため、
+        同時に保存しても古いバージョンで上書きされない（例外を送出した場合は公開しない）。
+        """
+        with self._lock:
+            current = self._snapshot
+            if base_data is None:
+                touched = None
+                if current.version != base_version:
+                    raise ManualVersionConflict(
+                        f"The manual was modified by another session (version {current.version}, edited from {base_version})."
+                    )
+            else:
+                deleted, edited, appended = _diff_rows(base_data, data)
+                touched = frozenset(deleted) | frozenset(edited.index)
+                if current.version != base_version:
+                    others = self._touched_since(base_version, current.version)
+                    if touched and (others is None or touched & others):
+                        raise ManualVersionConflict(
+                            f"The rows you changed were modified by another session "
+                            f"(version {current.version}, edited from {base_version})."
+                        )
+                    # 削除した行の ID を追加した行に使わないよう、削除する前に追加する
+                    data = append_rows(current.data, appended).drop(index=list(deleted))
+                    if not edited.empty:
+                        data.loc[edited.index, MANUAL_COLUMNS] = edited[MANUAL_COLUMNS]
+            return self._commit(data, touched, on_publish)
+
+    def _commit(self, data, touched, on_publish):
+        snapshot = ManualSnapshot(self._snapshot.version + 1, data)
+        if on_publish is not None:
+            on_publish(snapshot)
+        self._snapshot = snapshot
+        self._touched[snapshot.version] = touched
+        self._touched.pop(snapshot.version - self.history_size, None)
+        return snapshot
+
+    def mark_synced(self, data):
+        """
+        Google Drive にアップロードした内容を、次に他のプロセスの変更を取り込む際の共通の祖先として記録する関数
+        """
+        with self._lock:
+            self._synced = data
+
+    def merge_remote(self, remote, on_publish=None):
+        """
+        他のプロセスが Google Drive に書き出したマニュアルを、最後に同期した内容からの差分として現在のバージョンに
+        取り込み、ManualMerge を返す関数。行は内容で照合し、片方でのみ変更された行はその変更を採用する。
+        両方で同じ行を追加した場合は1つにまとめ、両方で変更された質問は両方の内容を残して conflicts に返す。
+        内容が変わらない行の ID はそのまま使う。on_publish は publish と同様にロック内で呼ばれる。
+        """
+        with self._lock:
+            current = self._snapshot
+            base_counts = Counter(_row_keys(self._synced))
+            remote_keys = _row_keys(remote)
+            remote_counts = Counter(remote_keys)
+            current_keys = _row_keys(current.data)
+            current_counts = Counter(current_keys)
+
+            target = {}
+            # 質問ごとの各行の増減（両方で同じ変更をした場合は競合としない）
+            local_deltas = {}
+            remote_deltas = {}
+            for key in base_counts.keys() | remote_counts.keys() | current_counts.keys():
+                b, r, c = base_counts[key], remote_counts[key], current_counts[key]
+                if c != b:
+                    local_deltas.setdefault(key[0], {})[key] = c - b
+                if r != b:
+                    remote_deltas.setdefault(key[0], {})[key] = r - b
+                if r == b:
+                    target[key] = c
+                elif c == b or (r > b and c > b and r > c) or (r < b and c < b and r < c):
+                    target[key] = r
+                else:
+                    target[key] = c
+
+            if current_counts == base_counts:
+                # ローカルに未同期の変更がない場合は、他のプロセスの内容を行の順序も含めてそのまま使う
+                available = {}
+                for row_id, key in zip(current.data.index, current_keys):
+                    available.setdefault(key, []).append(row_id)
+                next_id = int(current.data.index.max()) + 1 if len(current.data.index) else 0
+                ids = []
+                for key in remote_keys:
+                    if available.get(key):
+                        ids.append(available[key].pop(0))
+                    else:
+                        ids.append(next_id)
+                        next_id += 1
+                data = remote.copy()
+                data.index = pd.Index(ids)
+                touched = frozenset(row_id for row_ids in available.values() for row_id in row_ids)
+            else:
+                remaining = {key: current_counts[key] - count for key, count in target.items() if current_counts[key] > count}
+                dropped = []
+                for row_id, key in zip(reversed(current.data.index), reversed(current_keys)):
+                    if remaining.get(key):
+                        dropped.append(row_id)
+                        remaining[key] -= 1
+                missing = {key: count - current_counts[key] for key, count in target.items() if count > current_counts[key]}
+                positions = []
+                for position, key in enumerate(remote_keys):
+                    if missing.get(key):
+                        positions.append(position)
+                        missing[key] -= 1
+                # 削除した行の ID を追加した行に使わないよう、削除する前に追加する
+                data = append_rows(current.data, remote.iloc[positions][MANUAL_COLUMNS]).drop(index=dropped)
+                touched = frozenset(dropped)
+
+            self._synced = remote
+            snapshot = current
+            if Counter(_row_keys(data)) != current_counts or not data.index.equals(current.data.index):
+                snapshot = self._commit(data, touched, on_publish)
+            conflicts = sorted(
+                question for question in local_deltas.keys() & remote_deltas.keys()
+                if local_deltas[question] != remote_deltas[question]
+            )
+            return ManualMerge(snapshot, conflicts, Counter(_row_keys(snapshot.data)) != remote_counts)
+
+    def _touched_since(self, base_version, current_version):
+        touched = set()
+        for version in range(base_version + 1, current_version + 1):
+            rows = self._touched.get(version)
+            if rows is None:
+                # 全体が置き換えられた、または履歴が残っていないバージョン
+                return None
+            touched |= rows
+        return touched
+
+
+def read_manual_csv(path):
+    """
+    manual.csv を読み込み、priority 列を欠損値を許容する Int64 型にしたデータフレームを返す関数
+    """
+    data = pd.read_csv(path, encoding='utf-8')
+    if 'priority' in data.columns:
+        data['priority'] = pd.to_numeric(data['priority'], errors='coerce').astype('Int64')
+    else:
+        # 'priority' 列がない場合は追加（全てNaN）
+        data['priority'] = pd.Series([pd.NA] * len(data), dtype='Int64')
+    return data
+
+
+# -------------------------------
+# Changesets
+# -------------------------------
+# 行 ID はスナップショットのデータフレームのインデックス（プロセス内で行が削除・追加されても変わらない）
+MANUAL_COLUMNS = ['question', 'answer', 'priority']
+
+ManualChangeset = namedtuple(
+    'ManualChangeset', ['data', 'added', 'removed', 'inserted', 'updated', 'deleted', 'errors'],
+)
+
+
+def append_rows(data, rows):
+    """
+    既存の行の ID を変えずに、新しい行に続きの ID を割り当てて末尾に追加したデータフレームを返す関数
+    """
+    if rows.empty:
+        return data
+    start = int(data.index.max()) + 1 if len(data.index) else 0
+    rows = rows.reindex(columns=data.columns if len(data.columns) else MANUAL_COLUMNS)
+    rows.index = pd.RangeIndex(start, start + len(rows))
+    rows['priority'] = pd.to_numeric(rows['priority'], errors='coerce').astype('Int64')
+    if data.empty:
+        return rows
+    data = data.assign(priority=pd.to_numeric(data['priority'], errors='coerce').astype('Int64'))
+    # 列の型を揃えてから結合する（全て欠損値の列があると、結合後の型の決め方が pandas のバージョンで変わるため）
+    return pd.concat([data, rows.astype(data.dtypes.to_dict())])
+
+
+def _cell_text(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ''
+    return str(value).strip()
+
+
+def _cell_priority(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)) or _cell_text(value) == '':
+        return pd.NA
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = None
+    if number is None or not number.is_integer() or number < 1:
+        raise ValueError(f"priority must be a positive integer (got {value!r})")
+    return int(number)
+
+
+def _row_keys(data):
+    """
+    各行の内容を比較用のタプル (質問, 回答, 優先度) のリストで返す関数
+    """
+    return [
+        (_cell_text(question), _cell_text(answer), None if pd.isna(priority) else int(priority))
+        for question, answer, priority in zip(data['question'], data['answer'], data['priority'])
+    ]
+
+
+def _diff_rows(base, data):
+    """
+    編集元と変更後のデータフレームを行 ID で比較し、(削除した行 ID, 編集した行, 追加した行) を返す関数
+    """
+    common = base.index.intersection(data.index)
+    changed = pd.Series(False, index=common)
+    for column in MANUAL_COLUMNS:
+        before = base.loc[common, column]
+        after = data.loc[common, column]
+        changed |= ~((before == after).fillna(False).astype(bool) | (before.isna() & after.isna()))
+    deleted = base.index.difference(data.index)
+    return list(deleted), data.loc[changed[changed].index], data.loc[~data.index.isin(base.index)]
+
+
+def build_changeset(data, edited, shown_ids):
+    """
+    編集用の表（'id' 列に元の行 ID、新しい行は空）と元のデータを比較し、変更を1回で保存するための変更内容を返す関数。
+    shown_ids は表に表示していた行の ID で、表にない ID の行は削除されたものとする。
+    戻り値の data・added・removed をそのまま save_manual_data に渡す。errors がある場合は保存しない。
+    """
+    errors = []
+    updated = {}
+    inserted = []
+    seen = set()
+    for position, (row_id, question, answer, priority) in enumerate(
+        zip(edited['id'], edited['question'], edited['answer'], edited['priority']), start=1,
+    ):
+        is_new = row_id is None or pd.isna(row_id)
+        label = f"New row {position}" if is_new else f"Row {int(row_id)}"
+        question = _cell_text(question)
+        answer = _cell_text(answer)
+        # 追加したまま何も入力していない行は無視する
+        if is_new and not question and not answer and _cell_text(priority) == '':
+            continue
+        if not question or not answer:
+            errors.append((label, "Both question and answer are required."))
+            continue
+        try:
+            priority = _cell_priority(priority)
+        except ValueError as e:
+            errors.append((label, str(e)))
+            continue
+        if is_new:
+            inserted.append((question, answer, priority))
+            continue
+        row_id = int(row_id)
+        seen.add(row_id)
+        if row_id not in data.index:
+            errors.append((label, "The row no longer exists."))
+            continue
+        current = data.loc[row_id]
+        current_priority = pd.NA if pd.isna(current['priority']) else int(current['priority'])
+        if (current['question'], current['answer']) != (question, answer) or (
+            pd.isna(current_priority) != pd.isna(priority)
+            or (not pd.isna(priority) and current_priority != priority)
+        ):
+            updated[row_id] = (question, answer, priority)
+    deleted = [row_id for row_id in shown_ids if row_id not in seen and row_id in data.index]
+
+    # 削除した行の ID を追加した行に使わないよう、削除する前に追加する
+    result = append_rows(data, pd.DataFrame(inserted, columns=MANUAL_COLUMNS)).drop(index=deleted)
+    for row_id, (question, answer, priority) in updated.items():
+        result.loc[row_id, ['question', 'answer']] = [question, answer]
+        result.loc[row_id, 'priority'] = priority
+    result['priority'] = result['priority'].astype('Int64')
+
+    changed = list(updated)
+    added = result.loc[changed, MANUAL_COLUMNS]
+    if inserted:
+        added = pd.concat([added, result.iloc[len(result) - len(inserted):][MANUAL_COLUMNS]])
+    removed = data.loc[changed + deleted, MANUAL_COLUMNS]
+    return ManualChangeset(result, added, removed, len(inserted), len(updated), len(deleted), errors)
@@ -0,0 +1,227 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+
+import numpy as np
+
+# -------------------------------
+# Metrics Registry
+# -------------------------------
+# 処理時間のヒストグラムの境界（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = 'qa_bot_'
+STAGE_HISTOGRAM = 'stage_duration_seconds'
+
+# 実行中のスパン名（スレッドと asyncio のタスクごとに独立する）
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+_span_logger = logging.getLogger('qa_bot.spans')
+_span_logger.propagate = False
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics:
+    """
+    プロセス内のカウンターとヒストグラムを保持するクラス。
+    ヒストグラムは Prometheus 形式の累積バケットに加えて、管理者ページの表示用に直近の値も保持する。
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, recent_samples=1000):
+        self.buckets = tuple(buckets)
+        self.recent_samples = recent_samples
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, amount=1, **labels):
+        """
+        カウンターに加算する関数
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        ヒストグラムに値を記録する関数
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(self.buckets),
+                    'sum': 0.0,
+                    'count': 0,
+                    'recent': deque(maxlen=self.recent_samples),
+                }
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            histogram['recent'].append(value)
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """
+        with ブロックの処理時間を stage ごとのヒストグラムに記録するコンテキストマネージャー。
+        ログが有効な場合は、親のスパン名とともに1行の JSON として書き出す。
+        """
+        parent = _current_span.get()
+        token = _current_span.set(stage)
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _current_span.reset(token)
+            self.observe(STAGE_HISTOGRAM, elapsed, stage=stage, **labels)
+            if _span_logger.handlers:
+                _span_logger.info(json.dumps({
+                    'time': time.time(), 'stage': stage, 'parent': parent, 'seconds': round(elapsed, 6),
+                    'error': error, **labels,
+                }, ensure_ascii=False))
+
+    # ---------------------------
+    # Export
+    # ---------------------------
+    def counters(self):
+        """
+        カウンターの一覧（name, labels, value）を返す関数
+        """
+        with self._lock:
+            return [
+                {'name': name, 'labels': dict(key), 'value': value}
+                for (name, key), value in sorted(self._counters.items())
+            ]
+
+    def histograms(self):
+        """
+        ヒストグラムの一覧（件数、平均、直近の値によるパーセンタイル）を返す関数
+        """
+        with self._lock:
+            items = [
+                (name, key, histogram['count'], histogram['sum'], list(histogram['recent']))
+                for (name, key), histogram in sorted(self._histograms.items())
+            ]
+        summaries = []
+        for name, key, count, total, recent in items:
+            p50, p95, p99 = np.percentile(recent, [50, 95, 99]) if recent else (None, None, None)
+            summaries.append({
+                'name': name, 'labels': dict(key), 'count': count, 'mean': total / count if count else None,
+                'p50': p50, 'p95': p95, 'p99': p99,
+            })
+        return summaries
+
+    def recent(self, name, **labels):
+        """
+        ヒストグラムに記録された直近の値のリストを返す関数
+        """
+        with self._lock:
+            histogram = self._histograms.get((name, _label_key(labels)))
+            return list(histogram['recent']) if histogram else []
+
+    def render_prometheus(self):
+        """
+        全てのメトリクスを Prometheus のテキスト形式で返す関数
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = [
+                (name, key, list(h['buckets']), h['sum'], h['count'])
+                for (name, key), h in sorted(self._histograms.items())
+            ]
+        declared = set()
+        for (name, key), value in counters:
+            full_name = PREFIX + name
+            if full_name not in declared:
+                lines.append(f"# TYPE {full_name} counter")
+                declared.add(full_name)
+            lines.append(f"{full_name}{_format_labels(key)} {value}")
+        for name, key, buckets, total, count in histograms:
+            full_name = PREFIX + name
+            if full_name not in declared:
+                lines.append(f"# TYPE {full_name} histogram")
+                declared.add(full_name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                lines.append(f"{full_name}_bucket{_format_labels(key, [('le', repr(bound))])} {cumulative}")
+            lines.append(f"{full_name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{full_name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{full_name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+# -------------------------------
+# Exporters
+# -------------------------------
+def start_http_server(registry, port, host='0.0.0.0'):
+    """
+    /metrics で Prometheus 形式のメトリクスを返す HTTP サーバーをバックグラウンドスレッドで起動する関数
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+def enable_span_log(path, max_bytes=10 * 1024 * 1024, backup_count=5):
+    """
+    スパンを1行ずつ JSON で書き出すローテーションログを有効にする関数
+    """
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _span_logger.addHandler(handler)
+    _span_logger.setLevel(logging.INFO)
+    return handler
+
+
+# プロセス全体で共有するレジストリ
+REGISTRY = Metrics()
+span = REGISTRY.span
+increment = REGISTRY.increment
+observe = REGISTRY.observe
@@ -0,0 +1,24 @@
+import re
+import unicodedata
+
+# -------------------------------
+# Question Normalization
+# -------------------------------
+# 正規化の方法を変更した場合に増やす（正規化した質問を保存しているストアは起動時に作り直す）
+NORMALIZATION_VERSION = 2
+
+_IGNORED_PATTERN = re.compile(r"[\s\W_]+")
+
+# カタカナ（ァ〜ヶ）を対応するひらがなに置き換える変換表
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord('ァ'), ord('ヶ') + 1)}
+
+
+def normalize_question(text):
+    """
+    表記の揺れを無視して質問を比較するために、質問テキストを正規化する関数
+    （NFKC 正規化による全角・半角の統一、小文字化、カタカナのひらがなへの統一、空白・記号の除去）
+    """
+    if not isinstance(text, str):
+        return ''
+    text = unicodedata.normalize('NFKC', text).lower().translate(_KATAKANA_TO_HIRAGANA)
+    return _IGNORED_PATTERN.sub('', text)
@@ -0,0 +1,143 @@
+import threading
+
+import retrieval
+from llm import SYSTEM_PROMPT, LLMError
+
+# -------------------------------
+# Prompt Builder
+# -------------------------------
+# メッセージごとに加算されるおおよそのトークン数（役割名や区切り）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+USER_TEMPLATE = "Manual:\n{manual_text}\n\nUser's question:\n{question}"
+
+# 会話の要約をプロンプトに含める場合のシステムメッセージ
+SUMMARY_TEMPLATE = "Summary of the earlier conversation with this user:\n{summary}"
+
+# 会話の古いターンを要約する際の指示文
+SUMMARIZE_PROMPT = (
+    "Summarize the conversation below between a user and an assistant that answers questions about a manual."
+    " Keep the facts, names and open questions the user may refer to later, in the language of the conversation,"
+    " in at most 150 words."
+)
+
+
+class PromptTooLongError(LLMError):
+    """
+    質問を含めたプロンプトがトークン数の上限に収まらない場合に送出される例外
+    """
+
+
+class PromptBuilder:
+    """
+    OpenAI に送るメッセージをトークン数の予算内で組み立てるクラス。
+    システムメッセージには指示文と優先度1の行（固定の前置部分）を内容のみで決まる順序で含め、
+    マニュアルが変わらない限りバイト単位で同一にする（プロバイダー側のプロンプトキャッシュを効かせるため）。
+    質問ごとに変わる行はユーザーメッセージに含める。
+    """
+
+    def __init__(self, index, top_k, token_budget, prefix_token_budget, max_prompt_tokens, min_match_coverage=0.0):
+        self.index = index
+        self.min_match_coverage = min_match_coverage
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.prefix_token_budget = prefix_token_budget
+        self.max_prompt_tokens = max_prompt_tokens
+        self._lock = threading.Lock()
+        self._prefix = None
+
+    def _system_prefix(self):
+        """
+        マニュアルのバージョンごとに1回だけシステムメッセージを組み立て、
+        (システムメッセージ, 前置部分に含めた行ハッシュ, トークン数) を返す関数
+        """
+        version = self.index.version()
+        with self._lock:
+            if self._prefix is not None and self._prefix[0] == version:
+                return self._prefix[1:]
+        content = SYSTEM_PROMPT
+        rows = self.index.prefix_rows(self.prefix_token_budget) if self.prefix_token_budget > 0 else None
+        if rows is not None and not rows.empty:
+            content += "\n\nFrequently asked entries from the manual:\n" + retrieval.format_manual_text(rows)
+            hashes = frozenset(rows['row_hash'])
+        else:
+            hashes = frozenset()
+        prefix = (version, content, hashes, retrieval.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS)
+        with self._lock:
+            self._prefix = prefix
+        return prefix[1:]
+
+    def retrieve(self, question, use_embeddings=True):
+        """
+        固定の前置部分に含まれない行から、質問に関連する行を予算内で選択する関数
+        """
+        _, prefix_hashes, _ = self._system_prefix()
+        return retrieval.retrieve(
+            self.index,
+            question,
+            top_k=self.top_k,
+            token_budget=self.token_budget,
+            use_embeddings=use_embeddings,
+            exclude=prefix_hashes,
+            min_match_coverage=self.min_match_coverage,
+        )
+
+    def build(self, question, rows, history=None):
+        """
+        システムメッセージ、会話の履歴、選択された行、質問からメッセージを組み立てる関数。
+        history には ConversationStore.context の (要約, ターン) を渡す。
+        上限を超える場合は古いターン、要約、関連度の低い行の順に外し、
+        質問だけでも超える場合は PromptTooLongError を送出する。
+        """
+        system_content, _, system_tokens = self._system_prefix()
+        question_tokens = (
+            retrieval.count_tokens(USER_TEMPLATE.format(manual_text="", question=question)) + MESSAGE_OVERHEAD_TOKENS
+        )
+        available = self.max_prompt_tokens - system_tokens - question_tokens
+        if available < 0:
+            raise PromptTooLongError(
+                f"The question is too long ({question_tokens} tokens; the limit is {self.max_prompt_tokens} including the manual)."
+            )
+        history_messages, history_tokens = self._history_messages(history, available)
+        available -= history_tokens
+        costs = (rows['tokens'] + 1).cumsum()
+        rows = rows[(costs <= available).to_numpy()]
+        return [
+            {"role": "system", "content": system_content},
+            *history_messages,
+            {"role": "user", "content": USER_TEMPLATE.format(manual_text=retrieval.format_manual_text(rows), question=question)}
+        ]
+
+    @staticmethod
+    def _history_messages(history, available):
+        """
+        会話の履歴をメッセージに変換し、(メッセージ, トークン数) を返す関数（available を超える分は古い方から外す）
+        """
+        summary, turns = history or (None, [])
+        turns = list(turns)
+        turn_costs = [turn['tokens'] + 2 * MESSAGE_OVERHEAD_TOKENS for turn in turns]
+        summary_content = SUMMARY_TEMPLATE.format(summary=summary) if summary else None
+        summary_tokens = retrieval.count_tokens(summary_content) + MESSAGE_OVERHEAD_TOKENS if summary else 0
+        while turns and summary_tokens + sum(turn_costs) > available:
+            turns.pop(0)
+            turn_costs.pop(0)
+        if summary_tokens > available:
+            summary_content, summary_tokens = None, 0
+        messages = [{"role": "system", "content": summary_content}] if summary_content else []
+        for turn in turns:
+            messages.append({"role": "user", "content": turn['question']})
+            messages.append({"role": "assistant", "content": turn['answer']})
+        return messages, summary_tokens + sum(turn_costs)
+
+    @staticmethod
+    def summary_messages(summary, turns):
+        """
+        これまでの要約と新しいターンから、更新した要約を生成するためのメッセージを組み立てる関数
+        """
+        lines = [f"Previous summary:\n{summary}\n"] if summary else []
+        for turn in turns:
+            lines.append(f"User: {turn['question']}\nAssistant: {turn['answer']}")
+        return [
+            {"role": "system", "content": SUMMARIZE_PROMPT},
+            {"role": "user", "content": "\n\n".join(lines)},
+        ]
@@ -0,0 +1,203 @@
+import functools
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+
+import pandas as pd
+
+# -------------------------------
+# Tokenization
+# -------------------------------
+# 日本語は分かち書きされないため、文字 n-gram をトークンとして使用する
+NGRAM_SIZES = (1, 2)
+
+# 英数字の連続は単語として扱い、それ以外は文字 n-gram に分割する
+_WORD_PATTERN = re.compile(r"[a-z0-9]+|[^\sa-z0-9]+")
+_PUNCTUATION_PATTERN = re.compile(r"[\s\W_]+")
+
+
+def tokenize(text):
+    """
+    テキストを BM25 用のトークン（英数字の単語と文字 n-gram）に分割する関数
+    """
+    if not isinstance(text, str) or not text:
+        return []
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for chunk in _WORD_PATTERN.findall(text):
+        if chunk[0].isascii() and chunk[0].isalnum():
+            tokens.append(chunk)
+            continue
+        chunk = _PUNCTUATION_PATTERN.sub("", chunk)
+        for n in NGRAM_SIZES:
+            tokens.extend(chunk[i:i + n] for i in range(len(chunk) - n + 1))
+    return tokens
+
+
+def estimate_tokens(text):
+    """
+    テキストのおおよそのトークン数を見積もる関数
+    （ASCII は約4文字で1トークン、日本語などは1文字で約1トークンとして計算）
+    """
+    if not isinstance(text, str) or not text:
+        return 0
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+# tiktoken がインストールされている場合に使用するエンコーディング（gpt-4o と同じ）
+TIKTOKEN_ENCODING = "o200k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception:
+        return None
+
+
+def token_counter_name():
+    """
+    count_tokens が使用している数え方の名前を返す関数（保存済みのトークン数の再計算の判定に使用）
+    """
+    return f"tiktoken:{TIKTOKEN_ENCODING}" if _get_encoding() is not None else "estimate"
+
+
+def count_tokens(text):
+    """
+    テキストのトークン数を返す関数（tiktoken がない場合は estimate_tokens による見積もり）
+    """
+    if not isinstance(text, str) or not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+# -------------------------------
+# Embedding Backends
+# -------------------------------
+class EmbeddingBackend:
+    """
+    埋め込みバックエンドの基底クラス（embed を実装して差し替え可能にする）
+    """
+
+    def embed(self, texts):
+        """
+        テキストのリストを埋め込みベクトルのリストに変換する関数
+        """
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """
+    OpenAI Embeddings API を使用する埋め込みバックエンド（テキスト単位で最大 cache_size 件を LRU でキャッシュする）
+    """
+
+    def __init__(self, model, cache_size=1024):
+        self.model = model
+        self.cache_size = max(0, int(cache_size))
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed(self, texts):
+        from llm import get_openai
+
+        found = {}
+        with self._lock:
+            for text in dict.fromkeys(texts):
+                if text in self._cache:
+                    self._cache.move_to_end(text)
+                    found[text] = self._cache[text]
+        missing = [t for t in dict.fromkeys(texts) if t not in found]
+        if missing:
+            response = get_openai().Embedding.create(model=self.model, input=missing)
+            with self._lock:
+                for text, item in zip(missing, response['data']):
+                    found[text] = item['embedding']
+                    if self.cache_size:
+                        self._cache[text] = item['embedding']
+                        self._cache.move_to_end(text)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return [found[t] for t in texts]
+
+
+def get_embedding_backend(name, model, cache_size=1024):
+    """
+    設定名から埋め込みバックエンドを生成する関数（未設定の場合は None を返す）
+    """
+    if not name:
+        return None
+    if name == "openai":
+        return OpenAIEmbeddingBackend(model, cache_size=cache_size)
+    raise ValueError(f"Unknown embedding backend: {name}")
+
+
+# -------------------------------
+# Retrieval
+# -------------------------------
+# 優先度による重み（priority=1 の行は関連度のスコアを1.5倍、2 は1.25倍、…として扱う）
+PRIORITY_WEIGHT = 0.5
+
+
+def retrieve(index, question, top_k, token_budget, use_embeddings=True, exclude=(), min_match_coverage=0.0):
+    """
+    質問に関連するマニュアル行を最大 top_k 件、token_budget の範囲でインデックスから選択し、
+    データフレームとして返す関数。行は関連度の順位と優先度から計算したスコアの高い順に詰め込み、
+    各行のトークン数はインデックスに保存済みの値を使用する。exclude の行（固定の前置部分に含めた行など）は除く。
+    結果の attrs['top_match'] には exclude に関係なく最も関連度の高い行のハッシュを設定する。
+    該当がない場合と、その行に含まれる質問のトークンの割合が min_match_coverage 未満の場合は空文字列とする。
+    """
+    # 候補数を多めに取り、埋め込みがある場合は Reciprocal Rank Fusion で統合する
+    ranked = [h for h, _ in index.search(question, top_k * 3)]
+    if use_embeddings and index.embedding_backend is not None:
+        query_vector = index.embedding_backend.embed([question])[0]
+        dense = [h for h, _ in index.dense_search(query_vector, top_k * 3)]
+        fused = Counter()
+        for ranking in (ranked, dense):
+            for rank, h in enumerate(ranking):
+                fused[h] += 1.0 / (60 + rank)
+        ranked = [h for h, _ in fused.most_common()]
+
+    top_match = ranked[0] if ranked else ''
+    if top_match and min_match_coverage > 0 and index.match_coverage(question, top_match) < min_match_coverage:
+        top_match = ''
+
+    # 該当がない場合は優先度の高い行を使用する
+    if not ranked:
+        ranked = index.priority_hashes(top_k * 3)
+
+    exclude = set(exclude)
+    candidates = index.get_rows([h for h in ranked if h not in exclude])
+    scores = []
+    for rank, priority in enumerate(candidates['priority']):
+        weight = 1.0 if pd.isna(priority) or priority < 1 else 1.0 + PRIORITY_WEIGHT / priority
+        scores.append(weight / (60 + rank))
+    selected = []
+    used_tokens = 0
+    for pos in sorted(range(len(candidates)), key=lambda i: -scores[i]):
+        if len(selected) >= top_k:
+            break
+        # 行の区切りの改行を含めて数える
+        cost = candidates['tokens'].iat[pos] + 1
+        if used_tokens + cost > token_budget:
+            continue
+        selected.append(pos)
+        used_tokens += cost
+    rows = candidates.iloc[selected]
+    rows.attrs['top_match'] = top_match
+    return rows
+
+
+def format_manual_text(rows):
+    """
+    選択されたマニュアル行をプロンプト用のテキストに結合する関数
+    """
+    return "\n".join(rows['question'].fillna('') + "\n" + rows['answer'].fillna(''))
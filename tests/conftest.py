@@ -0,0 +1,7 @@
+import os
+import sys
+
+# リポジトリのルートとフェイクサーバー（tools）を import できるようにする（python -m pytest -q で実行する）
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
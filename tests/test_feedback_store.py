@@ -0,0 +1,84 @@
+import pytest
+
+from feedback_store import FeedbackStore
+
+
+@pytest.fixture
+def stores(tmp_path):
+    local = FeedbackStore(str(tmp_path / 'local.db'))
+    remote = FeedbackStore(str(tmp_path / 'remote.db'))
+    return local, remote
+
+
+def test_merge_csv_is_idempotent(stores, tmp_path):
+    local, remote = stores
+    qa_id = remote.record_question('質問', '回答', 'llm')
+    remote.record_feedback(qa_id, 'Yes')
+    path = str(tmp_path / 'feedback.csv')
+    remote.export_csv(path)
+
+    assert local.merge_csv(path) == (1, False)
+    assert local.merge_csv(path) == (0, False)
+    assert local.question_count() == 1
+    assert local.feedback_counts() == {'Yes': 1, 'No': 0}
+    # 同じイベントを持つプロセスは同じ内容を書き出す
+    assert local.to_csv_bytes() == remote.to_csv_bytes()
+
+
+def test_merge_csv_applies_and_keeps_tombstones(stores, tmp_path):
+    local, remote = stores
+    kept = remote.record_question('残す質問', '回答', 'llm')
+    deleted = remote.record_question('削除する質問', '回答', 'llm')
+    path = str(tmp_path / 'feedback.csv')
+    remote.export_csv(path)
+    local.merge_csv(path)
+
+    remote.record_delete(deleted)
+    remote.export_csv(path)
+    local.merge_csv(path)
+    local.merge_csv(path)
+
+    assert local.history()['qa_id'].tolist() == [kept]
+    assert local.question_count() == 1
+    exported = local.export_frame()
+    tombstones = exported[exported['deleted_at'].notna()]
+    assert tombstones['qa_id'].tolist() == [deleted]
+
+
+def test_merge_csv_does_not_resurrect_deleted_rows(stores, tmp_path):
+    local, remote = stores
+    qa_id = remote.record_question('質問', '回答', 'llm')
+    path = str(tmp_path / 'feedback.csv')
+    remote.export_csv(path)
+    local.merge_csv(path)
+    local.record_delete(qa_id)
+
+    # 削除を知らないプロセスの古い feedback.csv を取り込んでも削除したままで、送り返す必要がある
+    imported, has_local_events = local.merge_csv(path)
+
+    assert imported == 0
+    assert has_local_events
+    assert local.history().empty
+
+
+def test_merge_csv_reports_local_events_missing_from_the_file(stores, tmp_path):
+    local, remote = stores
+    remote.record_question('他のプロセスの質問', '回答', 'llm')
+    local.record_question('このプロセスの質問', '回答', 'llm')
+    path = str(tmp_path / 'feedback.csv')
+    remote.export_csv(path)
+
+    imported, has_local_events = local.merge_csv(path)
+
+    assert imported == 1
+    assert has_local_events
+    assert sorted(local.history()['question']) == sorted(['他のプロセスの質問', 'このプロセスの質問'])
+
+
+def test_merge_csv_accepts_an_empty_file(stores, tmp_path):
+    local, _ = stores
+    path = tmp_path / 'feedback.csv'
+    path.write_text('')
+
+    assert local.merge_csv(str(path)) == (0, False)
+    assert local.question_count() == 0
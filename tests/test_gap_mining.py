@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from gap_mining import cluster, mine_gaps, minhash_signatures
+
+
+def test_minhash_signatures_are_deterministic_and_chunk_independent():
+    texts = ['パスワードを忘れた場合はどうすればよいですか', 'VPN に接続できません', 'a']
+
+    whole = minhash_signatures(texts, num_perm=32)
+    chunked = minhash_signatures(texts, num_perm=32, chunk_size=1)
+
+    assert whole.shape == (3, 32)
+    np.testing.assert_array_equal(whole, chunked)
+    np.testing.assert_array_equal(whole, minhash_signatures(texts, num_perm=32))
+
+
+def test_cluster_groups_near_duplicates_only():
+    texts = [
+        'パスワードを忘れた場合はどうすればよいですか',
+        'パスワードを忘れた場合はどうすればよいですか？',
+        'パスワードを忘れた場合どうすればよいですか',
+        '経費精算の締め日はいつですか',
+        '経費精算の締め日はいつですか。',
+    ]
+
+    labels = cluster(minhash_signatures(texts))
+
+    assert labels[0] == labels[1] == labels[2]
+    assert labels[3] == labels[4]
+    assert labels[0] != labels[3]
+
+
+def test_mine_gaps_orders_clusters_by_weight():
+    now = pd.Timestamp('2026-01-01', tz='UTC')
+    questions = pd.DataFrame({
+        'question': ['VPN に接続できません', 'VPN に接続できません。', '経費精算の締め日はいつですか'],
+        'asked': [3, 1, 1],
+        'not_helpful': [1, 1, 0],
+        'no_match': [1, 0, 1],
+        'last_asked': [now, now + pd.Timedelta(days=1), now],
+    })
+
+    gaps = mine_gaps(questions)
+
+    assert [gap['size'] for gap in gaps] == [2, 1]
+    assert gaps[0]['question'] == 'VPN に接続できません'
+    assert (gaps[0]['weight'], gaps[0]['asked']) == (3, 4)
+    assert gaps[0]['last_asked'] == (now + pd.Timedelta(days=1)).isoformat()
+    assert mine_gaps(questions.iloc[:0]) == []
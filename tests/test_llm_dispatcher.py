@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+
+import fake_openai_server
+from llm import get_openai
+from llm_dispatcher import _STREAM_END, LLMDispatcher, _StreamBroadcast
+
+
+def drain(tokens):
+    received = []
+    while True:
+        token = tokens.get(timeout=5)
+        if token is _STREAM_END:
+            return received
+        received.append(token)
+
+
+# ---------------------------
+# Stream Sharing
+# ---------------------------
+def test_late_subscriber_receives_earlier_tokens_once():
+    broadcast = _StreamBroadcast()
+    early = broadcast.subscribe()
+    broadcast.publish('a')
+    broadcast.publish('b')
+    late = broadcast.subscribe()
+    broadcast.publish('c')
+    broadcast.finish()
+
+    assert drain(early) == ['a', 'b', 'c']
+    assert drain(late) == ['a', 'b', 'c']
+
+
+def test_subscriber_after_finish_receives_the_whole_stream():
+    broadcast = _StreamBroadcast()
+    broadcast.publish('a')
+    broadcast.finish()
+
+    assert drain(broadcast.subscribe()) == ['a']
+
+
+# ---------------------------
+# Dispatcher
+# ---------------------------
+@pytest.fixture
+def server(monkeypatch):
+    server = fake_openai_server.start_server(latency=0.3, chunk_delay=0.01)
+    requests = []
+    handler = server.RequestHandlerClass
+    do_post = handler.do_POST
+
+    def counting_do_post(self):
+        requests.append(self.path)
+        do_post(self)
+
+    monkeypatch.setattr(handler, 'do_POST', counting_do_post)
+    openai = get_openai()
+    monkeypatch.setattr(openai, 'api_base', f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(openai, 'api_key', 'fake-key')
+    server.requests = requests
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def dispatcher(server):
+    dispatcher = LLMDispatcher('gpt-4o', requests_per_minute=100000, tokens_per_minute=10000000)
+    yield dispatcher
+    dispatcher.close()
+
+
+def test_concurrent_streams_of_the_same_messages_share_one_request(server, dispatcher):
+    messages = [{'role': 'user', 'content': 'question'}]
+    results = [None] * 4
+    barrier = threading.Barrier(len(results))
+
+    def run(i):
+        barrier.wait()
+        results[i] = ''.join(dispatcher.stream(messages))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = fake_openai_server.fake_answer(messages)
+    assert results == [expected] * len(results)
+    assert len(server.requests) == 1
+
+
+def test_complete_after_a_finished_request_calls_the_api_again(server, dispatcher):
+    messages = [{'role': 'user', 'content': 'question'}]
+
+    assert dispatcher.complete(messages) == fake_openai_server.fake_answer(messages)
+    assert dispatcher.complete(messages) == fake_openai_server.fake_answer(messages)
+    assert len(server.requests) == 2
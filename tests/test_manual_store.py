@@ -0,0 +1,210 @@
+import threading
+import warnings
+
+import pandas as pd
+import pytest
+
+from manual_store import ManualStore, ManualVersionConflict, append_rows, build_changeset
+
+
+def manual(rows):
+    return pd.DataFrame({
+        'question': [row[0] for row in rows],
+        'answer': [row[1] for row in rows],
+        'priority': pd.array([row[2] for row in rows], dtype='Int64'),
+    })
+
+
+@pytest.fixture
+def base():
+    return manual([('q1', 'a1', 1), ('q2', 'a2', None), ('q3', 'a3', None)])
+
+
+# ---------------------------
+# Publish / Rebase
+# ---------------------------
+def test_concurrent_publish_keeps_every_row_and_writes_in_version_order(base):
+    store = ManualStore(base)
+    start = store.snapshot()
+    written = []
+    barrier = threading.Barrier(8)
+
+    def add(i):
+        barrier.wait()
+        data = append_rows(start.data, manual([(f"new {i}", f"answer {i}", None)]))
+        store.publish(data, start.version, base_data=start.data, on_publish=written.append)
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    snapshot = store.snapshot()
+    assert snapshot.version == start.version + 8
+    assert set(snapshot.data['question']) == {'q1', 'q2', 'q3'} | {f"new {i}" for i in range(8)}
+    assert snapshot.data.index.is_unique
+    # 書き出しはロック内で行われるため、最後に書き出した内容が最新のバージョンになる
+    assert [s.version for s in written] == list(range(start.version + 1, snapshot.version + 1))
+    assert written[-1] is snapshot
+
+
+def test_publish_rebases_edits_to_different_rows(base):
+    store = ManualStore(base)
+    start = store.snapshot()
+    mine = start.data.copy()
+    mine.loc[0, 'answer'] = 'mine'
+    theirs = start.data.drop(index=[2])
+    store.publish(theirs, start.version, base_data=start.data)
+
+    snapshot = store.publish(mine, start.version, base_data=start.data)
+
+    assert snapshot.data.index.tolist() == [0, 1]
+    assert snapshot.data['answer'].tolist() == ['mine', 'a2']
+
+
+def test_rebased_rows_do_not_reuse_deleted_ids(base):
+    store = ManualStore(base)
+    start = store.snapshot()
+    theirs = start.data.copy()
+    theirs.loc[0, 'answer'] = 'theirs'
+    store.publish(theirs, start.version, base_data=start.data)
+
+    data = append_rows(start.data, manual([('q4', 'a4', None)])).drop(index=[2])
+    snapshot = store.publish(data, start.version, base_data=start.data)
+
+    assert snapshot.data.index.tolist() == [0, 1, 3]
+
+
+def test_publish_rejects_edits_to_the_same_row(base):
+    store = ManualStore(base)
+    start = store.snapshot()
+    mine = start.data.copy()
+    mine.loc[1, 'answer'] = 'mine'
+    theirs = start.data.copy()
+    theirs.loc[1, 'answer'] = 'theirs'
+    store.publish(theirs, start.version, base_data=start.data)
+
+    with pytest.raises(ManualVersionConflict):
+        store.publish(mine, start.version, base_data=start.data)
+    assert store.snapshot().data.loc[1, 'answer'] == 'theirs'
+
+
+def test_publish_without_base_data_requires_the_current_version(base):
+    store = ManualStore(base)
+    start = store.snapshot()
+    store.publish(start.data.copy(), start.version)
+
+    with pytest.raises(ManualVersionConflict):
+        store.publish(start.data.copy(), start.version)
+
+
+def test_failed_on_publish_does_not_publish(base):
+    store = ManualStore(base)
+    start = store.snapshot()
+
+    def fail(snapshot):
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        store.publish(start.data.drop(index=[0]), start.version, base_data=start.data, on_publish=fail)
+    assert store.snapshot() is start
+
+
+# ---------------------------
+# Remote Merge
+# ---------------------------
+def test_merge_remote_without_local_changes_takes_the_remote_manual(base):
+    store = ManualStore(base)
+
+    merge = store.merge_remote(manual([('q1', 'a1', 1), ('q2', 'A2', None), ('q4', 'a4', 2)]))
+
+    assert merge.snapshot.data['answer'].tolist() == ['a1', 'A2', 'a4']
+    # 内容が変わらない行は ID を引き継ぐ
+    assert merge.snapshot.data.index[0] == 0
+    assert merge.conflicts == []
+    assert not merge.local_changes
+
+
+def test_merge_remote_keeps_unsynced_local_changes(base):
+    store = ManualStore(base)
+    start = store.snapshot()
+    data = append_rows(start.data, manual([('L', 'l', None)]))
+    data.loc[0, 'answer'] = 'local'
+    store.publish(data, start.version, base_data=start.data)
+
+    merge = store.merge_remote(manual([('q1', 'a1', 1), ('q2', 'a2', None), ('R', 'r', None)]))
+
+    assert merge.snapshot.data['question'].tolist() == ['q1', 'q2', 'L', 'R']
+    assert merge.snapshot.data['answer'].tolist() == ['local', 'a2', 'l', 'r']
+    assert merge.conflicts == []
+    assert merge.local_changes
+
+
+def test_merge_remote_reports_questions_changed_on_both_sides(base):
+    store = ManualStore(base)
+    start = store.snapshot()
+    data = start.data.copy()
+    data.loc[1, 'answer'] = 'mine'
+    store.publish(data, start.version, base_data=start.data)
+
+    merge = store.merge_remote(manual([('q1', 'a1', 1), ('q2', 'theirs', None), ('q3', 'a3', None)]))
+
+    assert sorted(merge.snapshot.data['answer']) == ['a1', 'a3', 'mine', 'theirs']
+    assert merge.conflicts == ['q2']
+
+
+def test_merge_remote_is_idempotent(base):
+    store = ManualStore(base)
+    remote = manual([('q1', 'a1', 1), ('q2', 'A2', None)])
+    first = store.merge_remote(remote)
+
+    second = store.merge_remote(remote)
+
+    assert second.snapshot is first.snapshot
+    assert not second.local_changes
+
+
+# ---------------------------
+# Changesets
+# ---------------------------
+def test_build_changeset_counts_updates_inserts_and_deletes(base):
+    edited = pd.DataFrame({
+        'id': [0, 1, None, None],
+        'priority': [1, 5, None, None],
+        'question': ['q1', 'q2', 'q4', ''],
+        'answer': ['a1', 'a2', 'a4', ''],
+    })
+
+    changeset = build_changeset(base, edited, shown_ids=[0, 1, 2])
+
+    assert changeset.errors == []
+    assert (changeset.inserted, changeset.updated, changeset.deleted) == (1, 1, 1)
+    assert changeset.data.index.tolist() == [0, 1, 3]
+    assert changeset.data.loc[1, 'priority'] == 5
+    assert changeset.added['question'].tolist() == ['q2', 'q4']
+    assert changeset.removed['question'].tolist() == ['q2', 'q3']
+
+
+def test_build_changeset_reports_invalid_rows(base):
+    edited = pd.DataFrame({
+        'id': [0, None],
+        'priority': ['high', None],
+        'question': ['q1', 'q4'],
+        'answer': ['a1', ''],
+    })
+
+    changeset = build_changeset(base, edited, shown_ids=[0])
+
+    assert [label for label, _ in changeset.errors] == ['Row 0', 'New row 2']
+
+
+def test_append_rows_with_all_missing_columns_does_not_warn(base):
+    rows = pd.DataFrame({'question': ['q4'], 'answer': [None], 'priority': [None]})
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        data = append_rows(base, rows)
+
+    assert data.index.tolist() == [0, 1, 2, 3]
+    assert str(data['priority'].dtype) == 'Int64'
@@ -0,0 +1,168 @@
+"""
+ローカル検証用の Google Drive v3 互換サーバー。
+
+ファイルの検索（files.list）、再開可能アップロードによる作成・更新、ダウンロード（alt=media）を
+メモリ上で模倣する。GDRIVE_API_ENDPOINT=http://127.0.0.1:<port> を設定してアプリを起動すると、
+Google Drive に接続せずに同期処理を検証できる。
+
+    python tools/fake_drive_server.py --port 8002 --latency 0.2
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+_NAME_PATTERN = re.compile(r"name='([^']*)'")
+_PARENT_PATTERN = re.compile(r"'([^']*)' in parents")
+
+
+class FakeDriveState:
+    """
+    フェイクサーバーが保持するファイルとアップロードセッション
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.sessions = {}
+        self.requests = []
+
+    def metadata(self, file_id):
+        f = self.files[file_id]
+        return {key: f[key] for key in ('id', 'name', 'parents', 'modifiedTime', 'md5Checksum')}
+
+    def write(self, file_id, content):
+        f = self.files[file_id]
+        f['content'] = content
+        f['md5Checksum'] = hashlib.md5(content).hexdigest()
+        f['modifiedTime'] = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    """
+    Google Drive v3 API の一部を模倣するリクエストハンドラー
+    """
+
+    state = None
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _handle(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self._read_body()
+        with self.state.lock:
+            self.state.requests.append((self.command, url.path))
+        if self.command == 'GET' and url.path == '/drive/v3/files':
+            return self._list(query)
+        match = re.fullmatch(r"/drive/v3/files/([^/]+)", url.path)
+        if self.command == 'GET' and match:
+            return self._get(match.group(1), query)
+        if url.path.startswith('/upload/drive/v3/files') and query.get('uploadType') == 'resumable':
+            return self._start_upload(url.path, body)
+        match = re.fullmatch(r"/upload/session/([^/]+)", url.path)
+        if self.command == 'PUT' and match:
+            return self._finish_upload(match.group(1), body)
+        self._send_json({'error': {'code': 404, 'message': f'Unknown path {url.path}'}}, status=404)
+
+    do_GET = do_POST = do_PATCH = do_PUT = _handle
+
+    def _list(self, query):
+        q = query.get('q', '')
+        name = _NAME_PATTERN.search(q)
+        parent = _PARENT_PATTERN.search(q)
+        with self.state.lock:
+            files = [
+                self.state.metadata(file_id) for file_id, f in self.state.files.items()
+                if (name is None or f['name'] == name.group(1))
+                and (parent is None or parent.group(1) in f['parents'])
+            ]
+        self._send_json({'files': files})
+
+    def _get(self, file_id, query):
+        with self.state.lock:
+            if file_id not in self.state.files:
+                return self._send_json({'error': {'code': 404, 'message': 'File not found'}}, status=404)
+            if query.get('alt') != 'media':
+                return self._send_json(self.state.metadata(file_id))
+            content = self.state.files[file_id]['content']
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _start_upload(self, path, body):
+        metadata = json.loads(body or b'{}')
+        match = re.fullmatch(r"/upload/drive/v3/files/([^/]+)", path)
+        with self.state.lock:
+            if match and match.group(1) not in self.state.files:
+                return self._send_json({'error': {'code': 404, 'message': 'File not found'}}, status=404)
+            session_id = uuid.uuid4().hex
+            self.state.sessions[session_id] = (match.group(1) if match else None, metadata)
+        host = self.headers.get('Host')
+        self._send_json({}, headers={'Location': f"http://{host}/upload/session/{session_id}"})
+
+    def _finish_upload(self, session_id, body):
+        with self.state.lock:
+            if session_id not in self.state.sessions:
+                return self._send_json({'error': {'code': 404, 'message': 'Upload session not found'}}, status=404)
+            file_id, metadata = self.state.sessions.pop(session_id)
+            if file_id is None:
+                file_id = uuid.uuid4().hex
+                self.state.files[file_id] = {
+                    'id': file_id,
+                    'name': metadata.get('name', 'untitled'),
+                    'parents': metadata.get('parents', []),
+                }
+            self.state.write(file_id, body)
+            payload = self.state.metadata(file_id)
+        self._send_json(payload)
+
+
+def start_server(host='127.0.0.1', port=0, latency=0.0, state=None):
+    """
+    サーバーをバックグラウンドスレッドで起動し、サーバーオブジェクトを返す関数（server.state でファイルを参照できる）
+    """
+    state = state or FakeDriveState()
+    handler = type('ConfiguredFakeDriveHandler', (FakeDriveHandler,), {'state': state, 'latency': latency})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答前の待ち時間（秒）')
+    args = parser.parse_args()
+    server = start_server(args.host, args.port, args.latency)
+    print(f"Fake Google Drive server listening on http://{args.host}:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
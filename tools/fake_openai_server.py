@@ -0,0 +1,130 @@
+"""
+ローカル検証用の OpenAI 互換サーバー。
+
+/v1/chat/completions（通常・SSE ストリーミング）と /v1/embeddings に固定的な応答を返す。
+OPENAI_API_BASE=http://127.0.0.1:<port>/v1 を設定してアプリを起動すると、
+OpenAI に接続せずにストリーミングや負荷の検証ができる。
+
+    python tools/fake_openai_server.py --port 8001 --latency 0.5 --chunk-delay 0.05
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_answer(messages):
+    """
+    メッセージから決定的な回答テキストを生成する関数
+    """
+    question = messages[-1]['content'].rsplit("\n", 1)[-1] if messages else ''
+    return f"This is a fake answer to: {question}"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI API の一部を模倣するリクエストハンドラー
+    """
+
+    latency = 0.0
+    chunk_delay = 0.0
+    chunk_size = 4
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(self.latency)
+        if self.path.endswith('/chat/completions'):
+            self._chat_completions(request)
+        elif self.path.endswith('/embeddings'):
+            self._embeddings(request)
+        else:
+            self._send_json({'error': {'message': f'Unknown path {self.path}'}}, status=404)
+
+    def _chat_completions(self, request):
+        answer = fake_answer(request.get('messages', []))
+        prompt_tokens = sum(len(m.get('content', '')) for m in request.get('messages', []))
+        if not request.get('stream'):
+            self._send_json({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'model': request.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(answer), 'total_tokens': prompt_tokens + len(answer)},
+            })
+            return
+
+        # Server-Sent Events 形式で回答を少しずつ送る
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        for start in range(0, len(answer), self.chunk_size):
+            chunk = {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'model': request.get('model'),
+                'choices': [{'index': 0, 'delta': {'content': answer[start:start + self.chunk_size]}, 'finish_reason': None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(self.chunk_delay)
+        if (request.get('stream_options') or {}).get('include_usage'):
+            chunk = {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'model': request.get('model'),
+                'choices': [],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(answer), 'total_tokens': prompt_tokens + len(answer)},
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _embeddings(self, request):
+        inputs = request.get('input', [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        data = []
+        for i, text in enumerate(inputs):
+            digest = hashlib.sha256(text.encode('utf-8')).digest()
+            data.append({'object': 'embedding', 'index': i, 'embedding': [b / 255.0 for b in digest[:16]]})
+        self._send_json({'object': 'list', 'data': data, 'model': request.get('model')})
+
+
+def start_server(host='127.0.0.1', port=0, latency=0.0, chunk_delay=0.0):
+    """
+    サーバーをバックグラウンドスレッドで起動し、サーバーオブジェクトを返す関数
+    """
+    handler = type('ConfiguredFakeOpenAIHandler', (FakeOpenAIHandler,), {'latency': latency, 'chunk_delay': chunk_delay})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答前の待ち時間（秒）')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='ストリーミングの断片ごとの待ち時間（秒）')
+    args = parser.parse_args()
+    server = start_server(args.host, args.port, args.latency, args.chunk_delay)
+    print(f"Fake OpenAI server listening on http://{args.host}:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()